@@ -1,72 +1,147 @@
 from __future__ import annotations
 import importlib
+import inspect
 import json
+import os
 import shlex
 import subprocess
 import sys
+import threading
 from pathlib import Path
 from typing import List
 
 from .config import settings
+from .joblog import JobLog
 from .models import Job
 
 
-def run_entrypoint(job: Job) -> int:
+# Progress range assigned to the entry point's own stage reports
+PROGRESS_START = 50
+PROGRESS_END = 90
+
+
+def _progress_callback(job: Job, log: JobLog):
+    """Build the progress_callback(stage, index, total, elapsed) handed to the entry point."""
+    def callback(stage: str, index: int, total: int, elapsed: float):
+        done = max(0, min(index - 1, total)) / total if total else 0
+        job.progress = int(PROGRESS_START + (PROGRESS_END - PROGRESS_START) * done)
+        job.message = f"{stage} ({index}/{total})"
+        log.write(f"[{index}/{total}] {stage} +{elapsed:.1f}s\n")
+    return callback
+
+
+def _parse_progress_line(line: str) -> dict | None:
+    """Structured progress line emitted on stdout in subprocess mode."""
+    if not line.startswith('{"progress"'):
+        return None
+    try:
+        return json.loads(line)["progress"]
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+def _accepts(fn, name: str) -> bool:
+    """True if fn declares `name` explicitly (a bare **kwargs does not count)."""
+    try:
+        return name in inspect.signature(fn).parameters
+    except (TypeError, ValueError):
+        return False
+
+
+def _terminate_on_cancel(proc: subprocess.Popen, cancel_event: threading.Event, grace: float = 5.0):
+    """Watcher thread: terminate the child when the job is cancelled, kill it if it lingers."""
+    while proc.poll() is None:
+        if not cancel_event.wait(0.5):
+            continue
+        proc.terminate()
+        try:
+            proc.wait(timeout=grace)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+        return
+
+
+def load_function(ep: str):
+    """Import the `module:function` entry point, with the project root on sys.path."""
+    mod_name, func_name = ep.split(":", 1)
+    # Ensure project root is on sys.path so modules at repo root are importable
+    try:
+        # __file__ -> .../AppOrario/backend/app/adapter.py
+        # parents[0]=.../backend/app, [1]=.../backend, [2]=.../AppOrario
+        base_root = Path(__file__).resolve().parents[2]
+        if str(base_root) not in sys.path:
+            sys.path.insert(0, str(base_root))
+    except Exception:
+        pass
+    mod = importlib.import_module(mod_name.replace(".py", ""))
+    return getattr(mod, func_name)
+
+
+def session_inputs(inputs_dir: Path) -> List[str]:
+    return [str(p) for p in sorted(inputs_dir.glob("*.xlsx"))]
+
+
+def run_entrypoint(job: Job, log: JobLog, parsed=None) -> int:
+    """
+    Run the configured entry point for job. `parsed`, if given, is the result of
+    the entry point module's load_inputs() for these inputs and is passed on to
+    a function entry point that declares a `parsed` parameter.
+    """
     assert job.workdir is not None
     assert job.log_path is not None
     inputs_dir = job.workdir.parent.parent / "inputs"
-    input_paths = [str(p) for p in sorted(inputs_dir.glob("*.xlsx"))]
-
-    # Prepare log file capture
-    log_file = open(job.log_path, "a", encoding="utf-8")
+    input_paths = session_inputs(inputs_dir)
 
     # Write a header
-    log_file.write("=== Job {} ===\n".format(job.job_id))
-    log_file.write("Inputs: {}\n".format(", ".join(Path(p).name for p in input_paths)))
-    log_file.flush()
+    log.write("=== Job {} ===\n".format(job.job_id))
+    log.write("Inputs: {}\n".format(", ".join(Path(p).name for p in input_paths)))
 
     # Progressive messages
     job.message = "Esecuzione entrypoint"
     job.progress = 25
 
     exit_code = 1
+    on_progress = _progress_callback(job, log)
     try:
         ep = settings.PROGRAM_ENTRYPOINT
         if ":" in ep:
-            mod_name, func_name = ep.split(":", 1)
-            job.message = f"Import {mod_name}:{func_name}"
+            job.message = f"Import {ep}"
             job.progress = 35
-            # Ensure project root is on sys.path so modules at repo root are importable
-            try:
-                # __file__ -> .../AppOrario/backend/app/adapter.py
-                # parents[0]=.../backend/app, [1]=.../backend, [2]=.../AppOrario
-                base_root = Path(__file__).resolve().parents[2]
-                if str(base_root) not in sys.path:
-                    sys.path.insert(0, str(base_root))
-            except Exception:
-                pass
-            mod = importlib.import_module(mod_name.replace(".py", ""))
-            fn = getattr(mod, func_name)
+            fn = load_function(ep)
             job.message = "Esecuzione funzione"
-            job.progress = 50
-            result = fn(input_paths=input_paths, output_dir=str(job.workdir), **job.options)
+            job.progress = PROGRESS_START
+            kwargs = dict(job.options)
+            if _accepts(fn, "progress_callback"):
+                kwargs["progress_callback"] = on_progress
+            if _accepts(fn, "cancel_event"):
+                kwargs["cancel_event"] = job.cancel_event
+            if parsed is not None and _accepts(fn, "parsed"):
+                kwargs["parsed"] = parsed
+                log.write("Input già letti al caricamento: lettura saltata\n")
+            result = fn(input_paths=input_paths, output_dir=str(job.workdir), **kwargs)
             exit_code = 0 if (result is None or result == 0) else int(result)
         else:
             job.message = "Esecuzione subprocess"
-            job.progress = 50
+            job.progress = PROGRESS_START
             cmd = [sys.executable, ep] if ep.endswith('.py') else shlex.split(ep)
             cmd += ["--inputs", json.dumps(input_paths), "--out", str(job.workdir), "--options", json.dumps(job.options)]
-            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+            # unbuffered child stdout so progress lines arrive as they are printed
+            env = {**os.environ, "PYTHONUNBUFFERED": "1"}
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, env=env)
+            watcher = threading.Thread(target=_terminate_on_cancel, args=(proc, job.cancel_event), daemon=True)
+            watcher.start()
             for line in proc.stdout:  # type: ignore
-                log_file.write(line)
+                p = _parse_progress_line(line)
+                if p is not None:
+                    on_progress(p.get("stage", ""), int(p.get("index", 0)), int(p.get("total", 0)), float(p.get("elapsed", 0)))
+                else:
+                    log.write(line)
             proc.wait()
+            watcher.join()
             exit_code = proc.returncode
-        job.progress = 90
+        job.progress = PROGRESS_END
         job.message = "Post-processing"
     except Exception as e:
-        log_file.write(f"\n[ERROR] {e}\n")
+        log.write(f"\n[ERROR] {e}\n")
         exit_code = 1
-    finally:
-        log_file.flush()
-        log_file.close()
     return exit_code
@@ -0,0 +1,91 @@
+"""
+Admission control for /upload and /run: per-client token buckets and a cap on
+concurrent uploads. Queue-depth limits live in JobQueue, which knows the queue.
+Everything here is non-blocking: over the limit a request is rejected at once
+with the number of seconds the client should wait.
+"""
+from __future__ import annotations
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+from .config import settings
+
+
+class TokenBucket:
+    def __init__(self, rate_per_sec: float, capacity: float):
+        self.rate = rate_per_sec
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def take(self, now: float) -> float:
+        """Consume one token; return 0 on success, else seconds until one is available."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """One token bucket per client key (the remote address)."""
+
+    def __init__(self, per_minute: float, burst: int):
+        self.rate = per_minute / 60.0
+        self.burst = max(1, burst)
+        self._buckets: dict[str, TokenBucket] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.rate > 0
+
+    def check(self, key: str) -> int:
+        """0 if admitted, else Retry-After seconds."""
+        if not self.enabled:
+            return 0
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if len(self._buckets) > 10_000:
+                    self._prune(now)
+                bucket = self._buckets[key] = TokenBucket(self.rate, self.burst)
+            wait = bucket.take(now)
+        return math.ceil(wait) if wait else 0
+
+    def _prune(self, now: float) -> None:
+        # a bucket idle long enough to be full again carries no state
+        refill = self.burst / self.rate
+        for key in [k for k, b in self._buckets.items() if now - b.updated > refill]:
+            del self._buckets[key]
+
+
+class ConcurrencySlots:
+    """Non-blocking counter of in-flight operations."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.active = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def acquire(self):
+        """Yields True if a slot was taken, False if all are busy (limit <= 0 = unlimited)."""
+        with self._lock:
+            ok = self.limit <= 0 or self.active < self.limit
+            if ok:
+                self.active += 1
+        try:
+            yield ok
+        finally:
+            if ok:
+                with self._lock:
+                    self.active -= 1
+
+
+rate_limiter = RateLimiter(settings.RATE_LIMIT_PER_MINUTE, settings.RATE_LIMIT_BURST)
+upload_slots = ConcurrencySlots(settings.MAX_CONCURRENT_UPLOADS)
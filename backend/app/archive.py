@@ -0,0 +1,58 @@
+"""
+Results archive ("Scarica tutto"), built once per job and then served from disk.
+
+The worker builds it as soon as a job succeeds; jobs that end otherwise get it
+lazily on the first request. A per-job lock makes concurrent first requests
+wait for a single build instead of zipping the directory twice.
+"""
+from __future__ import annotations
+import hashlib
+import threading
+from pathlib import Path
+
+from .models import Job
+from .quota import quota
+from .storage import RESULTS_ARCHIVE, write_results_archive
+
+
+class ResultsArchiver:
+    def __init__(self):
+        self._locks: dict[str, threading.Lock] = {}
+        self._guard = threading.Lock()
+
+    def _lock_for(self, job_id: str) -> threading.Lock:
+        with self._guard:
+            return self._locks.setdefault(job_id, threading.Lock())
+
+    def ensure(self, job: Job) -> tuple[Path, str]:
+        """(archive path, ETag) for a finished job, building the archive if needed. Blocking."""
+        path = job.workdir / RESULTS_ARCHIVE
+        with self._lock_for(job.job_id):
+            if job.archive_etag is None or not path.is_file():
+                members = write_results_archive(job.workdir, path)
+                digest = hashlib.sha256()
+                if job.manifest is not None:
+                    # same outputs, same ETag, whenever the archive is rebuilt
+                    for f in job.manifest:
+                        digest.update(f"{f['filename']}\0{f['sha256']}\n".encode())
+                else:
+                    for m in members:
+                        digest.update(f"{m['filename']}\0{m['size_bytes']}\0{m['mtime_ns']}\n".encode())
+                job.archive_etag = f'"{digest.hexdigest()[:32]}"'
+                quota.charge("archive", job.job_id, path.stat().st_size, job.session_id)
+        return path, job.archive_etag
+
+    def drop(self, job: Job) -> bool:
+        """Delete a job's archive to free space; the next download rebuilds it."""
+        with self._lock_for(job.job_id):
+            (job.workdir / RESULTS_ARCHIVE).unlink(missing_ok=True)
+            job.archive_etag = None
+            quota.release("archive", job.job_id)
+        return True
+
+    def forget(self, job_id: str) -> None:
+        with self._guard:
+            self._locks.pop(job_id, None)
+
+
+archives = ResultsArchiver()
@@ -0,0 +1,109 @@
+"""
+Content-addressed store for uploaded inputs: OUTPUT_DIR_BASE/blobs/ab/<sha256>.
+
+Files in session inputs/ become hard links to their blob, so the same timetable
+uploaded by many sessions uses disk space once. The reference count is the
+inode's link count: a blob whose st_nlink is 1 is referenced only by the store
+itself and can be deleted.
+
+Every link shares the same bytes, so a linked file must never be written in
+place. Inputs satisfy that (each upload gets a new session directory and is
+only read afterwards); job outputs are not stored here, as exports embed their
+creation time and would rarely match anyway. The read-only mode on blobs only
+guards against a non-root process writing to them.
+
+Where hard links are not possible (other filesystem, no permission) the file
+simply keeps its private copy.
+"""
+from __future__ import annotations
+import os
+import stat
+import threading
+from pathlib import Path
+from typing import Iterable
+
+from .config import settings
+from .logging_config import logger
+from .quota import BLOB_OWNER, quota
+
+
+class BlobStore:
+    def __init__(self, root: Path):
+        self.root = root
+        self._lock = threading.Lock()
+
+    def path_for(self, sha256: str) -> Path:
+        return self.root / sha256[:2] / sha256
+
+    def adopt(self, path: Path, sha256: str) -> bool:
+        """
+        Replace `path` with a hard link to the blob of its content (creating the
+        blob from it if new). Returns True if the file is now blob-backed.
+        """
+        blob = self.path_for(sha256)
+        try:
+            with self._lock:
+                if blob.exists():
+                    tmp = path.with_name(path.name + ".link")
+                    os.link(blob, tmp)
+                    os.replace(tmp, path)
+                else:
+                    blob.parent.mkdir(parents=True, exist_ok=True)
+                    os.link(path, blob)
+                    os.chmod(blob, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+                    quota.charge("blob", sha256, blob.stat().st_size, BLOB_OWNER)
+            return True
+        except OSError as e:
+            logger.warning(f"Blob store: keeping private copy of {path.name} ({e})")
+            return False
+
+    def adopt_many(self, items: Iterable[tuple[Path, str]]) -> int:
+        """Adopt (path, sha256) pairs; returns the bytes of the files left as private copies."""
+        private = 0
+        for path, sha256 in items:
+            if not self.adopt(path, sha256):
+                private += path.stat().st_size
+        return private
+
+    def release(self, hashes: Iterable[str]) -> None:
+        """Delete the given blobs if no session or job links to them any more."""
+        with self._lock:
+            for sha256 in set(hashes):
+                self._drop_if_unused(self.path_for(sha256))
+
+    def _drop_if_unused(self, blob: Path) -> None:
+        try:
+            if blob.stat().st_nlink <= 1:
+                blob.unlink()
+                quota.release("blob", blob.name)
+                self._prune_dir(blob.parent)
+        except FileNotFoundError:
+            quota.release("blob", blob.name)
+
+    @staticmethod
+    def _prune_dir(prefix_dir: Path) -> None:
+        try:
+            prefix_dir.rmdir()
+        except OSError:
+            pass  # not empty
+
+    def sweep(self) -> None:
+        """Full pass over the store: drop unreferenced blobs and charge the rest (at startup)."""
+        if not self.root.is_dir():
+            return
+        kept = removed = 0
+        with self._lock:
+            for blob in list(self.root.glob("*/*")):
+                st = blob.stat()
+                if st.st_nlink <= 1:
+                    blob.unlink()
+                    quota.release("blob", blob.name)
+                    self._prune_dir(blob.parent)
+                    removed += 1
+                else:
+                    quota.charge("blob", blob.name, st.st_size, BLOB_OWNER)
+                    kept += 1
+        logger.info(f"Blob store: {kept} blobs in use, {removed} unreferenced removed")
+
+
+blobs = BlobStore(settings.OUTPUT_DIR_BASE / "blobs")
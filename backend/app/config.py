@@ -8,9 +8,31 @@ class Settings(BaseSettings):
     PROGRAM_ENTRYPOINT: str = Field(default="mio_runner.py:main", description="Module:function or script path")
     MAX_FILE_SIZE_MB: int = 50
     ALLOWED_EXTENSIONS: list[str] | str = [".xlsx"]
-    JOB_TTL_MINUTES: int = 120
+    JOB_TTL_MINUTES: int = 120  # finished jobs are deleted this long after their last access
+    SESSION_TTL_MINUTES: int = 240  # sessions (inputs + job tree) idle this long are deleted
+    JOB_TIMEOUT_MINUTES: float = 30  # max runtime per job; 0 disables
     OUTPUT_DIR_BASE: Path | str = Path("./data")
     FRONTEND_DIST_DIR: Path | None = None  # optional static mount
+    STORAGE_BUDGET_MB: int = 2048  # disk budget for sessions + jobs; 0 = no limit (usage still tracked)
+    PREPARSE_ENABLED: bool = True  # parse inputs in the background right after upload
+    PREPARSE_WORKERS: int = 1
+    TIMETABLE_CACHE_MB: int = 16  # rendered /sessions/.../timetable responses kept in memory
+    LOG_TAIL_LINES: int = 2000  # recent log lines kept in memory per running job
+    MAX_BATCH_VARIANTS: int = 20  # option variants one /run may render over a single parse
+
+    # admission control (0 disables a limit)
+    MAX_QUEUED_JOBS: int = 50
+    MAX_QUEUED_JOBS_PER_SESSION: int = 5
+    MAX_CONCURRENT_UPLOADS: int = 4
+    RATE_LIMIT_PER_MINUTE: float = 30  # /upload + /run requests per client
+    RATE_LIMIT_BURST: int = 10
+
+    # concurrent worker threads per kind of blocking I/O in the API
+    IO_CONCURRENCY_FS: int = 8
+    IO_CONCURRENCY_VALIDATE: int = 4
+    IO_CONCURRENCY_ZIP: int = 1
+    IO_CONCURRENCY_DELETE: int = 2
+    IO_CONCURRENCY_INDEX: int = 2
 
     # server
     HOST: str = "0.0.0.0"
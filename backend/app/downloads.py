@@ -0,0 +1,122 @@
+"""
+File responses with validators: ETag / If-None-Match (304) and single-range
+`Range` requests (206 / 416). Starlette's FileResponse sends neither ranges nor
+our own ETags, so downloads of results go through file_response().
+Cached JSON bodies get the same ETag handling through json_response().
+"""
+from __future__ import annotations
+import mimetypes
+import re
+from email.utils import formatdate
+from pathlib import Path
+from urllib.parse import quote
+
+import anyio
+from fastapi import Request
+from fastapi.responses import FileResponse, Response, StreamingResponse
+
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+CHUNK_SIZE = 64 * 1024
+
+
+def _content_disposition(filename: str) -> str:
+    quoted = quote(filename)
+    if quoted != filename:
+        return f"attachment; filename*=utf-8''{quoted}"
+    return f'attachment; filename="{filename}"'
+
+
+def _etag_matches(header: str, etag: str) -> bool:
+    if header.strip() == "*":
+        return True
+    # weak comparison, as RFC 9110 prescribes for If-None-Match
+    tags = [t.strip().removeprefix("W/") for t in header.split(",")]
+    return etag.removeprefix("W/") in tags
+
+
+def _parse_range(header: str, size: int) -> tuple[int, int] | None:
+    """(start, end) inclusive for a single satisfiable range; None if unsatisfiable."""
+    m = RANGE_RE.match(header.strip())
+    if not m or size == 0:
+        return None
+    first, last = m.groups()
+    if first:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    elif last:
+        start, end = max(0, size - int(last)), size - 1
+    else:
+        return None
+    if start > end or start >= size:
+        return None
+    return start, end
+
+
+async def _read_range(path: Path, start: int, end: int):
+    async with await anyio.open_file(path, "rb") as fh:
+        await fh.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = await fh.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def file_response(request: Request, path: Path, *, filename: str, etag: str, size: int, mtime: float,
+                  cache_control: str | None = None, media_type: str | None = None) -> Response:
+    """
+    Serve `path` (whose size and mtime the caller already knows) as an attachment.
+    The file itself is only opened when a body is sent.
+    """
+    headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(mtime, usegmt=True),
+        "Accept-Ranges": "bytes",
+    }
+    if cache_control:
+        headers["Cache-Control"] = cache_control
+
+    inm = request.headers.get("if-none-match")
+    if inm is not None and _etag_matches(inm, etag):
+        return Response(status_code=304, headers=headers)
+
+    rng = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    # If-Range needs a strong validator: with a weak ETag a conditional range gets the whole file
+    if rng and (if_range is None or (if_range.strip() == etag and not etag.startswith("W/"))):
+        if not RANGE_RE.match(rng.strip()):
+            rng = None  # multiple or malformed ranges: send the whole file
+        else:
+            span = _parse_range(rng, size)
+            if span is None:
+                headers["Content-Range"] = f"bytes */{size}"
+                return Response(status_code=416, headers=headers)
+            start, end = span
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+            headers["Content-Length"] = str(end - start + 1)
+            headers["Content-Disposition"] = _content_disposition(filename)
+            media_type = media_type or mimetypes.guess_type(filename)[0] or "application/octet-stream"
+            return StreamingResponse(_read_range(path, start, end), status_code=206, headers=headers,
+                                     media_type=media_type)
+    headers["Content-Length"] = str(size)
+    return FileResponse(path, filename=filename, headers=headers, media_type=media_type)
+
+
+def json_response(request: Request, body: bytes, *, etag: str, cache_control: str | None = None) -> Response:
+    """Serve an already serialized JSON body, or 304 if the client has it."""
+    headers = {"ETag": etag}
+    if cache_control:
+        headers["Cache-Control"] = cache_control
+    inm = request.headers.get("if-none-match")
+    if inm is not None and _etag_matches(inm, etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, headers=headers, media_type="application/json")
+
+
+def attachment_response(body: bytes, filename: str) -> Response:
+    """A file built in memory (not stored in a job), served as a download."""
+    media_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    return Response(content=body, media_type=media_type,
+                    headers={"Content-Disposition": _content_disposition(filename), "Cache-Control": "no-store"})
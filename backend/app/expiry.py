@@ -0,0 +1,129 @@
+"""
+Expiry of sessions and jobs.
+
+ExpiryIndex is a min-heap of (deadline, kind, key). Extending a TTL only
+updates the deadline in a dict; the stale heap entry is re-pushed with the real
+deadline when it surfaces. Each GC pass therefore only touches entries that are
+due, however many sessions and jobs are stored.
+
+The Reaper thread sleeps until the next deadline and hands due keys to the
+handler registered for their kind ("session", "job"). A handler returns False
+to keep the key alive for another TTL (e.g. a session with jobs still around).
+"""
+from __future__ import annotations
+import heapq
+import threading
+import time
+import traceback
+from typing import Callable
+
+from .logging_config import logger
+
+# upper bound on one sleep, so a clock jump or a missed notify cannot stall GC
+MAX_SLEEP_SECONDS = 60.0
+
+
+class ExpiryIndex:
+    def __init__(self):
+        self._heap: list[tuple[float, str, str]] = []
+        self._deadline: dict[tuple[str, str], float] = {}
+        self._ttl: dict[tuple[str, str], float] = {}
+        self._cond = threading.Condition()
+
+    def __len__(self) -> int:
+        with self._cond:
+            return len(self._deadline)
+
+    def add(self, kind: str, key: str, ttl_seconds: float) -> None:
+        """Start (or restart) tracking key; it expires ttl_seconds after its last touch."""
+        deadline = time.monotonic() + ttl_seconds
+        with self._cond:
+            self._deadline[(kind, key)] = deadline
+            self._ttl[(kind, key)] = ttl_seconds
+            heapq.heappush(self._heap, (deadline, kind, key))
+            if self._heap[0][0] == deadline:
+                self._cond.notify()
+
+    def touch(self, kind: str, key: str) -> None:
+        """Extend a tracked key by its TTL from now. O(1): no heap operation."""
+        with self._cond:
+            ttl = self._ttl.get((kind, key))
+            if ttl is not None:
+                self._deadline[(kind, key)] = time.monotonic() + ttl
+
+    def discard(self, kind: str, key: str) -> None:
+        with self._cond:
+            self._deadline.pop((kind, key), None)
+            self._ttl.pop((kind, key), None)
+            # its heap entry is dropped when it surfaces
+
+    def pop_due(self, now: float) -> list[tuple[str, str]]:
+        due = []
+        with self._cond:
+            while self._heap and self._heap[0][0] <= now:
+                _deadline, kind, key = heapq.heappop(self._heap)
+                current = self._deadline.get((kind, key))
+                if current is None:
+                    continue  # discarded
+                if current > now:
+                    heapq.heappush(self._heap, (current, kind, key))  # touched since
+                    continue
+                del self._deadline[(kind, key)]
+                self._ttl.pop((kind, key), None)
+                due.append((kind, key))
+        return due
+
+    def wait(self, timeout: float) -> None:
+        """Sleep until the earliest deadline, a new earlier one, or timeout."""
+        with self._cond:
+            if self._heap:
+                timeout = min(timeout, max(0.0, self._heap[0][0] - time.monotonic()))
+            if timeout > 0:
+                self._cond.wait(timeout)
+
+
+class Reaper:
+    def __init__(self, index: ExpiryIndex):
+        self.index = index
+        self._handlers: dict[str, tuple[Callable[[str], bool], float]] = {}
+        self._startup: list[Callable[[], None]] = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, daemon=True, name="reaper")
+
+    def register(self, kind: str, handler: Callable[[str], bool], ttl_seconds: float) -> None:
+        self._handlers[kind] = (handler, ttl_seconds)
+
+    def on_start(self, fn: Callable[[], None]) -> None:
+        """Run fn on the reaper thread before the first pass (startup reconciliation)."""
+        self._startup.append(fn)
+
+    def track(self, kind: str, key: str) -> None:
+        self.index.add(kind, key, self._handlers[kind][1])
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def _loop(self) -> None:
+        for fn in self._startup:
+            try:
+                fn()
+            except Exception:
+                logger.error("Startup reconciliation failed:\n" + traceback.format_exc())
+        while not self._stop.is_set():
+            for kind, key in self.index.pop_due(time.monotonic()):
+                handler, ttl = self._handlers[kind]
+                try:
+                    done = handler(key)
+                except Exception:
+                    logger.error(f"Expiry of {kind} {key} failed:\n" + traceback.format_exc())
+                    done = False
+                if not done:
+                    self.index.add(kind, key, ttl)
+            self.index.wait(MAX_SLEEP_SECONDS)
+
+
+expiry = ExpiryIndex()
+reaper = Reaper(expiry)
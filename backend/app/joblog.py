@@ -0,0 +1,108 @@
+"""
+Job log writer with an in-memory tail.
+
+Each running job writes its log through a JobLog: bytes go to job.log on disk
+and the most recent lines stay in a bounded ring buffer, so incremental
+`/logs/{job_id}?offset=N` polls are served from memory while the job runs.
+Once the job finishes the log is closed and reads fall back to seek-based
+reads of the file.
+"""
+from __future__ import annotations
+import threading
+from collections import deque
+from pathlib import Path
+
+from .config import settings
+from .storage import read_file_chunk
+
+
+class JobLog:
+    def __init__(self, path: Path, max_lines: int | None = None):
+        self.path = Path(path)
+        self._fh = open(self.path, "ab")
+        self._size = self._fh.tell()
+        self._lines: deque[tuple[int, bytes]] = deque(maxlen=max_lines or settings.LOG_TAIL_LINES)
+        self._lock = threading.Lock()
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    def write(self, text: str) -> None:
+        data = text.encode("utf-8")
+        if not data:
+            return
+        with self._lock:
+            self._fh.write(data)
+            self._fh.flush()
+            self._buffer(data, self._size)
+            self._size += len(data)
+
+    def _buffer(self, data: bytes, start: int) -> None:
+        for piece in data.splitlines(keepends=True):
+            # an unterminated last line keeps growing until its newline arrives
+            if self._lines and not self._lines[-1][1].endswith(b"\n"):
+                off, prev = self._lines[-1]
+                self._lines[-1] = (off, prev + piece)
+            else:
+                self._lines.append((start, piece))
+            start += len(piece)
+
+    def read_from(self, offset: int) -> tuple[bytes, int] | None:
+        """Bytes after `offset` from the ring buffer, or None if already evicted."""
+        with self._lock:
+            if offset >= self._size:
+                return b"", self._size
+            if not self._lines or offset < self._lines[0][0]:
+                return None
+            parts = []
+            for off, piece in self._lines:
+                end = off + len(piece)
+                if end <= offset:
+                    continue
+                parts.append(piece[max(0, offset - off):])
+            return b"".join(parts), self._size
+
+    def close(self) -> None:
+        with self._lock:
+            self._fh.close()
+
+
+class JobLogRegistry:
+    """Open JobLog per running job, keyed by job_id."""
+
+    def __init__(self):
+        self._logs: dict[str, JobLog] = {}
+        self._lock = threading.Lock()
+
+    def open(self, job_id: str, path: Path) -> JobLog:
+        log = JobLog(path)
+        with self._lock:
+            self._logs[job_id] = log
+        return log
+
+    def get(self, job_id: str) -> JobLog | None:
+        with self._lock:
+            return self._logs.get(job_id)
+
+    def close(self, job_id: str) -> None:
+        with self._lock:
+            log = self._logs.pop(job_id, None)
+        if log:
+            log.close()
+
+    def read(self, job_id: str, path: Path, offset: int) -> tuple[bytes, int]:
+        """
+        Return (bytes appended after offset, new offset).
+        Blocking when it has to go to disk: call it off the event loop.
+        """
+        offset = max(0, offset)
+        log = self.get(job_id)
+        if log is not None:
+            hit = log.read_from(offset)
+            if hit is not None:
+                return hit
+        return read_file_chunk(path, offset)
+
+
+job_logs = JobLogRegistry()
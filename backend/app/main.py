@@ -1,33 +1,95 @@
 from __future__ import annotations
+import asyncio
+import hashlib
 import io
 import json
+import os
 import uuid
 from datetime import datetime
 from pathlib import Path
 from typing import Annotated
+from urllib.parse import quote
 
-from fastapi import FastAPI, UploadFile, File, HTTPException, BackgroundTasks, Depends
-from fastapi.responses import FileResponse, PlainTextResponse, ORJSONResponse
+import orjson
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Depends, Request
+from fastapi.responses import PlainTextResponse, ORJSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
+from starlette.middleware.base import BaseHTTPMiddleware
 
 from .config import settings
 from .models import Job, JobStatus, Session
-from .storage import sanitize_filename, ensure_session_dirs, create_job_dir, total_size, list_files, zip_directory
+from .storage import (ensure_session_dirs, create_job_dir, total_size, list_files, is_result_file,
+                      cleanup_dir, session_dir, sessions_root)
 from .worker import job_queue
-from .validation import validator
+from .scheduler import PRIORITIES, DEFAULT_PRIORITY
+from .joblog import job_logs
+from .admission import rate_limiter, upload_slots
+from .uploads import receive_files, MULTIPART_OVERHEAD
+from .offload import run_io
+from .archive import archives
+from .downloads import attachment_response, file_response, json_response
+from .expiry import expiry, reaper
+from .quota import quota
+from .blobs import blobs
+from .speculative import preparser
+from .schedule import SessionSchedule, schedules, teacher_key, timetables
+from .validation import engine
 from .logging_config import logger
 
 ALLOWED_EXTS = set(settings.ALLOWED_EXTENSIONS)
 MAX_TOTAL = settings.MAX_FILE_SIZE_MB * 1024 * 1024
 
+ADMISSION_PATHS = {"/upload", "/run"}
+
+
+def too_busy(status_code: int, detail: str, retry_after: int) -> ORJSONResponse:
+    return ORJSONResponse({"detail": detail}, status_code=status_code, headers={"Retry-After": str(retry_after)})
+
+
+# per-browser id sent by the frontend with /upload and /run (random, kept in localStorage)
+CLIENT_ID_HEADER = "X-Client-Id"
+
+
+def client_key(request: Request) -> str:
+    """
+    Who a request counts against: the browser's X-Client-Id, else the remote address
+    (the X-Forwarded-For client when uvicorn runs with --proxy-headers behind a trusted proxy).
+    A school's staff usually share one IP, so the address alone would lump them together.
+    """
+    client_id = request.headers.get(CLIENT_ID_HEADER)
+    if client_id:
+        return "id:" + client_id[:64]
+    return "ip:" + (request.client.host if request.client else "unknown")
+
+
+async def admission_control(request: Request, call_next):
+    """Rate-limit /upload and /run per client and cap concurrent uploads, before the body is read."""
+    if request.method != "POST" or request.url.path not in ADMISSION_PATHS:
+        return await call_next(request)
+    client = client_key(request)
+    wait = rate_limiter.check(client)
+    if wait:
+        logger.warning(f"Rate limit hit by {client} on {request.url.path}")
+        return too_busy(429, "Troppe richieste, riprovare più tardi", wait)
+    if request.url.path != "/upload":
+        return await call_next(request)
+    with upload_slots.acquire() as ok:
+        if not ok:
+            return too_busy(503, "Troppi caricamenti in corso, riprovare più tardi", 2)
+        return await call_next(request)
+
+
 app = FastAPI(title="Excel Runner API", default_response_class=ORJSONResponse)
+# added first so CORS (added last, outermost) also decorates its rejections
+app.add_middleware(BaseHTTPMiddleware, dispatch=admission_control)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Log-Offset", "Retry-After", "ETag", "Content-Range", "Accept-Ranges"],
 )
 
 # Nota: montiamo StaticFiles alla fine del file, dopo aver registrato tutte le API,
@@ -36,6 +98,51 @@ app.add_middleware(
 
 SESSIONS: dict[str, Session] = {}
 
+
+def _expire_session(session_id: str) -> bool:
+    """Expiry handler: delete the whole session tree once none of its jobs is queued or running."""
+    # unregister first so /run stops accepting it, and put it back if a job is still active
+    session = SESSIONS.pop(session_id, None)
+    jobs = job_queue.drop_session(session_id)
+    if jobs is None:
+        if session is not None:
+            SESSIONS[session_id] = session
+        return False
+    preparser.discard(session_id)
+    schedules.discard(session_id)
+    cleanup_dir(session_dir(session_id))
+    quota.release("inputs", session_id)
+    if session is not None:
+        blobs.release(session.input_hashes.values())
+    logger.info(f"Session {session_id} expired")
+    return True
+
+
+def _reconcile_sessions_dir() -> None:
+    """
+    At startup no session is known, so every directory under sessions/ is an
+    orphan of a previous run that no client can use again (sessions live in
+    memory): delete them all, then drop the blobs only they linked to.
+    """
+    root = sessions_root()
+    if not root.is_dir():
+        return
+    removed = 0
+    for d in root.iterdir():
+        if d.name in SESSIONS:
+            continue
+        if d.is_dir():
+            cleanup_dir(d)
+        else:
+            d.unlink(missing_ok=True)
+        removed += 1
+    logger.info(f"Orphan session dirs: {removed} removed")
+    blobs.sweep()
+
+
+reaper.register("session", _expire_session, settings.SESSION_TTL_MINUTES * 60)
+reaper.on_start(_reconcile_sessions_dir)
+
 @app.on_event("startup")
 async def on_startup():
     logger.info(f"Starting Excel Runner API")
@@ -43,6 +150,7 @@ async def on_startup():
     logger.info(f"MAX_FILE_SIZE_MB: {settings.MAX_FILE_SIZE_MB}")
     logger.info(f"ALLOWED_EXTENSIONS: {settings.ALLOWED_EXTENSIONS}")
     logger.info(f"JOB_TTL_MINUTES: {settings.JOB_TTL_MINUTES}")
+    logger.info(f"SESSION_TTL_MINUTES: {settings.SESSION_TTL_MINUTES}")
     import sys
     logger.info(f"PYTHON_EXECUTABLE: {sys.executable}")
     try:
@@ -50,14 +158,17 @@ async def on_startup():
         logger.info(f"pandas_version: {_pd.__version__}")
     except Exception as _e:
         logger.error(f"pandas_import_error: {_e}")
+    await run_io("validate", engine.load_examples)
+    logger.info(f"Example fingerprints: {sorted(engine.examples)}")
     job_queue.start()
+    reaper.start()
 
 
 @app.get("/health")
 async def health():
     """Health check endpoint."""
     import sys
-    info = {"status": "ok", "version": "0.1.0", "python": sys.executable}
+    info = {"status": "ok", "version": "0.1.0", "python": sys.executable, "storage": quota.usage()}
     try:
         import pandas as _pd
         info["pandas_version"] = _pd.__version__
@@ -67,91 +178,371 @@ async def health():
 
 
 @app.post("/upload")
-async def upload(files: list[UploadFile] = File(...)):
-    if not files:
-        raise HTTPException(400, "Nessun file caricato")
-    exts = []
-    total = 0
+async def upload(request: Request):
+    """Multipart upload of the `files` parts, streamed to disk (see uploads.receive_files)."""
+    declared = int(request.headers.get("content-length") or 0)
+    if declared > MAX_TOTAL + MULTIPART_OVERHEAD:
+        logger.warning(f"Upload rejected: declared size {declared} > {MAX_TOTAL}")
+        raise HTTPException(413, f"Dimensione totale supera limite: {settings.MAX_FILE_SIZE_MB} MB")
+    if not await run_io("delete", quota.enforce, declared):
+        logger.warning(f"Upload rejected: storage budget exhausted ({quota.used} bytes used)")
+        raise HTTPException(507, "Spazio di archiviazione esaurito, riprovare più tardi")
     session_id = str(uuid.uuid4())
-    base, inputs_dir, _jobs = ensure_session_dirs(session_id)
-    logger.info(f"Upload session {session_id}: {len(files)} files")
-
-    # Helper: compare uploaded Excel structure against example file if present
-    def compare_with_example(fname: str, uploaded_path: Path) -> tuple[bool, str | None]:
-        try:
-            examples_dir = Path(__file__).resolve().parents[2] / "examples"
-            example_path = examples_dir / fname
-            if not example_path.exists():
-                return True, None  # no example available => skip
-            import pandas as pd
-            # Compare sheet names
-            up_xl = pd.ExcelFile(str(uploaded_path))
-            ex_xl = pd.ExcelFile(str(example_path))
-            if set(up_xl.sheet_names) != set(ex_xl.sheet_names):
-                return False, f"Fogli diversi: {up_xl.sheet_names} vs {ex_xl.sheet_names}"
-            # Compare header columns for each sheet
-            for sh in ex_xl.sheet_names:
-                up_cols = pd.read_excel(str(uploaded_path), sheet_name=sh, nrows=0).columns.tolist()
-                ex_cols = pd.read_excel(str(example_path), sheet_name=sh, nrows=0).columns.tolist()
-                if up_cols != ex_cols:
-                    return False, f"Intestazioni diverse nel foglio '{sh}': {up_cols} vs {ex_cols}"
-            return True, None
-        except Exception as e:
-            # In caso di errore imprevisto nella comparazione, non bloccare l'upload
-            logger.warning(f"Example compare skipped for {fname}: {e}")
-            return True, None
-
-    for uf in files:
-        name = sanitize_filename(uf.filename or "file")
-        ext = Path(name).suffix.lower()
-        exts.append(ext)
-        if ext not in ALLOWED_EXTS:
-            logger.warning(f"Upload rejected: invalid extension {ext}")
-            raise HTTPException(400, f"Estensione non permessa: {ext}")
-        data = await uf.read()
-        total += len(data)
-        if total > MAX_TOTAL:
-            logger.warning(f"Upload rejected: size {total} > {MAX_TOTAL}")
-            raise HTTPException(413, f"Dimensione totale supera limite: {settings.MAX_FILE_SIZE_MB} MB")
-        file_path = inputs_dir / name
-        file_path.write_bytes(data)
-        
-        # Optional schema validation
-        is_valid, error_msg = validator.validate(file_path)
-        if not is_valid:
-            logger.warning(f"Upload validation failed for {name}: {error_msg}")
-            raise HTTPException(400, f"Validazione schema fallita per {name}: {error_msg}")
-
-        # Structural comparison with example file (if present)
-        ok, reason = compare_with_example(name, file_path)
-        if not ok:
-            logger.warning(f"Upload structure mismatch for {name}: {reason}")
-            raise HTTPException(status_code=400, detail={
-                "bad_file": name,
-                "reason": "Verificare il file caricato, la sua struttura differisce da quella prevista",
-                "debug": reason,
-            })
-
-    SESSIONS[session_id] = Session(session_id=session_id, created_at=datetime.utcnow(), input_dir=inputs_dir)
+    base, inputs_dir, _jobs = await run_io("fs", ensure_session_dirs, session_id)
+    logger.info(f"Upload session {session_id}: {declared} bytes declared")
+
+    try:
+        stored = await receive_files(request, inputs_dir, MAX_TOTAL, ALLOWED_EXTS)
+    except HTTPException as e:
+        logger.warning(f"Upload rejected: {e.detail}")
+        await run_io("delete", cleanup_dir, base)
+        raise
+    if not stored:
+        await run_io("delete", cleanup_dir, base)
+        raise HTTPException(400, "Nessun file caricato")
+    total = sum(f.size_bytes for f in stored)
+
+    # Schema validation + structural comparison with example files, all files in parallel
+    problems = await asyncio.gather(*(run_io("validate", engine.check, f.filename, f.path, f.sha256) for f in stored))
+    for f, problem in zip(stored, problems):
+        if problem is None:
+            continue
+        kind, msg = problem
+        name = f.filename
+        if kind == "schema":
+            logger.warning(f"Upload validation failed for {name}: {msg}")
+            raise HTTPException(400, f"Validazione schema fallita per {name}: {msg}")
+        logger.warning(f"Upload structure mismatch for {name}: {msg}")
+        raise HTTPException(status_code=400, detail={
+            "bad_file": name,
+            "reason": "Verificare il file caricato, la sua struttura differisce da quella prevista",
+            "debug": msg,
+        })
+
+    # identical inputs from other sessions share one blob on disk
+    private = await run_io("fs", blobs.adopt_many, [(f.path, f.sha256) for f in stored])
+    SESSIONS[session_id] = Session(session_id=session_id, created_at=datetime.utcnow(), input_dir=inputs_dir,
+                                   input_hashes={f.filename: f.sha256 for f in stored})
+    reaper.track("session", session_id)
+    quota.charge("inputs", session_id, private, session_id)
+    # start parsing now, while the user fills in the run options; a new upload from the same
+    # browser (X-Client-Id, not the IP: a school's staff often share one) supersedes it
+    await run_io("fs", preparser.start, session_id, inputs_dir, request.headers.get(CLIENT_ID_HEADER) or None)
     logger.info(f"Upload session {session_id} completed: {total} bytes")
-    return {"session_id": session_id, "files": [f.filename for f in files], "total_bytes": total}
+    return {"session_id": session_id, "files": [f.original_name for f in stored], "total_bytes": total}
+
+
+def compute_run_key(input_hashes: dict[str, str], options: dict) -> str:
+    """Identity of a run: entry point, input file contents and canonical (key-sorted) options."""
+    canonical = json.dumps(
+        {"entrypoint": settings.PROGRAM_ENTRYPOINT, "inputs": sorted(input_hashes.items()), "options": options},
+        sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str,
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def _run_response(job: Job, deduplicated: bool) -> dict:
+    resp = {"job_id": job.job_id, "status": job.status, "deduplicated": deduplicated}
+    if job.status == JobStatus.succeeded:
+        resp["results_url"] = f"/results/{job.job_id}"
+        resp["download_all_url"] = f"/download/{job.job_id}/all.zip"
+    return resp
 
 
 @app.post("/run")
 async def run(body: dict):
     session_id = body.get("session_id")
     options = body.get("options", {})
+    priority = body.get("priority") or DEFAULT_PRIORITY
+    force = bool(body.get("force", False))
     if not session_id or session_id not in SESSIONS:
         logger.warning(f"Run rejected: invalid session_id {session_id}")
         raise HTTPException(400, "session_id non valido")
+    if priority not in PRIORITIES:
+        raise HTTPException(400, f"priority non valida: {priority} (ammesse: {', '.join(PRIORITIES)})")
+    variants = body.get("variants")
+    if variants is not None:
+        if (not isinstance(variants, list) or not variants
+                or not all(isinstance(v, dict) and isinstance(v.get("options", {}), dict) for v in variants)):
+            raise HTTPException(400, "variants: attesa una lista non vuota di {nome, options}")
+        if len(variants) > settings.MAX_BATCH_VARIANTS:
+            raise HTTPException(400, f"variants: al massimo {settings.MAX_BATCH_VARIANTS} varianti per run")
+        # one job renders every variant over a single parse of the inputs
+        options = {**options, "variants": variants}
+    expiry.touch("session", session_id)
+    edits = schedules.edits(session_id)
+    if edits:
+        # the run renders the timetable as edited through PATCH /sessions/{id}/schedule
+        options = {**options, "edits": edits}
+    return await _enqueue_run(session_id, options, priority, force)
+
+
+async def _enqueue_run(session_id: str, options: dict, priority: str, force: bool) -> dict:
+    """Deduplicate, admit and enqueue a run of the session's inputs with `options`."""
+    run_key = compute_run_key(SESSIONS[session_id].input_hashes, options)
+    if not force:
+        existing = job_queue.find_duplicate(session_id, run_key)
+        if existing:
+            logger.info(f"Run for session {session_id} served by existing job {existing.job_id}")
+            return _run_response(existing, deduplicated=True)
+    refused = job_queue.admission_error(session_id)
+    if refused:
+        code, detail, retry_after = refused
+        logger.warning(f"Run rejected for session {session_id}: {detail}")
+        raise HTTPException(code, detail, headers={"Retry-After": str(retry_after)})
     job_id = str(uuid.uuid4())
-    workdir = create_job_dir(session_id, job_id)
+    workdir = await run_io("fs", create_job_dir, session_id, job_id)
     log_path = workdir / "job.log"
-    log_path.touch(exist_ok=True)
-    job = Job(job_id=job_id, session_id=session_id, created_at=datetime.utcnow(), options=options, workdir=workdir, log_path=log_path)
-    job_queue.enqueue(job)
+    await run_io("fs", log_path.touch, exist_ok=True)
+    job = Job(job_id=job_id, session_id=session_id, created_at=datetime.utcnow(), options=options,
+              priority=priority, run_key=run_key, workdir=workdir, log_path=log_path)
+    served_by = job_queue.enqueue_unique(job, force=force)
+    if served_by is not job:
+        # an identical request won the race while the job dir was being created
+        await run_io("delete", cleanup_dir, workdir)
+        return _run_response(served_by, deduplicated=True)
     logger.info(f"Job {job_id} enqueued for session {session_id}")
-    return {"job_id": job_id}
+    return _run_response(job, deduplicated=False)
+
+
+async def session_schedule(session_id: str) -> SessionSchedule:
+    """The session's query indexes (see schedule.py), waiting off the event loop for its parse."""
+    session = SESSIONS.get(session_id)
+    if session is None:
+        raise HTTPException(404, "sessione non trovata")
+    expiry.touch("session", session_id)
+    sched = schedules.cached(session_id, session.input_hashes)
+    if sched is None:
+        sched = await run_io("index", schedules.get, session_id, session.input_dir, session.input_hashes)
+    if sched is None:
+        raise HTTPException(503, "Orario non disponibile per questa sessione: lettura dei file non riuscita")
+    return sched
+
+
+async def session_index(session_id: str, name: str):
+    """One index of the session, built on first use."""
+    sched = await session_schedule(session_id)
+    if sched.ready(name):
+        return getattr(sched, name)
+    return await run_io("index", getattr, sched, name)
+
+
+def _unaffected(parsed, affected: dict):
+    """keep(kind, name) for ResponseCache.carry: timetables an edit did not touch."""
+    classes = {k for c in affected["classi"] for k in parsed.class_keys(c)}
+    teachers = {teacher_key(t) for t in affected["docenti"]}
+    rooms = {a.casefold() for a in affected["aule"]}
+
+    def keep(kind: str, name: str) -> bool:
+        if kind == "class":
+            return not set(parsed.class_keys(name)) & classes
+        if kind == "teacher":
+            return teacher_key(name) not in teachers
+        return name not in rooms
+    return keep
+
+
+@app.patch("/sessions/{session_id}/schedule")
+async def edit_schedule(session_id: str, body: dict):
+    """
+    Point edits to the session's timetable (add / remove / move a lesson, see
+    ParsedInputs.apply_edits). Indexes and cached timetables are updated in place;
+    unless render is false, a job re-renders only the touched workbook blocks.
+    """
+    edits = body.get("edits")
+    if not isinstance(edits, list) or not edits or not all(isinstance(e, dict) for e in edits):
+        raise HTTPException(400, "edits: indicare almeno una modifica")
+    priority = body.get("priority") or DEFAULT_PRIORITY
+    if priority not in PRIORITIES:
+        raise HTTPException(400, f"priority non valida: {priority} (ammesse: {', '.join(PRIORITIES)})")
+    sched = await session_schedule(session_id)
+    if not hasattr(sched.parsed, "apply_edits"):
+        raise HTTPException(501, "Il programma configurato non supporta modifiche puntuali")
+    try:
+        old, new, affected = await run_io("index", schedules.edit, session_id, edits)
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+    timetables.carry(old.digest, new.digest, _unaffected(new.parsed, affected))
+    resp = {
+        "edits": len(new.edits),
+        "interessati": {k: affected[k] for k in ("docenti", "classi", "aule", "plessi")},
+        "slots": [{"giorno": g, "ora": o} for g, o in affected["slots"]],
+        "conflicts_url": f"/sessions/{session_id}/conflicts",
+    }
+    if body.get("render", True):
+        only = {k: affected[k] for k in ("classi", "aule", "plessi")}
+        options = {**(body.get("options") or {}), "edits": new.edits, "only": only}
+        resp["job"] = await _enqueue_run(session_id, options, priority, False)
+    return resp
+
+
+def _previous_session(session_id: str) -> str | None:
+    """
+    The latest session uploaded before this one that shares at least one input file
+    (e.g. the same Tabella_Aule): the previous timetable of the same school.
+    """
+    current = SESSIONS[session_id]
+    mine = set(current.input_hashes.values())
+    earlier = [s for s in SESSIONS.values() if s.session_id != session_id and s.created_at <= current.created_at
+               and mine & set(s.input_hashes.values())]
+    return max(earlier, key=lambda s: s.created_at).session_id if earlier else None
+
+
+async def _diff_pair(session_id: str, against: str | None):
+    """(previous schedule, this schedule, previous session id) for the diff endpoints."""
+    if session_id not in SESSIONS:
+        raise HTTPException(404, "sessione non trovata")
+    against = against or _previous_session(session_id)
+    if against is None:
+        raise HTTPException(404, "nessun caricamento precedente con file in comune: indicare against")
+    if against not in SESSIONS:
+        raise HTTPException(404, f"sessione non trovata: {against}")
+    new = await session_schedule(session_id)
+    old = await session_schedule(against)
+    if not hasattr(new.parsed, "diff"):
+        raise HTTPException(501, "Il programma configurato non supporta il confronto tra orari")
+    return old, new, against
+
+
+@app.get("/sessions/{session_id}/diff")
+async def diff(session_id: str, against: str | None = None):
+    """What changed since another session's timetable (by default the previous upload of the same school)."""
+    old, new, against = await _diff_pair(session_id, against)
+    changes = await run_io("index", new.parsed.diff, old.parsed)
+    return {"da": against, "a": session_id, **changes,
+            "workbook_url": f"/sessions/{session_id}/diff.xlsx?against={against}"}
+
+
+@app.get("/sessions/{session_id}/diff.xlsx")
+async def diff_workbook(session_id: str, against: str | None = None):
+    """The same comparison as a workbook: one row per changed lesson, plus the printouts to reissue."""
+    old, new, against = await _diff_pair(session_id, against)
+    body = await run_io("index", new.parsed.diff_workbook, old.parsed)
+    return attachment_response(body, "MODIFICHE_ORARIO.xlsx")
+
+
+@app.get("/sessions/{session_id}/rooms/free")
+async def free_rooms(session_id: str, giorno: str, ora: str, plesso: str | None = None,
+                     min_capienza: int | None = None):
+    """Rooms free for the whole of `ora` ("3" or a range "2-4") on `giorno`, largest first."""
+    index = await session_index(session_id, "rooms")
+    try:
+        day = index.day(giorno)
+        hours = index.hours(ora)
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+    rooms = index.free(day, hours, plesso=plesso, min_capienza=min_capienza)
+    return {"giorno": day, "ore": hours, "plesso": plesso, "min_capienza": min_capienza,
+            "count": len(rooms), "rooms": [r.as_dict() for r in rooms]}
+
+
+@app.get("/sessions/{session_id}/teachers/free")
+async def free_teachers(session_id: str, giorno: str, ora: str, plesso: str | None = None,
+                        sostegno: bool = False, limit: int = 20):
+    """Teachers free for the whole of `ora` on `giorno`, ranked as substitutes (see TeacherIndex.free)."""
+    index = await session_index(session_id, "teachers")
+    try:
+        day = index.day(giorno)
+        hours = index.hours(ora)
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+    candidates = index.free(day, hours, plesso=plesso, sostegno=sostegno)
+    return {"giorno": day, "ore": hours, "plesso": plesso, "count": len(candidates),
+            "candidati": candidates[:max(0, limit)]}
+
+
+@app.post("/sessions/{session_id}/substitutes")
+async def substitutes(session_id: str, body: dict):
+    """Candidates for every lesson of a day's absent teachers, in one call."""
+    index = await session_index(session_id, "teachers")
+    absent = body.get("assenti") or []
+    if not isinstance(absent, list) or not absent:
+        raise HTTPException(400, "assenti: indicare almeno un docente")
+    limit = body.get("limit", 10)
+    if isinstance(limit, bool) or not isinstance(limit, int):
+        raise HTTPException(400, f"limit non valido: {limit!r} (atteso un intero)")
+    try:
+        day = index.day(body.get("giorno") or "")
+        teachers = [index.teacher(name) for name in absent]
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+    cover = index.substitutes(day, teachers, sostegno=bool(body.get("sostegno", False)),
+                              limit=max(0, limit))
+    return {"giorno": day, "assenti": [index.teachers[t] for t in teachers], "coperture": cover}
+
+
+@app.get("/sessions/{session_id}/common-free")
+async def common_free(session_id: str, classe: str | None = None, docenti: str | None = None,
+                      max_assenti: int = 0):
+    """Slots where all teachers of `classe`, or of the comma-separated `docenti`, are free."""
+    index = await session_index(session_id, "teachers")
+    try:
+        if classe:
+            group = index.class_group(classe)
+        elif docenti:
+            group = 0
+            for name in docenti.split(","):
+                if name.strip():
+                    group |= 1 << index.teacher(name)
+        else:
+            raise ValueError("indicare classe oppure docenti")
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+    slots = index.common_free(group, max_assenti)
+    return {"classe": classe, "docenti": index.names(group), "max_assenti": max_assenti,
+            "count": len(slots), "slots": slots}
+
+
+@app.get("/sessions/{session_id}/common-free/classes")
+async def common_free_classes(session_id: str, max_assenti: int = 0):
+    """common-free for every class at once."""
+    index = await session_index(session_id, "teachers")
+    return {"max_assenti": max_assenti, "classi": index.common_free_by_class(max_assenti)}
+
+
+@app.get("/sessions/{session_id}/conflicts")
+async def conflicts(session_id: str):
+    """Timetable inconsistencies found right after parsing, before any job runs."""
+    found = await session_index(session_id, "conflicts")
+    return {"count": len(found), "conflicts": found}
+
+
+# cap on /search results, whatever the client asks
+SEARCH_MAX_RESULTS = 50
+
+
+@app.get("/sessions/{session_id}/search")
+async def search(session_id: str, q: str = "", limit: int = 10):
+    """Teachers, classes and rooms whose name (or a word of it) starts with q; accent-insensitive."""
+    index = await session_index(session_id, "search")
+    results = index.search(q, max(0, min(limit, SEARCH_MAX_RESULTS)))
+    for r in results:
+        r["timetable_url"] = f"/sessions/{session_id}/timetable/{r['tipo']}/{quote(r['nome'])}"
+    return {"q": q, "results": results}
+
+
+# URL kind -> ParsedInputs.timetable kind
+TIMETABLE_KINDS = {"class": "classe", "teacher": "docente", "room": "aula"}
+
+
+@app.get("/sessions/{session_id}/timetable/{kind}/{name}")
+async def timetable(session_id: str, kind: str, name: str, request: Request):
+    """Weekly grid of one class, teacher or room, with the exporters' cell texts. Cached, with ETag."""
+    if kind not in TIMETABLE_KINDS:
+        raise HTTPException(404, f"tipo di orario non valido: {kind} (ammessi: {', '.join(TIMETABLE_KINDS)})")
+    sched = await session_schedule(session_id)
+    key = (sched.digest, kind, name.strip().casefold())
+    cached = timetables.get(key)
+    if cached is None:
+        data = await run_io("index", sched.parsed.timetable, TIMETABLE_KINDS[kind], name)
+        if data is None:
+            what = {"class": "classe non trovata", "teacher": "docente non trovato", "room": "aula non trovata"}[kind]
+            raise HTTPException(404, f"{what}: {name}")
+        body = orjson.dumps(data)
+        cached = (f'"{hashlib.sha256(body).hexdigest()[:32]}"', body)
+        timetables.put(key, *cached)
+    etag, body = cached
+    return json_response(request, body, etag=etag, cache_control="private, no-cache")
 
 
 @app.get("/status/{job_id}")
@@ -159,21 +550,27 @@ async def status(job_id: str):
     job = job_queue.get(job_id)
     if not job:
         raise HTTPException(404, "job non trovato")
+    ahead = job_queue.jobs_ahead(job_id)
     return {
         "status": job.status,
         "progress": job.progress,
         "message": job.message,
         "started_at": job.started_at,
         "finished_at": job.finished_at,
+        "queue_position": ahead + 1 if ahead is not None else None,
+        "jobs_ahead": ahead,
+        "pinned": job.pinned,
     }
 
 
 @app.get("/logs/{job_id}", response_class=PlainTextResponse)
-async def logs(job_id: str):
+async def logs(job_id: str, offset: int = 0):
+    """Log bytes appended after `offset`; the next offset is in the X-Log-Offset header."""
     job = job_queue.get(job_id)
     if not job or not job.log_path:
         raise HTTPException(404, "job non trovato")
-    return Path(job.log_path).read_text(encoding="utf-8")
+    data, new_offset = await run_io("fs", job_logs.read, job_id, job.log_path, offset)
+    return PlainTextResponse(data.decode("utf-8", errors="replace"), headers={"X-Log-Offset": str(new_offset)})
 
 
 @app.get("/results/{job_id}")
@@ -181,34 +578,91 @@ async def results(job_id: str):
     job = job_queue.get(job_id)
     if not job or not job.workdir:
         raise HTTPException(404, "job non trovato")
-    files = [f for f in list_files(job.workdir) if not (f["filename"].endswith("_OK.txt") or f["filename"] == "job.log")]
+    if job.manifest is not None:
+        files = [dict(f) for f in job.manifest]
+    else:
+        # job still running or not successful: whatever it has produced so far
+        listing = await run_io("fs", list_files, job.workdir)
+        files = [f for f in listing if is_result_file(f["filename"])]
     for f in files:
         f["download_url"] = f"/download/{job_id}/{f['filename']}"
     return files
 
 
 @app.get("/download/{job_id}/all.zip")
-async def download_all(job_id: str):
+async def download_all(job_id: str, request: Request):
     job = job_queue.get(job_id)
     if not job or not job.workdir:
         raise HTTPException(404, "job non trovato")
-    zip_path = job.workdir / "all.zip"
-    zip_directory(job.workdir, zip_path)
-    return FileResponse(zip_path, filename=f"results_{job_id}.zip")
+    if job.status in (JobStatus.queued, JobStatus.running):
+        raise HTTPException(409, "job non ancora terminato")
+    zip_path, etag = await run_io("zip", archives.ensure, job)
+    st = await run_io("fs", zip_path.stat)
+    # with a manifest, Last-Modified is the newest output, not the (re)build time of the zip
+    mtime = max((datetime.fromisoformat(f["generated_at"]).timestamp() for f in job.manifest or ()),
+                default=st.st_mtime)
+    return file_response(request, zip_path, filename=f"results_{job_id}.zip", etag=etag,
+                         size=st.st_size, mtime=mtime, cache_control="no-cache")
+
+
+def _resolve_download(workdir: Path, filename: str) -> tuple[Path, bool, os.stat_result | None]:
+    target = (workdir / filename).resolve()
+    inside = str(target).startswith(str(workdir.resolve()))
+    return target, inside, target.stat() if inside and target.is_file() else None
 
 
 @app.get("/download/{job_id}/{filename:path}")
-async def download_file(job_id: str, filename: str):
+async def download_file(job_id: str, filename: str, request: Request):
     job = job_queue.get(job_id)
     if not job or not job.workdir:
         raise HTTPException(404, "job non trovato")
-    target = (job.workdir / filename).resolve()
+    entry = next((f for f in job.manifest or () if f["filename"] == filename), None)
+    if entry is not None:
+        # finished output: content never changes for this job id
+        ttl = settings.JOB_TTL_MINUTES * 60
+        return file_response(request, job.workdir / filename, filename=Path(filename).name,
+                             etag=f'"{entry["sha256"]}"', size=entry["size_bytes"],
+                             mtime=datetime.fromisoformat(entry["generated_at"]).timestamp(),
+                             cache_control=f"public, max-age={ttl}, immutable")
+    target, inside, st = await run_io("fs", _resolve_download, job.workdir, filename)
     # prevent path traversal
-    if not str(target).startswith(str(job.workdir.resolve())):
+    if not inside:
         raise HTTPException(400, "path non valido")
-    if not target.exists() or not target.is_file():
+    if st is None:
         raise HTTPException(404, "file non trovato")
-    return FileResponse(target, filename=target.name)
+    return file_response(request, target, filename=target.name, etag=f'W/"{st.st_mtime_ns:x}-{st.st_size:x}"',
+                         size=st.st_size, mtime=st.st_mtime, cache_control="no-cache")
+
+
+@app.post("/jobs/{job_id}/cancel")
+async def cancel_job(job_id: str):
+    job = job_queue.get(job_id)
+    if not job:
+        raise HTTPException(404, "job non trovato")
+    if job.status not in (JobStatus.queued, JobStatus.running):
+        raise HTTPException(409, f"job già terminato ({job.status.value})")
+    job_queue.cancel(job_id)
+    logger.info(f"Job {job_id} cancellation requested")
+    return {"cancelled": True, "status": job.status}
+
+
+@app.post("/jobs/{job_id}/pin")
+async def pin_job(job_id: str):
+    """Protect a job's outputs from eviction when the storage budget is exceeded."""
+    job = job_queue.get(job_id)
+    if not job:
+        raise HTTPException(404, "job non trovato")
+    job.pinned = True
+    return {"pinned": True}
+
+
+@app.delete("/jobs/{job_id}/pin")
+async def unpin_job(job_id: str):
+    job = job_queue.get(job_id)
+    if not job:
+        raise HTTPException(404, "job non trovato")
+    job.pinned = False
+    return {"pinned": False}
 
 
 @app.delete("/jobs/{job_id}")
@@ -216,9 +670,11 @@ async def delete_job(job_id: str):
     job = job_queue.get(job_id)
     if not job or not job.workdir:
         raise HTTPException(404, "job non trovato")
-    cleanup_dir(job.workdir)
-    job.message = "Eliminato"
-    job.status = JobStatus.succeeded
+    job_queue.cancel(job_id, reason="Eliminato")
+    if job_queue.delete_when_stopped(job_id):
+        # still running until its next stage check: the worker deletes the dir once it stops
+        return {"deleted": True, "deferred": True}
+    await run_io("delete", job_queue.delete_outputs, job)
     return {"deleted": True}
 
 
@@ -1,4 +1,5 @@
 from __future__ import annotations
+import threading
 from dataclasses import dataclass, field
 from enum import Enum
 from datetime import datetime
@@ -10,6 +11,7 @@ class JobStatus(str, Enum):
     running = "running"
     succeeded = "succeeded"
     failed = "failed"
+    cancelled = "cancelled"
 
 @dataclass
 class Job:
@@ -22,11 +24,21 @@ class Job:
     progress: int = 0
     message: str = ""
     options: dict = field(default_factory=dict)
+    priority: str = "interactive"
+    run_key: str = ""  # hash of session inputs + options, for deduplication
+    pinned: bool = False  # never evicted to free disk space
     workdir: Path | None = None
     log_path: Path | None = None
+    # set by cancel or timeout; checked by the adapter and the entry point
+    cancel_event: threading.Event = field(default_factory=threading.Event, repr=False)
+    cancel_reason: str = ""
+    delete_on_stop: bool = False  # DELETE while running: the worker deletes the outputs once the job stops
+    archive_etag: str | None = None  # set once all.zip has been built
+    manifest: list[dict] | None = None  # result files, written when the job succeeds
 
 @dataclass
 class Session:
     session_id: str
     created_at: datetime
     input_dir: Path
+    input_hashes: dict[str, str] = field(default_factory=dict)  # filename -> sha256
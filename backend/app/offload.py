@@ -0,0 +1,39 @@
+"""
+Blocking filesystem work for the async API handlers.
+
+Everything runs on the shared worker-thread pool, but each kind of operation
+has its own CapacityLimiter: a long zip build or rmtree can only occupy its
+own slots, so small reads (and /health, which does no I/O) stay responsive.
+"""
+from __future__ import annotations
+import functools
+from typing import Any, Callable
+
+import anyio
+import anyio.to_thread
+
+from .config import settings
+
+# operation kind -> max concurrent threads
+IO_LIMITS = {
+    "fs": settings.IO_CONCURRENCY_FS,          # stat, listing, small reads/writes
+    "validate": settings.IO_CONCURRENCY_VALIDATE,  # openpyxl header reads
+    "zip": settings.IO_CONCURRENCY_ZIP,        # archive builds
+    "delete": settings.IO_CONCURRENCY_DELETE,  # rmtree
+    "index": settings.IO_CONCURRENCY_INDEX,    # waiting for a parse, building query indexes
+}
+
+_limiters: dict[str, anyio.CapacityLimiter] = {}
+
+
+def _limiter(kind: str) -> anyio.CapacityLimiter:
+    # created lazily: a CapacityLimiter needs the running event loop
+    lim = _limiters.get(kind)
+    if lim is None:
+        lim = _limiters[kind] = anyio.CapacityLimiter(max(1, IO_LIMITS[kind]))
+    return lim
+
+
+async def run_io(kind: str, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+    """Run fn(*args, **kwargs) in a worker thread under the `kind` concurrency limit."""
+    return await anyio.to_thread.run_sync(functools.partial(fn, *args, **kwargs), limiter=_limiter(kind))
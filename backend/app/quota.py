@@ -0,0 +1,116 @@
+"""
+Storage accounting and budget enforcement under OUTPUT_DIR_BASE.
+
+Sizes are charged when data is written (upload, job end, archive build) and
+released when it is deleted, so the total is always known without walking the
+data volume. When the total exceeds STORAGE_BUDGET_MB, finished jobs are
+evicted least-recently-accessed first: their rebuildable archives before any
+job, then the jobs themselves. Running and pinned jobs are never candidates;
+session inputs only go away when the session expires.
+"""
+from __future__ import annotations
+import threading
+from collections import OrderedDict
+from typing import Callable
+
+from .config import settings
+from .logging_config import logger
+
+# eviction order: caches first, then finished jobs
+EVICTION_ORDER = ("archive", "job")
+# the owner blobs are charged to: they belong to no single session
+BLOB_OWNER = "blobs"
+
+
+class StorageQuota:
+    def __init__(self, budget_bytes: int):
+        self.budget = budget_bytes  # <= 0: account only, never evict
+        self.used = 0
+        self._charges: dict[tuple[str, str], tuple[int, str]] = {}  # (kind, key) -> (bytes, session_id)
+        self._by_session: dict[str, int] = {}
+        self._lru: OrderedDict[str, None] = OrderedDict()  # finished job ids, least recently used first
+        self._evictors: dict[str, Callable[[str], bool]] = {}
+        self._lock = threading.Lock()
+
+    def register_evictor(self, kind: str, fn: Callable[[str], bool]) -> None:
+        """fn(job_id) deletes that kind of data for the job and returns False if it may not."""
+        self._evictors[kind] = fn
+
+    def charge(self, kind: str, key: str, nbytes: int, session_id: str) -> None:
+        """Record the current size of an item (replacing any previous charge for it)."""
+        with self._lock:
+            self._release(kind, key)
+            self._charges[(kind, key)] = (nbytes, session_id)
+            self.used += nbytes
+            self._by_session[session_id] = self._by_session.get(session_id, 0) + nbytes
+
+    def release(self, kind: str, key: str) -> None:
+        with self._lock:
+            self._release(kind, key)
+
+    def _release(self, kind: str, key: str) -> None:
+        old = self._charges.pop((kind, key), None)
+        if old is None:
+            return
+        nbytes, session_id = old
+        self.used -= nbytes
+        left = self._by_session.get(session_id, 0) - nbytes
+        if left > 0:
+            self._by_session[session_id] = left
+        else:
+            self._by_session.pop(session_id, None)
+
+    def release_job(self, job_id: str) -> None:
+        with self._lock:
+            for kind in EVICTION_ORDER:
+                self._release(kind, job_id)
+            self._lru.pop(job_id, None)
+
+    def finished(self, job_id: str) -> None:
+        """The job became an eviction candidate."""
+        with self._lock:
+            self._lru[job_id] = None
+
+    def touch(self, job_id: str) -> None:
+        with self._lock:
+            if job_id in self._lru:
+                self._lru.move_to_end(job_id)
+
+    def session_bytes(self, session_id: str) -> int:
+        with self._lock:
+            return self._by_session.get(session_id, 0)
+
+    def usage(self) -> dict:
+        with self._lock:
+            return {
+                "used_bytes": self.used,
+                "budget_bytes": self.budget if self.budget > 0 else None,
+                "sessions": len(self._by_session) - (BLOB_OWNER in self._by_session),
+                "jobs": sum(1 for kind, _ in self._charges if kind == "job"),
+            }
+
+    def enforce(self, extra: int = 0) -> bool:
+        """
+        Evict until `extra` more bytes fit in the budget. Blocking (deletes files).
+        Returns False if that is not possible with what may be evicted.
+        """
+        if self.budget <= 0:
+            return True
+        for kind in EVICTION_ORDER:
+            with self._lock:
+                if self.used + extra <= self.budget:
+                    return True
+                candidates = [jid for jid in self._lru if (kind, jid) in self._charges]
+            for job_id in candidates:
+                with self._lock:
+                    if self.used + extra <= self.budget:
+                        return True
+                    if (kind, job_id) not in self._charges:
+                        continue
+                if self._evictors[kind](job_id):
+                    logger.info(f"Storage budget: evicted {kind} of job {job_id}")
+        with self._lock:
+            return self.used + extra <= self.budget
+
+
+quota = StorageQuota(settings.STORAGE_BUDGET_MB * 1024 * 1024)
@@ -0,0 +1,568 @@
+"""
+Query indexes over a session's timetable, for instant answers without a job.
+
+They are built from the entry point's parse result (the one the speculative
+parser starts at upload, see speculative.py), once per session and input
+content, and kept until the session expires:
+
+- RoomIndex: for every (giorno, ora) slot, a bitmask of the free rooms. A
+  query over several hours is the AND of their masks, further ANDed with a
+  per-plesso mask and a minimum-capacity mask (rooms are ordered by capacity,
+  so "capienza >= n" is a prefix of the bits).
+- TeacherIndex: the teacher x slot matrix as bitsets both ways, a slot mask
+  per teacher and a teacher mask per slot, so "who is free at this hour" is
+  one AND-NOT and ranking a candidate only looks at its neighbouring bits.
+  The hours where a whole group (e.g. a class's teachers) is free are the
+  complement of the OR of their slot masks.
+- SearchIndex: a sorted array of accent-folded name terms (every word of
+  each name too); a prefix query is a bisect plus a short forward scan.
+
+Rendered per-entity timetables (ParsedInputs.timetable) are kept in a
+size-bounded LRU of serialized responses, keyed by input digest, so sessions
+with the same inputs share them.
+
+Point edits (ParsedInputs.apply_edits, PATCH /sessions/{id}/schedule) give the
+session a new schedule whose built indexes are updated, not rebuilt: room
+masks of the touched slots, the touched teachers' rows, conflicts of the
+touched slots. Cached timetables of untouched entities are carried over to the
+new digest.
+
+The parse result must offer the PARSED_VIEWS (see ParsedInputs in
+mio_runner.py); room occupancy follows the same rules as the
+ORARIO_AULE_LIBERE exports, so the API and the workbooks agree.
+"""
+from __future__ import annotations
+import bisect
+import copy
+import hashlib
+import json
+import threading
+import unicodedata
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable
+
+from .config import settings
+from .logging_config import logger
+from .speculative import preparser
+
+# what the indexes read from the entry point's parse result
+PARSED_VIEWS = ("giorni", "ore", "rooms", "room_occupancy", "lessons", "classes", "class_keys", "timetable",
+                "search_terms", "conflicts")
+
+
+def day_key(name: str) -> str:
+    """Case- and accent-insensitive form of a day name ("Giovedì" -> "giovedi")."""
+    s = unicodedata.normalize("NFKD", str(name).strip())
+    return "".join(c for c in s if not unicodedata.combining(c)).casefold()
+
+
+def inputs_digest(input_hashes: dict[str, str]) -> str:
+    """One hash for a session's whole input set: indexes are rebuilt when it changes."""
+    return hashlib.sha256(repr(sorted(input_hashes.items())).encode()).hexdigest()
+
+
+def edits_digest(inputs: str, edits: list[dict]) -> str:
+    """The digest of the inputs with point edits applied (the inputs' own digest if there are none)."""
+    if not edits:
+        return inputs
+    canonical = json.dumps(edits, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(f"{inputs}\n{canonical}".encode()).hexdigest()
+
+
+@dataclass(frozen=True)
+class Room:
+    aula: str
+    plesso: str
+    capienza: int | None
+
+    def as_dict(self) -> dict:
+        return {"aula": self.aula, "plesso": self.plesso, "capienza": self.capienza}
+
+
+def _bits(mask: int):
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+class SlotGrid:
+    """The timetable's days and hours, and the parsing of the day/hour query parameters."""
+
+    def __init__(self, giorni: list, ore: list):
+        self.giorni = [str(g) for g in giorni]
+        self.ore = [str(o) for o in ore]
+        self._days = {day_key(g): g for g in self.giorni}
+
+    def day(self, giorno: str) -> str:
+        """The timetable's name for a day, given any case/accents or an unambiguous prefix ("gio")."""
+        key = day_key(giorno)
+        if key in self._days:
+            return self._days[key]
+        matches = [g for k, g in self._days.items() if len(key) >= 3 and k.startswith(key)]
+        if len(matches) != 1:
+            raise ValueError(f"giorno non valido: {giorno} (ammessi: {', '.join(self.giorni)})")
+        return matches[0]
+
+    def hours(self, spec: str) -> list[str]:
+        """"3" -> ["3"], "2-4" -> ["2", "3", "4"]; hours as in the timetable."""
+        lo, sep, hi = str(spec).replace(" ", "").partition("-")
+        hi = hi if sep else lo
+        if lo not in self.ore or hi not in self.ore or self.ore.index(lo) > self.ore.index(hi):
+            raise ValueError(f"ora non valida: {spec} (ammesse: {self.ore[0]}-{self.ore[-1]})")
+        return self.ore[self.ore.index(lo):self.ore.index(hi) + 1]
+
+
+class RoomIndex(SlotGrid):
+    def __init__(self, rooms: list[tuple[str, str, int | None]], occupancy, giorni: list, ore: list):
+        super().__init__(giorni, ore)
+        # largest rooms first, rooms without a capacity last
+        self.rooms = sorted((Room(*r) for r in rooms),
+                            key=lambda r: (r.capienza is None, -(r.capienza or 0), r.aula))
+        bit = {r.aula: i for i, r in enumerate(self.rooms)}
+        all_rooms = (1 << len(self.rooms)) - 1
+
+        self._free = {(g, o): all_rooms for g in self.giorni for o in self.ore}
+        for plesso, aula, giorno, ora in occupancy:
+            i = bit.get(aula)
+            if i is None or (giorno, ora) not in self._free:
+                continue  # not a room of Tabella_Aule, or outside the timetable grid
+            if self.rooms[i].plesso.lower() == plesso.lower():
+                self._free[(giorno, ora)] &= ~(1 << i)
+
+        self._plesso: dict[str, int] = {}
+        for i, r in enumerate(self.rooms):
+            self._plesso[r.plesso.lower()] = self._plesso.get(r.plesso.lower(), 0) | (1 << i)
+        # negated capacities, ascending, for bisect
+        self._neg_caps = [-r.capienza for r in self.rooms if r.capienza is not None]
+
+    def updated(self, occupancy, slots: set[tuple[str, str]]) -> "RoomIndex":
+        """A copy with the free masks of `slots` recomputed from the new occupancy."""
+        index = copy.copy(self)
+        index._free = dict(self._free)
+        bit = {r.aula: i for i, r in enumerate(self.rooms)}
+        all_rooms = (1 << len(self.rooms)) - 1
+        for s in slots:
+            if s in index._free:
+                index._free[s] = all_rooms
+        for plesso, aula, giorno, ora in occupancy:
+            i = bit.get(aula)
+            if i is not None and (giorno, ora) in slots and (giorno, ora) in index._free \
+                    and self.rooms[i].plesso.lower() == plesso.lower():
+                index._free[(giorno, ora)] &= ~(1 << i)
+        return index
+
+    def free(self, giorno: str, ore: list[str], plesso: str | None = None,
+             min_capienza: int | None = None) -> list[Room]:
+        """Rooms free in every one of the given hours of the day, largest first."""
+        mask = (1 << len(self.rooms)) - 1
+        for o in ore:
+            mask &= self._free[(giorno, o)]
+        if plesso:
+            mask &= self._plesso.get(plesso.lower(), 0)
+        if min_capienza is not None:
+            mask &= (1 << bisect.bisect_right(self._neg_caps, -min_capienza)) - 1
+        return [self.rooms[i] for i in _bits(mask)]
+
+
+@dataclass(frozen=True)
+class Lesson:
+    docente: str
+    plesso: str
+    classe: str
+    aula: str
+    giorno: str
+    ora: str
+    sostegno: bool
+
+    def as_dict(self) -> dict:
+        return {"docente": self.docente, "plesso": self.plesso, "classe": self.classe, "aula": self.aula,
+                "giorno": self.giorno, "ora": self.ora, "sostegno": self.sostegno}
+
+
+def teacher_key(name: str) -> str:
+    return " ".join(str(name).split()).casefold()
+
+
+class TeacherIndex(SlotGrid):
+    def __init__(self, lessons, giorni: list, ore: list, classes: list[str],
+                 class_keys: Callable[[str], list[str]]):
+        super().__init__(giorni, ore)
+        lessons = [Lesson(*row) for row in lessons]
+        self.teachers = sorted({l.docente for l in lessons})
+        self._teacher = {teacher_key(t): i for i, t in enumerate(self.teachers)}
+        # slot s = day index * hours per day + hour index
+        self._slot = {(g, o): d * len(self.ore) + h
+                      for d, g in enumerate(self.giorni) for h, o in enumerate(self.ore)}
+        n_slots = len(self._slot)
+
+        self.busy = [0] * len(self.teachers)       # per teacher: slots with a lesson
+        self.by_slot = [0] * n_slots               # per slot: teachers with a lesson
+        self._sostegno_only = [0] * n_slots        # per slot: teachers whose lessons there are all sostegno
+        self._lessons: dict[tuple[int, int], list[Lesson]] = {}
+        # class key -> teachers with a lesson there (sostegno included: they sit on the council too)
+        self._class_key = class_keys
+        self._class_teachers: dict[str, int] = {}
+        self._add_lessons(lessons)
+        self._day_mask = {g: ((1 << len(self.ore)) - 1) << (d * len(self.ore)) for d, g in enumerate(self.giorni)}
+        self._slots = list(self._slot)  # slot number -> (giorno, ora)
+        self.classes = list(classes)
+
+    def _add_lessons(self, lessons: list[Lesson]) -> None:
+        touched = set()
+        for l in lessons:
+            t = self._teacher[teacher_key(l.docente)]
+            for key in self._class_key(l.classe):
+                self._class_teachers[key] = self._class_teachers.get(key, 0) | (1 << t)
+            s = self._slot.get((l.giorno, l.ora))
+            if s is None:
+                continue
+            self.busy[t] |= 1 << s
+            self.by_slot[s] |= 1 << t
+            self._lessons.setdefault((t, s), []).append(l)
+            touched.add((t, s))
+        for t, s in touched:
+            if all(l.sostegno for l in self._lessons[(t, s)]):
+                self._sostegno_only[s] |= 1 << t
+
+    def updated(self, lessons, teachers: list[str]) -> "TeacherIndex | None":
+        """
+        A copy with the rows of `teachers` rebuilt from the new lessons. None if the
+        set of teachers changed (bit positions would move): build a new index then.
+        """
+        lessons = [Lesson(*row) for row in lessons]
+        names = {teacher_key(n) for n in teachers}
+        mine = [l for l in lessons if teacher_key(l.docente) in names]
+        if any(n not in self._teacher for n in names) or {teacher_key(l.docente) for l in mine} != names:
+            return None
+        index = copy.copy(self)
+        index.busy, index.by_slot = list(self.busy), list(self.by_slot)
+        index._sostegno_only = list(self._sostegno_only)
+        index._lessons = dict(self._lessons)
+        index._class_teachers = dict(self._class_teachers)
+        clear = 0
+        for n in names:
+            t = self._teacher[n]
+            clear |= 1 << t
+            for s in _bits(self.busy[t]):
+                del index._lessons[(t, s)]
+            index.busy[t] = 0
+        index.by_slot = [m & ~clear for m in index.by_slot]
+        index._sostegno_only = [m & ~clear for m in index._sostegno_only]
+        index._class_teachers = {k: m & ~clear for k, m in index._class_teachers.items() if m & ~clear}
+        index._add_lessons(mine)
+        return index
+
+    def teacher(self, name: str) -> int:
+        t = self._teacher.get(teacher_key(name))
+        if t is None:
+            raise ValueError(f"docente non trovato: {name}")
+        return t
+
+    def class_group(self, classe: str) -> int:
+        """Mask of the teachers of a class, matched as the exports match class names."""
+        keys = self._class_key(classe)
+        group = self._class_teachers.get(keys[0], 0) if len(keys) == 1 else 0
+        if not group:
+            raise ValueError(f"classe non trovata: {classe}")
+        return group
+
+    def names(self, group: int) -> list[str]:
+        return [self.teachers[t] for t in _bits(group)]
+
+    def common_free(self, group: int, max_absent: int = 0) -> list[dict]:
+        """Slots where every teacher of `group` is free, or all but at most max_absent of them."""
+        if max_absent <= 0:
+            busy = 0
+            for t in _bits(group):
+                busy |= self.busy[t]
+            free = ((1 << len(self._slots)) - 1) & ~busy
+            return [{"giorno": self._slots[s][0], "ora": self._slots[s][1], "assenti": []} for s in _bits(free)]
+        out = []
+        for s, (giorno, ora) in enumerate(self._slots):
+            absent = group & self.by_slot[s]
+            if absent.bit_count() <= max_absent:
+                out.append({"giorno": giorno, "ora": ora, "assenti": self.names(absent)})
+        return out
+
+    def common_free_by_class(self, max_absent: int = 0) -> list[dict]:
+        """common_free for the teachers of every class of Tabella_Classi."""
+        out = []
+        for classe in self.classes:
+            try:
+                group = self.class_group(classe)
+            except ValueError:
+                continue  # a class without lessons
+            out.append({"classe": classe, "docenti": group.bit_count(), "slots": self.common_free(group, max_absent)})
+        return out
+
+    def lessons_of(self, t: int, giorno: str) -> list[Lesson]:
+        """The teacher's lessons on a day, in hour order."""
+        base = self.giorni.index(giorno) * len(self.ore)
+        return [l for h in range(len(self.ore)) for l in self._lessons.get((t, base + h), ())]
+
+    def _plesso_at(self, t: int, s: int) -> str | None:
+        ls = self._lessons.get((t, s))
+        return ls[0].plesso if ls else None
+
+    def free(self, giorno: str, ore: list[str], plesso: str | None = None, sostegno: bool = False,
+             exclude: int = 0) -> list[dict]:
+        """
+        Teachers free for all of `ore` on `giorno`, best substitutes first:
+        those already in `plesso` (or at school, if no plesso is given) in the
+        hours just before and after, then those with lessons that day, fewest first.
+        With sostegno=True, teachers busy only with sostegno are listed too, after the others.
+        """
+        slots = [self._slot[(giorno, o)] for o in ore]
+        everyone = (1 << len(self.teachers)) - 1
+        free = sostegno_ok = everyone & ~exclude
+        for s in slots:
+            free &= ~self.by_slot[s]
+            sostegno_ok &= ~self.by_slot[s] | self._sostegno_only[s]
+        candidates = free | sostegno_ok if sostegno else free
+
+        first, last = self.ore.index(ore[0]), self.ore.index(ore[-1])
+        base = self.giorni.index(giorno) * len(self.ore)
+        adjacent = [base + h for h in (first - 1, last + 1) if 0 <= h < len(self.ore)]
+        day_mask = self._day_mask[giorno]
+        ranked = []
+        for t in _bits(candidates):
+            near = [self._plesso_at(t, s) for s in adjacent]
+            near = [p for p in near if p]
+            same = sum(1 for p in near if plesso is None or p.lower() == plesso.lower())
+            moves = len(near) - same
+            n_day = (self.busy[t] & day_mask).bit_count()
+            from_sostegno = not (free >> t) & 1
+            key = (from_sostegno, -same, moves > 0, n_day == 0, n_day, self.teachers[t])
+            ranked.append((key, {
+                "docente": self.teachers[t], "continuita": same, "cambio_plesso": moves > 0,
+                "ore_nel_giorno": n_day, "da_sostegno": from_sostegno,
+            }))
+        ranked.sort(key=lambda kv: kv[0])
+        return [c for _key, c in ranked]
+
+    def substitutes(self, giorno: str, absent: list[int], sostegno: bool = False, limit: int = 10) -> list[dict]:
+        """For every lesson of the absent teachers on `giorno`: the lesson and its ranked candidates."""
+        exclude = 0
+        for t in absent:
+            exclude |= 1 << t
+        cover = []
+        for t in absent:
+            for l in self.lessons_of(t, giorno):
+                candidates = self.free(giorno, [l.ora], plesso=l.plesso or None, sostegno=sostegno,
+                                       exclude=exclude)
+                cover.append({"lezione": l.as_dict(), "candidati": candidates[:limit]})
+        cover.sort(key=lambda c: (self.ore.index(c["lezione"]["ora"]), c["lezione"]["docente"]))
+        return cover
+
+
+class SearchIndex:
+    def __init__(self, entries):
+        self.entities: list[tuple[str, str]] = []  # (kind, name)
+        terms = set()
+        for kind, name, names in entries:
+            e = len(self.entities)
+            self.entities.append((kind, name))
+            for term in names:
+                folded = day_key(term)
+                words = folded.split()
+                # the whole term and every word of it, so "simone" finds "DE SIMONE R."
+                for i in range(len(words)):
+                    terms.add((" ".join(words[i:]), e))
+        self._terms = sorted(terms)
+
+    def search(self, q: str, limit: int = 10) -> list[dict]:
+        """
+        Entities with a name term starting with q, at most `limit`. Terms are
+        scanned in sorted order, so an exact match comes before longer names.
+        """
+        q = " ".join(day_key(q).split())
+        found: list[int] = []
+        i = bisect.bisect_left(self._terms, (q, -1))
+        while q and i < len(self._terms) and len(found) < limit:
+            term, e = self._terms[i]
+            if not term.startswith(q):
+                break
+            if e not in found:
+                found.append(e)
+            i += 1
+        return [{"tipo": self.entities[e][0], "nome": self.entities[e][1]} for e in found]
+
+
+@dataclass
+class SessionSchedule:
+    """The indexes of one session, built on first use."""
+    inputs: str                      # inputs_digest of the session's files
+    parsed: object
+    edits: list[dict] = field(default_factory=list)  # point edits applied to `parsed`, oldest first
+    _rooms: RoomIndex | None = None
+    _teachers: TeacherIndex | None = None
+    _search: SearchIndex | None = None
+    _conflicts: list[dict] | None = None
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+    digest: str = field(init=False, default="")
+
+    def __post_init__(self):
+        # identity of the timetable content: inputs plus edits (cache key of rendered timetables)
+        self.digest = edits_digest(self.inputs, self.edits)
+
+    def ready(self, name: str) -> bool:
+        """Whether index `name` is already built (reading it will not block)."""
+        return getattr(self, "_" + name) is not None
+
+    @property
+    def rooms(self) -> RoomIndex:
+        with self._lock:
+            if self._rooms is None:
+                p = self.parsed
+                self._rooms = RoomIndex(p.rooms(), p.room_occupancy(), p.giorni, p.ore)
+            return self._rooms
+
+    @property
+    def teachers(self) -> TeacherIndex:
+        with self._lock:
+            if self._teachers is None:
+                p = self.parsed
+                self._teachers = TeacherIndex(p.lessons(), p.giorni, p.ore, p.classes(), p.class_keys)
+            return self._teachers
+
+    @property
+    def search(self) -> SearchIndex:
+        with self._lock:
+            if self._search is None:
+                self._search = SearchIndex(self.parsed.search_terms())
+            return self._search
+
+    @property
+    def conflicts(self) -> list[dict]:
+        with self._lock:
+            if self._conflicts is None:
+                self._conflicts = self.parsed.conflicts()
+            return self._conflicts
+
+    def apply(self, edits: list[dict]) -> tuple["SessionSchedule", dict]:
+        """
+        The schedule with `edits` applied on top, and what they touched (see
+        ParsedInputs.apply_edits). Indexes already built are updated for the
+        touched slots and teachers only; the others stay lazy. Raises ValueError.
+        """
+        parsed, affected = self.parsed.apply_edits(edits)
+        new = SessionSchedule(self.inputs, parsed, [*self.edits, *edits])
+        slots = {tuple(s) for s in affected["slots"]}
+        with self._lock:
+            if self._rooms is not None:
+                new._rooms = self._rooms.updated(parsed.room_occupancy(), slots)
+            if self._teachers is not None:
+                new._teachers = self._teachers.updated(parsed.lessons(), affected["docenti"])
+            if self._search is not None and not affected["nomi"]:
+                new._search = self._search
+            if self._conflicts is not None:
+                kept = [c for c in self._conflicts if (c["giorno"], c["ora"]) not in slots]
+                order = {(g, o): i for i, (g, o) in enumerate((str(g), str(o)) for g in parsed.giorni for o in parsed.ore)}
+                new._conflicts = sorted(kept + parsed.conflicts(slots),
+                                        key=lambda c: (order.get((c["giorno"], c["ora"]), len(order)), c["tipo"], c["nome"]))
+        return new, affected
+
+
+class ScheduleRegistry:
+    def __init__(self):
+        self._schedules: dict[str, SessionSchedule] = {}
+        self._lock = threading.Lock()
+        self._edit_lock = threading.Lock()
+
+    def cached(self, session_id: str, input_hashes: dict[str, str]) -> SessionSchedule | None:
+        """The session's schedule if already loaded for these inputs. Non-blocking."""
+        with self._lock:
+            sched = self._schedules.get(session_id)
+        if sched is not None and sched.inputs == inputs_digest(input_hashes):
+            return sched
+        return None
+
+    def edits(self, session_id: str) -> list[dict]:
+        """The point edits applied to the session's schedule so far. Non-blocking."""
+        with self._lock:
+            sched = self._schedules.get(session_id)
+        return list(sched.edits) if sched is not None else []
+
+    def get(self, session_id: str, inputs_dir: Path, input_hashes: dict[str, str]) -> SessionSchedule | None:
+        """
+        The session's schedule, waiting for (or starting) the parse of its inputs.
+        None if the entry point offers no parse result or parsing failed. Blocking.
+        """
+        sched = self.cached(session_id, input_hashes)
+        if sched is not None:
+            return sched
+        parsed = preparser.parsed(session_id, inputs_dir)
+        if parsed is None or not all(hasattr(parsed, name) for name in PARSED_VIEWS):
+            return None
+        sched = SessionSchedule(inputs_digest(input_hashes), parsed)
+        with self._lock:
+            self._schedules[session_id] = sched
+        logger.info(f"Schedule of session {session_id} loaded")
+        return sched
+
+    def edit(self, session_id: str, edits: list[dict]) -> tuple[SessionSchedule, SessionSchedule, dict]:
+        """
+        Apply point edits to the session's loaded schedule: (previous, new, affected).
+        Edits of one session are applied one batch at a time. Raises KeyError if the
+        schedule is not loaded, ValueError if an edit is invalid. Blocking.
+        """
+        with self._edit_lock:
+            with self._lock:
+                old = self._schedules[session_id]
+            new, affected = old.apply(edits)
+            with self._lock:
+                self._schedules[session_id] = new
+        logger.info(f"Schedule of session {session_id}: {len(edits)} edits applied ({len(new.edits)} in total)")
+        return old, new, affected
+
+    def discard(self, session_id: str) -> None:
+        with self._lock:
+            self._schedules.pop(session_id, None)
+
+
+class ResponseCache:
+    """Serialized responses with their ETag; least recently used dropped beyond max_bytes."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._items: OrderedDict[tuple, tuple[str, bytes]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple) -> tuple[str, bytes] | None:
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                self._items.move_to_end(key)
+            return item
+
+    def put(self, key: tuple, etag: str, body: bytes) -> None:
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.size -= len(old[1])
+            self._items[key] = (etag, body)
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                _key, (_etag, dropped) = self._items.popitem(last=False)
+                self.size -= len(dropped)
+
+    def carry(self, old: str, new: str, keep: Callable[[str, str], bool]) -> int:
+        """
+        Copy the entries of digest `old` to digest `new` where keep(kind, name), i.e.
+        those an edit did not touch (keys are (digest, kind, name)). Returns how many.
+        """
+        with self._lock:
+            items = [(k, v) for k, v in self._items.items() if k[0] == old and keep(k[1], k[2])]
+        for (_digest, kind, name), (etag, body) in items:
+            self.put((new, kind, name), etag, body)
+        return len(items)
+
+
+schedules = ScheduleRegistry()
+timetables = ResponseCache(settings.TIMETABLE_CACHE_MB * 1024 * 1024)
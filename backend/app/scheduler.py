@@ -0,0 +1,103 @@
+"""
+Fair job scheduler: one FIFO sub-queue per session, sessions served round-robin.
+
+Priority levels are strict: a batch job is only dispatched when no interactive
+job is waiting. Within a level every session with waiting jobs gets one job per
+round, so a client that queues many jobs does not delay the others.
+"""
+from __future__ import annotations
+import threading
+from collections import OrderedDict, deque
+
+PRIORITIES = ("interactive", "batch")  # dispatch order
+DEFAULT_PRIORITY = "interactive"
+
+
+class FairScheduler:
+    def __init__(self):
+        # priority -> session_id -> job ids; OrderedDict order is the rotation order
+        self._levels: dict[str, OrderedDict[str, deque[str]]] = {p: OrderedDict() for p in PRIORITIES}
+        self._where: dict[str, tuple[str, str]] = {}  # job_id -> (priority, session_id)
+        self._cond = threading.Condition()
+
+    def __len__(self) -> int:
+        with self._cond:
+            return len(self._where)
+
+    def put(self, job_id: str, session_id: str, priority: str = DEFAULT_PRIORITY) -> None:
+        if priority not in self._levels:
+            raise ValueError(f"priorità non valida: {priority}")
+        with self._cond:
+            self._levels[priority].setdefault(session_id, deque()).append(job_id)
+            self._where[job_id] = (priority, session_id)
+            self._cond.notify()
+
+    def get(self, timeout: float | None = None) -> str | None:
+        """Next job id to run, or None if nothing arrives within timeout."""
+        with self._cond:
+            if not self._where:
+                self._cond.wait(timeout)
+            for prio in PRIORITIES:
+                sessions = self._levels[prio]
+                if not sessions:
+                    continue
+                session_id, jobs = next(iter(sessions.items()))
+                job_id = jobs.popleft()
+                if jobs:
+                    sessions.move_to_end(session_id)
+                else:
+                    del sessions[session_id]
+                del self._where[job_id]
+                return job_id
+            return None
+
+    def remove(self, job_id: str) -> bool:
+        with self._cond:
+            loc = self._where.pop(job_id, None)
+            if loc is None:
+                return False
+            prio, session_id = loc
+            jobs = self._levels[prio][session_id]
+            jobs.remove(job_id)
+            if not jobs:
+                del self._levels[prio][session_id]
+            return True
+
+    def jobs_ahead(self, job_id: str) -> int | None:
+        """
+        Waiting jobs that will be dispatched before job_id if nothing else
+        arrives; None if the job is not waiting.
+        """
+        with self._cond:
+            loc = self._where.get(job_id)
+            if loc is None:
+                return None
+            prio, session_id = loc
+            ahead = 0
+            for p in PRIORITIES:
+                if p == prio:
+                    break
+                ahead += sum(len(q) for q in self._levels[p].values())
+            sessions = self._levels[prio]
+            k = sessions[session_id].index(job_id)
+            before = True  # sessions earlier in the rotation get one extra turn
+            for sid, jobs in sessions.items():
+                if sid == session_id:
+                    before = False
+                    ahead += k
+                    continue
+                ahead += min(len(jobs), k + 1 if before else k)
+            return ahead
+
+    def count_for_session(self, session_id: str) -> int:
+        with self._cond:
+            return sum(len(level.get(session_id, ())) for level in self._levels.values())
+
+    def session_head(self, session_id: str) -> str | None:
+        """The session's job that will be dispatched first, if any is waiting."""
+        with self._cond:
+            for prio in PRIORITIES:
+                jobs = self._levels[prio].get(session_id)
+                if jobs:
+                    return jobs[0]
+            return None
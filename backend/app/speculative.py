@@ -0,0 +1,153 @@
+"""
+Speculative input parsing, started as soon as an upload is accepted.
+
+If the function entry point's module exposes `load_inputs(input_paths,
+cancel_event=None)` and the entry point declares a `parsed` parameter, the
+inputs are parsed in the background while the user fills in the run options.
+/run then hands the result to the entry point instead of parsing again; a job
+that starts while the parse is still going waits for it rather than starting over.
+
+Speculative work is cancelled when the same client uploads again (the earlier
+upload is superseded) and dropped when the session expires. Any failure only
+means the job parses the inputs itself.
+"""
+from __future__ import annotations
+import importlib
+import threading
+import time
+import traceback
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable
+
+from .adapter import load_function, session_inputs, _accepts
+from .config import settings
+from .logging_config import logger
+
+
+@dataclass
+class _Parse:
+    session_id: str
+    future: Future | None = None
+    cancel_event: threading.Event = field(default_factory=threading.Event)
+    started: float = field(default_factory=time.monotonic)
+
+
+class SpeculativeParser:
+    def __init__(self, workers: int):
+        self.workers = max(1, workers)
+        self._executor: ThreadPoolExecutor | None = None
+        self._loader: Callable[..., Any] | None = None
+        self._resolved = False
+        self._parses: dict[str, _Parse] = {}  # session_id -> parse
+        self._latest: dict[str, str] = {}     # client -> session_id of its last upload
+        self._lock = threading.Lock()
+        self._resolve_lock = threading.Lock()  # held for the (slow) first import of the entry point
+
+    def _get_loader(self) -> Callable[..., Any] | None:
+        """load_inputs of the entry point module, or None if it cannot use a parse result."""
+        if self._resolved:
+            return self._loader
+        with self._resolve_lock:
+            # a concurrent first caller waits for the import instead of seeing no loader yet
+            if not self._resolved:
+                self._loader = self._resolve()
+                self._resolved = True
+        return self._loader
+
+    @staticmethod
+    def _resolve() -> Callable[..., Any] | None:
+        ep = settings.PROGRAM_ENTRYPOINT
+        if not settings.PREPARSE_ENABLED or ":" not in ep:
+            return None
+        try:
+            fn = load_function(ep)
+            mod = importlib.import_module(fn.__module__)
+            loader = getattr(mod, "load_inputs", None)
+            if callable(loader) and _accepts(fn, "parsed"):
+                return loader
+        except Exception:
+            logger.error("Speculative parsing disabled:\n" + traceback.format_exc())
+        return None
+
+    @property
+    def enabled(self) -> bool:
+        return self._get_loader() is not None
+
+    def start(self, session_id: str, inputs_dir: Path, client: str | None = None) -> bool:
+        """Begin parsing a session's inputs in the background. Blocking only for the first import."""
+        loader = self._get_loader()
+        if loader is None:
+            return False
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix="preparse")
+            if client is not None:
+                previous = self._latest.get(client)
+                self._latest[client] = session_id
+                if previous and previous != session_id:
+                    self._cancel(previous, "superseded by a newer upload")
+            parse = _Parse(session_id)
+            parse.future = self._executor.submit(self._run, loader, session_inputs(inputs_dir), parse)
+            self._parses[session_id] = parse
+        return True
+
+    @staticmethod
+    def _run(loader, input_paths: list[str], parse: _Parse):
+        result = loader(input_paths, cancel_event=parse.cancel_event)
+        logger.info(f"Speculative parse of session {parse.session_id} ready in "
+                    f"{time.monotonic() - parse.started:.1f}s")
+        return result
+
+    def _cancel(self, session_id: str, why: str) -> None:
+        # caller holds self._lock
+        parse = self._parses.pop(session_id, None)
+        if parse is None:
+            return
+        if not parse.future.done():
+            logger.info(f"Speculative parse of session {session_id} cancelled: {why}")
+        parse.cancel_event.set()
+        parse.future.cancel()
+
+    def discard(self, session_id: str) -> None:
+        with self._lock:
+            self._cancel(session_id, "session removed")
+            for client in [c for c, sid in self._latest.items() if sid == session_id]:
+                del self._latest[client]
+
+    def take(self, session_id: str, cancel_event: threading.Event | None = None):
+        """
+        The session's parse result, waiting for it if it is still running.
+        None if there is none, it failed, or cancel_event is set meanwhile.
+        The result is shared: callers must not modify it.
+        """
+        with self._lock:
+            parse = self._parses.get(session_id)
+        if parse is None:
+            return None
+        while True:
+            if cancel_event is not None and cancel_event.is_set():
+                return None
+            try:
+                return parse.future.result(timeout=0.5)
+            except FutureTimeout:
+                continue
+            except BaseException as e:  # includes CancelledError
+                logger.warning(f"Speculative parse of session {session_id} unusable: {e!r}")
+                with self._lock:
+                    if self._parses.get(session_id) is parse:
+                        del self._parses[session_id]
+                return None
+
+    def parsed(self, session_id: str, inputs_dir: Path):
+        """The session's parse result for read-only queries, parsing now if none is around. Blocking."""
+        with self._lock:
+            running = session_id in self._parses
+        if not running and not self.start(session_id, inputs_dir):
+            return None
+        return self.take(session_id)
+
+
+preparser = SpeculativeParser(settings.PREPARSE_WORKERS)
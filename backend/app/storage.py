@@ -1,7 +1,10 @@
 from __future__ import annotations
+import hashlib
+import json
 import re
 import shutil
 import zipfile
+from datetime import datetime, timezone
 from pathlib import Path
 from typing import Iterable
 
@@ -17,8 +20,16 @@ def sanitize_filename(name: str) -> str:
     return name[:200]
 
 
+def sessions_root() -> Path:
+    return settings.OUTPUT_DIR_BASE / "sessions"
+
+
+def session_dir(session_id: str) -> Path:
+    return sessions_root() / session_id
+
+
 def ensure_session_dirs(session_id: str) -> tuple[Path, Path, Path]:
-    base = settings.OUTPUT_DIR_BASE / "sessions" / session_id
+    base = session_dir(session_id)
     inputs = base / "inputs"
     jobs = base / "jobs"
     for p in (base, inputs, jobs):
@@ -41,16 +52,71 @@ def total_size(paths: Iterable[Path]) -> int:
     return total
 
 
-def zip_directory(src: Path, dest_zip: Path) -> None:
-    dest_zip = dest_zip.resolve()
-    with zipfile.ZipFile(dest_zip, "w", zipfile.ZIP_DEFLATED) as zf:
-        for file in src.rglob("*"):
-            if not file.is_file():
-                continue
-            # Skip the destination zip itself if it's under src
-            if file.resolve() == dest_zip:
-                continue
-            zf.write(file, arcname=file.relative_to(src))
+RESULTS_ARCHIVE = "all.zip"
+MANIFEST_NAME = "manifest.json"
+# already-compressed formats: deflating them again costs CPU for no gain
+STORED_EXTS = {".xlsx", ".xlsm", ".zip", ".png", ".jpg", ".jpeg", ".pdf"}
+
+
+def is_result_file(relname: str) -> bool:
+    """True for job outputs offered for download (not logs, markers, archives or partial writes)."""
+    name = relname.rsplit("/", 1)[-1]
+    return not (relname in ("job.log", RESULTS_ARCHIVE, MANIFEST_NAME)
+                or name.endswith("_OK.txt") or name.endswith(".part"))
+
+
+def write_results_archive(workdir: Path, dest_zip: Path) -> list[dict]:
+    """
+    Zip the job's result files into dest_zip (atomically, via a .part file).
+    xlsx and other compressed formats are stored, text is deflated.
+    Returns the members as list_files() entries plus their mtime_ns.
+    """
+    members = []
+    for f in sorted(p for p in workdir.rglob("*") if p.is_file()):
+        rel = str(f.relative_to(workdir)).replace("\\", "/")
+        if not is_result_file(rel):
+            continue
+        st = f.stat()
+        members.append({"filename": rel, "size_bytes": st.st_size, "mtime_ns": st.st_mtime_ns, "path": f})
+    tmp = dest_zip.with_name(dest_zip.name + ".part")
+    with zipfile.ZipFile(tmp, "w") as zf:
+        for m in members:
+            ctype = zipfile.ZIP_STORED if m["path"].suffix.lower() in STORED_EXTS else zipfile.ZIP_DEFLATED
+            zf.write(m.pop("path"), arcname=m["filename"], compress_type=ctype)
+    tmp.replace(dest_zip)
+    return members
+
+
+def sha256_file(path: Path, chunk_size: int = 1024 * 1024) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as fh:
+        while chunk := fh.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def write_manifest(workdir: Path) -> list[dict]:
+    """
+    Describe the job's result files in workdir/manifest.json and return the entries:
+    filename, size_bytes, sha256, type (extension) and generated_at (UTC mtime).
+    """
+    entries = []
+    for f in sorted(p for p in workdir.rglob("*") if p.is_file()):
+        rel = str(f.relative_to(workdir)).replace("\\", "/")
+        if not is_result_file(rel):
+            continue
+        st = f.stat()
+        entries.append({
+            "filename": rel,
+            "size_bytes": st.st_size,
+            "sha256": sha256_file(f),
+            "type": f.suffix.lower().lstrip("."),
+            "generated_at": datetime.fromtimestamp(st.st_mtime, timezone.utc).isoformat(),
+        })
+    tmp = workdir / (MANIFEST_NAME + ".part")
+    tmp.write_text(json.dumps({"files": entries}, indent=2), encoding="utf-8")
+    tmp.replace(workdir / MANIFEST_NAME)
+    return entries
 
 
 def list_files(dirpath: Path) -> list[dict]:
@@ -63,6 +129,21 @@ def list_files(dirpath: Path) -> list[dict]:
     return files
 
 
+def read_file_chunk(path: Path, offset: int) -> tuple[bytes, int]:
+    """Read from byte `offset` to EOF with a seek. Returns (data, new_offset)."""
+    try:
+        with open(path, "rb") as fh:
+            fh.seek(0, 2)
+            size = fh.tell()
+            if offset >= size:
+                return b"", size
+            fh.seek(offset)
+            data = fh.read(size - offset)
+    except FileNotFoundError:
+        return b"", offset
+    return data, offset + len(data)
+
+
 def cleanup_dir(path: Path) -> None:
     if path.exists():
         shutil.rmtree(path, ignore_errors=True)
@@ -0,0 +1,164 @@
+"""
+Streaming multipart upload: parts are written to disk in fixed-size chunks as
+they arrive, never held whole in memory. The size limit is enforced on the
+running total and each file's SHA-256 is computed while it streams.
+"""
+from __future__ import annotations
+import hashlib
+import os
+from dataclasses import dataclass
+from pathlib import Path
+
+from fastapi import HTTPException, Request
+from multipart.exceptions import MultipartParseError
+from multipart.multipart import MultipartParser, parse_options_header
+from .offload import run_io
+from .storage import sanitize_filename
+
+UPLOAD_CHUNK_SIZE = 256 * 1024
+# allowance for multipart boundaries/headers when pre-checking Content-Length
+MULTIPART_OVERHEAD = 64 * 1024
+
+
+@dataclass
+class StoredUpload:
+    filename: str        # sanitized name under inputs/
+    original_name: str
+    path: Path
+    size_bytes: int
+    sha256: str
+
+
+class _FileSink:
+    """One file being written: buffers up to a chunk, writes and hashes off the event loop."""
+
+    def __init__(self, path: Path, original_name: str):
+        self.path = path
+        self.tmp_path = path.with_name(path.name + ".part")
+        self.original_name = original_name
+        self.size = 0
+        self._hash = hashlib.sha256()
+        self._buf = bytearray()
+        self._fh = None
+
+    async def open(self) -> None:
+        self._fh = await run_io("fs", open, self.tmp_path, "wb")
+
+    def _write_sync(self, data: bytes) -> None:
+        self._fh.write(data)
+        self._hash.update(data)
+
+    async def write(self, data: bytes) -> None:
+        self.size += len(data)
+        self._buf += data
+        if len(self._buf) >= UPLOAD_CHUNK_SIZE:
+            chunk, self._buf = bytes(self._buf), bytearray()
+            await run_io("fs", self._write_sync, chunk)
+
+    def _finish_sync(self, tail: bytes) -> None:
+        self._write_sync(tail)
+        self._fh.close()
+        os.replace(self.tmp_path, self.path)
+
+    async def close(self) -> StoredUpload:
+        tail, self._buf = bytes(self._buf), bytearray()
+        await run_io("fs", self._finish_sync, tail)
+        return StoredUpload(self.path.name, self.original_name, self.path, self.size, self._hash.hexdigest())
+
+    def abort(self) -> None:
+        if self._fh and not self._fh.closed:
+            self._fh.close()
+        self.tmp_path.unlink(missing_ok=True)
+
+
+async def receive_files(request: Request, dest_dir: Path, max_total: int, allowed_exts: set[str],
+                        field_name: str = "files") -> list[StoredUpload]:
+    """
+    Stream the `field_name` file parts of a multipart request into dest_dir.
+    Raises HTTPException 400 (bad request/extension) or 413 (over max_total)
+    as soon as the offending part or byte arrives.
+    """
+    _ctype, params = parse_options_header(request.headers.get("content-type", ""))
+    boundary = params.get(b"boundary")
+    if not boundary:
+        raise HTTPException(400, "Richiesta multipart non valida")
+
+    events: list[tuple] = []
+    hdr = {"field": b"", "value": b"", "disposition": b""}
+
+    def on_header_field(data, start, end):
+        hdr["field"] += data[start:end]
+
+    def on_header_value(data, start, end):
+        hdr["value"] += data[start:end]
+
+    def on_header_end():
+        if hdr["field"].lower() == b"content-disposition":
+            hdr["disposition"] = hdr["value"]
+        hdr["field"] = hdr["value"] = b""
+
+    def on_headers_finished():
+        _disp, opts = parse_options_header(hdr["disposition"])
+        hdr["disposition"] = b""
+        name = opts.get(b"name", b"").decode("utf-8", "replace")
+        filename = opts.get(b"filename")
+        events.append(("begin", name, filename.decode("utf-8", "replace") if filename is not None else None))
+
+    def on_part_data(data, start, end):
+        events.append(("data", bytes(data[start:end])))
+
+    def on_part_end():
+        events.append(("end",))
+
+    parser = MultipartParser(boundary, {
+        "on_header_field": on_header_field,
+        "on_header_value": on_header_value,
+        "on_header_end": on_header_end,
+        "on_headers_finished": on_headers_finished,
+        "on_part_data": on_part_data,
+        "on_part_end": on_part_end,
+    })
+
+    saved: list[StoredUpload] = []
+    sink: _FileSink | None = None
+    total = 0
+
+    async def drain():
+        nonlocal sink, total
+        for ev in events:
+            kind = ev[0]
+            if kind == "begin":
+                _, name, filename = ev
+                if name != field_name or filename is None:
+                    continue  # plain form fields are ignored
+                safe = sanitize_filename(filename or "file")
+                ext = Path(safe).suffix.lower()
+                if ext not in allowed_exts:
+                    raise HTTPException(400, f"Estensione non permessa: {ext}")
+                sink = _FileSink(dest_dir / safe, filename)
+                await sink.open()
+            elif kind == "data" and sink is not None:
+                total += len(ev[1])
+                if total > max_total:
+                    raise HTTPException(413, f"Dimensione totale supera limite: {max_total // (1024 * 1024)} MB")
+                await sink.write(ev[1])
+            elif kind == "end" and sink is not None:
+                saved.append(await sink.close())
+                sink = None
+        events.clear()
+
+    try:
+        async for chunk in request.stream():
+            parser.write(chunk)
+            await drain()
+        parser.finalize()
+        await drain()
+    except BaseException as e:
+        if sink is not None:
+            sink.abort()
+        for s in saved:
+            s.path.unlink(missing_ok=True)
+        if isinstance(e, MultipartParseError):
+            raise HTTPException(400, f"Richiesta multipart non valida: {e}") from e
+        raise
+    return saved
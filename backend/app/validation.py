@@ -1,7 +1,14 @@
 """
 Optional schema validation for Excel files.
 Can be extended to check required sheets, headers, data types, etc.
+
+Validation only needs sheet names and header rows, so files are reduced to a
+"fingerprint" ({sheet: header}) read in openpyxl read-only mode, touching just
+the first row of each sheet. Fingerprints of examples/*.xlsx are computed once
+at startup; those of uploads are cached by SHA-256.
 """
+import threading
+from collections import OrderedDict, defaultdict
 from pathlib import Path
 from typing import Optional
 
@@ -12,6 +19,44 @@ except ImportError:
     HAS_OPENPYXL = False
 
 
+def _header_names(row) -> list:
+    """Header row as pandas.read_excel(nrows=0) would name the columns."""
+    vals = []
+    for v in row:
+        if v is None:
+            v = ""
+        elif isinstance(v, float) and v.is_integer():
+            v = int(v)
+        vals.append(v)
+    while vals and vals[-1] == "":
+        vals.pop()
+    names, counts = [], defaultdict(int)
+    for i, col in enumerate(vals):
+        if col == "":
+            col = f"Unnamed: {i}"
+        cur = counts[col]
+        while cur > 0:  # duplicate names get .1, .2, ... like pandas
+            counts[col] = cur + 1
+            col = f"{col}.{cur}"
+            cur = counts[col]
+        names.append(col)
+        counts[col] = cur + 1
+    return names
+
+
+def read_fingerprint(file_path: Path) -> dict[str, list]:
+    """{sheet name: header columns}, in workbook order."""
+    wb = openpyxl.load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        fp = {}
+        for ws in wb.worksheets:
+            row = next(ws.iter_rows(min_row=1, max_row=1, values_only=True), ())
+            fp[ws.title] = _header_names(row)
+        return fp
+    finally:
+        wb.close()
+
+
 class SchemaValidator:
     """
     Validates Excel files against a schema.
@@ -37,33 +82,102 @@ class SchemaValidator:
             return True, ""  # Skip if openpyxl not installed
 
         try:
-            wb = openpyxl.load_workbook(file_path, data_only=True)
+            fp = read_fingerprint(file_path)
         except Exception as e:
             return False, f"Impossibile aprire file: {e}"
+        return self.validate_fingerprint(fp)
 
+    def validate_fingerprint(self, fp: dict[str, list]) -> tuple[bool, str]:
         # Check required sheets
         required_sheets = self.schema.get("required_sheets", [])
-        sheet_names = set(wb.sheetnames)
-        missing = set(required_sheets) - sheet_names
+        missing = set(required_sheets) - set(fp)
         if missing:
             return False, f"Fogli mancanti: {', '.join(missing)}"
 
         # Check sheet headers
         sheets_config = self.schema.get("sheets", {})
         for sheet_name, config in sheets_config.items():
-            if sheet_name not in wb.sheetnames:
+            if sheet_name not in fp:
                 continue
-            ws = wb[sheet_name]
             required_headers = config.get("required_headers", [])
             if required_headers:
-                first_row = [cell.value for cell in ws[1]]
-                missing_headers = set(required_headers) - set(first_row)
+                missing_headers = set(required_headers) - set(fp[sheet_name])
                 if missing_headers:
                     return False, f"Foglio '{sheet_name}': intestazioni mancanti: {', '.join(missing_headers)}"
 
         return True, ""
 
 
+class ValidationEngine:
+    """
+    Schema validation plus structural comparison with the example file of the
+    same name. Thread-safe: uploads validate their files in parallel.
+    """
+
+    def __init__(self, schema_validator: SchemaValidator, examples_dir: Path, cache_size: int = 256):
+        self.schema_validator = schema_validator
+        self.examples_dir = examples_dir
+        self.examples: dict[str, dict[str, list]] = {}
+        self._cache: OrderedDict[str, dict[str, list]] = OrderedDict()
+        self._cache_size = cache_size
+        self._lock = threading.Lock()
+
+    def load_examples(self) -> None:
+        """Fingerprint examples/*.xlsx once (startup)."""
+        if not HAS_OPENPYXL or not self.examples_dir.exists():
+            return
+        for p in sorted(self.examples_dir.glob("*.xlsx")):
+            try:
+                self.examples[p.name] = read_fingerprint(p)
+            except Exception:
+                continue  # unreadable example => no comparison for that name
+
+    def fingerprint(self, file_path: Path, sha256: str | None = None) -> dict[str, list]:
+        if sha256:
+            with self._lock:
+                fp = self._cache.get(sha256)
+                if fp is not None:
+                    self._cache.move_to_end(sha256)
+                    return fp
+        fp = read_fingerprint(file_path)
+        if sha256:
+            with self._lock:
+                self._cache[sha256] = fp
+                while len(self._cache) > self._cache_size:
+                    self._cache.popitem(last=False)
+        return fp
+
+    def compare_with_example(self, fname: str, fp: dict[str, list]) -> tuple[bool, str | None]:
+        ex = self.examples.get(fname)
+        if ex is None:
+            return True, None  # no example available => skip
+        if set(fp) != set(ex):
+            return False, f"Fogli diversi: {list(fp)} vs {list(ex)}"
+        for sh, ex_cols in ex.items():
+            if fp[sh] != ex_cols:
+                return False, f"Intestazioni diverse nel foglio '{sh}': {fp[sh]} vs {ex_cols}"
+        return True, None
+
+    def check(self, fname: str, file_path: Path, sha256: str | None = None) -> tuple[str, str] | None:
+        """
+        None if the file is acceptable, else (kind, message) with kind
+        "schema" (schema validation failed) or "structure" (differs from example).
+        """
+        if not HAS_OPENPYXL:
+            return None
+        try:
+            fp = self.fingerprint(file_path, sha256)
+        except Exception as e:
+            return "schema", f"Impossibile aprire file: {e}"
+        ok, msg = self.schema_validator.validate_fingerprint(fp)
+        if not ok:
+            return "schema", msg
+        ok, reason = self.compare_with_example(fname, fp)
+        if not ok:
+            return "structure", reason
+        return None
+
+
 # Default schema (can be overridden via env or config)
 DEFAULT_SCHEMA = {
     "required_sheets": [],  # No required sheets by default
@@ -71,3 +185,4 @@ DEFAULT_SCHEMA = {
 }
 
 validator = SchemaValidator(DEFAULT_SCHEMA)
+engine = ValidationEngine(validator, Path(__file__).resolve().parents[2] / "examples")
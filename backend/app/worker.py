@@ -1,57 +1,204 @@
 from __future__ import annotations
-import queue
+import math
 import threading
-import time
-from datetime import datetime, timedelta
+from datetime import datetime
 from pathlib import Path
 from typing import Dict
 import traceback
 
 from .models import Job, JobStatus
 from .config import settings
-from .storage import cleanup_dir
+from .storage import cleanup_dir, write_manifest, RESULTS_ARCHIVE
 from .adapter import run_entrypoint
+from .joblog import job_logs
+from .scheduler import FairScheduler
+from .archive import archives
+from .expiry import expiry, reaper
+from .quota import quota
+from .speculative import preparser
+from .logging_config import logger
+
+
+# runtime assumed for Retry-After estimates until a job has completed
+DEFAULT_RUNTIME_ESTIMATE = 60.0
 
 
 class JobQueue:
     def __init__(self):
-        self.q: queue.Queue[str] = queue.Queue()
+        self.scheduler = FairScheduler()
+        self.avg_runtime = DEFAULT_RUNTIME_ESTIMATE  # EWMA of job durations (s)
         self.jobs: Dict[str, Job] = {}
+        self.by_session: Dict[str, set[str]] = {}  # session_id -> job ids
+        self.by_run_key: Dict[tuple[str, str], list[str]] = {}  # (session_id, run_key) -> job ids, oldest first
         self.lock = threading.Lock()
+        self._executing: str | None = None  # job id the worker thread is running
         self.stop_event = threading.Event()
         self.worker_thread = threading.Thread(target=self._worker_loop, daemon=True)
-        self.gc_thread = threading.Thread(target=self._gc_loop, daemon=True)
+        reaper.register("job", self._expire_job, settings.JOB_TTL_MINUTES * 60)
+        quota.register_evictor("job", self._evict_job)
+        quota.register_evictor("archive", self._evict_archive)
 
     def start(self):
         self.worker_thread.start()
-        self.gc_thread.start()
 
     def enqueue(self, job: Job):
         with self.lock:
-            self.jobs[job.job_id] = job
-        self.q.put(job.job_id)
+            self._add(job)
+        self.scheduler.put(job.job_id, job.session_id, job.priority)
+
+    def _reusable(self, key: tuple[str, str]) -> Job | None:
+        for job_id in reversed(self.by_run_key.get(key, ())):
+            job = self.jobs.get(job_id)
+            if job is None:
+                continue
+            if job.status in (JobStatus.queued, JobStatus.running):
+                if job.cancel_event.is_set():
+                    continue  # cancelled or timed out: about to end as cancelled
+                return job
+            if job.status == JobStatus.succeeded and job.manifest is not None:
+                return job
+        return None
+
+    def _forget_run_key(self, job: Job) -> None:
+        key = (job.session_id, job.run_key)
+        ids = self.by_run_key.get(key)
+        if ids and job.job_id in ids:
+            ids.remove(job.job_id)
+            if not ids:
+                del self.by_run_key[key]
+
+    def find_duplicate(self, session_id: str, run_key: str) -> Job | None:
+        """A queued/running job not being cancelled, or a succeeded one whose outputs still exist, with the same run key."""
+        with self.lock:
+            return self._reusable((session_id, run_key))
+
+    def enqueue_unique(self, job: Job, force: bool = False) -> Job:
+        """
+        Enqueue job unless an equivalent one appeared meanwhile (single-flight):
+        returns the job that will actually serve the request.
+        """
+        key = (job.session_id, job.run_key)
+        with self.lock:
+            existing = None if force else self._reusable(key)
+            if existing is not None:
+                return existing
+            self._add(job)
+            self.by_run_key.setdefault(key, []).append(job.job_id)
+        self.scheduler.put(job.job_id, job.session_id, job.priority)
+        return job
 
     def get(self, job_id: str) -> Job | None:
+        """Look up a job; any access extends the TTL of the job and of its session."""
         with self.lock:
-            return self.jobs.get(job_id)
+            job = self.jobs.get(job_id)
+        if job:
+            expiry.touch("job", job_id)
+            expiry.touch("session", job.session_id)
+            quota.touch(job_id)
+        return job
+
+    def cancel(self, job_id: str, reason: str = "Annullato") -> Job | None:
+        """
+        Request cancellation. A queued job is removed from the scheduler and
+        finished immediately; a running job is stopped by the adapter at the next check.
+        """
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if not job or job.status not in (JobStatus.queued, JobStatus.running):
+                return job
+            job.cancel_reason = reason
+            job.cancel_event.set()
+            if job.status == JobStatus.queued:
+                self.scheduler.remove(job_id)
+                job.status = JobStatus.cancelled
+                job.message = reason
+                job.finished_at = datetime.utcnow()
+                reaper.track("job", job_id)
+        return job
+
+    def delete_when_stopped(self, job_id: str) -> bool:
+        """
+        Mark the job the worker is running for deletion once it stops (see delete_outputs).
+        False if the worker is not running it: the caller may delete right away.
+        """
+        with self.lock:
+            if self._executing != job_id:
+                return False
+            self.jobs[job_id].delete_on_stop = True
+            return True
+
+    def delete_outputs(self, job: Job) -> None:
+        """Delete a job's directory and release its storage; the job record stays. Blocking."""
+        if job.workdir:
+            cleanup_dir(job.workdir)
+        quota.release_job(job.job_id)
+        job.manifest = None
+        job.archive_etag = None
+        job.message = "Eliminato"
+
+    def jobs_ahead(self, job_id: str) -> int | None:
+        return self.scheduler.jobs_ahead(job_id)
+
+    def estimated_wait(self, jobs: int = 1) -> int:
+        """Seconds for `jobs` more jobs to leave the queue at the current throughput."""
+        return max(1, math.ceil(self.avg_runtime * max(1, jobs)))
+
+    def admission_error(self, session_id: str) -> tuple[int, str, int] | None:
+        """(status_code, message, retry_after) if a new job must be refused, else None."""
+        limit = settings.MAX_QUEUED_JOBS
+        if limit > 0 and len(self.scheduler) >= limit:
+            return 503, "Coda piena, riprovare più tardi", self.estimated_wait(1)
+        limit = settings.MAX_QUEUED_JOBS_PER_SESSION
+        if limit > 0 and self.scheduler.count_for_session(session_id) >= limit:
+            # a slot frees when the session's first waiting job is dispatched
+            head = self.scheduler.session_head(session_id)
+            ahead = self.scheduler.jobs_ahead(head) if head else 0
+            return 429, "Troppi job in coda per questa sessione", self.estimated_wait((ahead or 0) + 1)
+        return None
 
     def _worker_loop(self):
         while not self.stop_event.is_set():
-            try:
-                job_id = self.q.get(timeout=0.5)
-            except queue.Empty:
+            job_id = self.scheduler.get(timeout=0.5)
+            if job_id is None:
                 continue
-            job = self.get(job_id)
+            with self.lock:
+                job = self.jobs.get(job_id)
+                if job and job.status == JobStatus.queued:
+                    job.status = JobStatus.running
+                    job.started_at = datetime.utcnow()
+                    self._executing = job_id
+                else:
+                    job = None
             if not job:
                 continue
+            log = job_logs.open(job_id, job.log_path)
+            timer = None
+            if settings.JOB_TIMEOUT_MINUTES > 0:
+                timer = threading.Timer(settings.JOB_TIMEOUT_MINUTES * 60, self.cancel, (job_id, "Tempo massimo superato"))
+                timer.daemon = True
+                timer.start()
             try:
-                job.status = JobStatus.running
-                job.started_at = datetime.utcnow()
                 job.progress = 5
                 job.message = "Validazione e preparazione"
+                parsed = None
+                if preparser.enabled:
+                    job.message = "Lettura input (avviata al caricamento)"
+                    parsed = preparser.take(job.session_id, job.cancel_event)
                 # Execute entrypoint
-                exit_code = run_entrypoint(job)
-                if exit_code == 0:
+                exit_code = run_entrypoint(job, log, parsed=parsed)
+                if job.cancel_event.is_set():
+                    job.status = JobStatus.cancelled
+                    job.progress = 100
+                    job.message = job.cancel_reason
+                    log.write(f"\n[CANCELLED] {job.cancel_reason}\n")
+                elif exit_code == 0:
+                    job.message = "Creazione archivio"
+                    job.manifest = write_manifest(job.workdir)
+                    try:
+                        archives.ensure(job)
+                    except Exception:
+                        # not fatal: /download/all.zip retries the build on demand
+                        log.write("\n[WARN] archivio risultati non creato\n" + traceback.format_exc())
                     job.status = JobStatus.succeeded
                     job.progress = 100
                     job.message = "Completato"
@@ -64,26 +211,89 @@ class JobQueue:
                 job.progress = 100
                 job.message = "Errore runtime"
                 # append stacktrace to log
-                if job.log_path:
-                    with open(job.log_path, 'a', encoding='utf-8') as f:
-                        f.write("\n" + traceback.format_exc())
+                log.write("\n" + traceback.format_exc())
             finally:
+                if timer:
+                    timer.cancel()
                 job.finished_at = datetime.utcnow()
-                self.q.task_done()
-
-    def _gc_loop(self):
-        while not self.stop_event.is_set():
-            try:
-                ttl = timedelta(minutes=settings.JOB_TTL_MINUTES)
-                cutoff = datetime.utcnow() - ttl
+                runtime = (job.finished_at - job.started_at).total_seconds()
+                self.avg_runtime = 0.8 * self.avg_runtime + 0.2 * runtime
+                job_logs.close(job_id)
+                reaper.track("job", job_id)
+                self._account(job)
                 with self.lock:
-                    old_ids = [jid for jid, j in self.jobs.items() if j.finished_at and j.finished_at < cutoff]
-                for jid in old_ids:
-                    job = self.jobs.pop(jid, None)
-                    if job and job.workdir:
-                        cleanup_dir(job.workdir)
-                time.sleep(60)
-            except Exception:
-                time.sleep(60)
+                    self._executing = None
+                    delete = job.delete_on_stop
+                if delete:
+                    self.delete_outputs(job)
+
+    def _account(self, job: Job) -> None:
+        """
+        Charge a finished job's files (one walk of its dir) and evict others if over
+        budget. The archive is charged separately, as it can be dropped and rebuilt.
+        """
+        try:
+            size = sum(p.stat().st_size for p in job.workdir.rglob("*") if p.name != RESULTS_ARCHIVE and p.is_file())
+            quota.charge("job", job.job_id, size, job.session_id)
+            quota.finished(job.job_id)
+            quota.enforce()
+        except Exception:
+            logger.error(f"Storage accounting failed for job {job.job_id}:\n" + traceback.format_exc())
+
+    def _add(self, job: Job) -> None:
+        # caller holds self.lock
+        self.jobs[job.job_id] = job
+        self.by_session.setdefault(job.session_id, set()).add(job.job_id)
+
+    def _remove(self, job: Job) -> None:
+        # caller holds self.lock
+        del self.jobs[job.job_id]
+        quota.release_job(job.job_id)
+        ids = self.by_session.get(job.session_id)
+        if ids is not None:
+            ids.discard(job.job_id)
+            if not ids:
+                del self.by_session[job.session_id]
+        self._forget_run_key(job)
+        expiry.discard("job", job.job_id)
+        archives.forget(job.job_id)
+
+    def _drop_finished(self, job_id: str, keep_pinned: bool) -> bool:
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return True
+            if job.status in (JobStatus.queued, JobStatus.running) or (keep_pinned and job.pinned):
+                return False
+            self._remove(job)
+        if job.workdir:
+            cleanup_dir(job.workdir)
+        return True
+
+    def _expire_job(self, job_id: str) -> bool:
+        """Expiry handler: drop a finished job and its directory; keep it while it still runs."""
+        return self._drop_finished(job_id, keep_pinned=False)
+
+    def _evict_job(self, job_id: str) -> bool:
+        """Quota evictor: like expiry, but pinned jobs are kept."""
+        return self._drop_finished(job_id, keep_pinned=True)
+
+    def _evict_archive(self, job_id: str) -> bool:
+        with self.lock:
+            job = self.jobs.get(job_id)
+        return archives.drop(job) if job and job.workdir else False
+
+    def drop_session(self, session_id: str) -> list[Job] | None:
+        """
+        Forget every job of a session (their files go with the session tree) and
+        return them. Returns None, removing nothing, while one of them is queued or running.
+        """
+        with self.lock:
+            jobs = [self.jobs[jid] for jid in self.by_session.get(session_id, ())]
+            if any(j.status in (JobStatus.queued, JobStatus.running) for j in jobs):
+                return None
+            for job in jobs:
+                self._remove(job)
+        return jobs
 
 job_queue = JobQueue()
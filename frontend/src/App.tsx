@@ -8,6 +8,17 @@ const API_BASE = import.meta.env.VITE_API_BASE || '' // same origin by default (
 
 function bytesToMB(n: number) { return (n / (1024*1024)).toFixed(2) }
 
+// Per-browser id: rate limits count per browser, and a new upload supersedes this browser's previous one
+function clientId(): string {
+  let id = localStorage.getItem('client_id')
+  if (!id) {
+    // not crypto.randomUUID: unavailable over plain http on the school LAN
+    id = Math.random().toString(36).slice(2) + Date.now().toString(36)
+    localStorage.setItem('client_id', id)
+  }
+  return id
+}
+
 export default function App() {
   // Fixed required inputs mapping
   const REQUIRED_KEYS = [
@@ -47,7 +58,10 @@ export default function App() {
   const [isUploading, setUploading] = useState<boolean>(false)
   const [committedHeader, setCommittedHeader] = useState<string>('')
   const [headerMsg, setHeaderMsg] = useState<string>('')
+  const [conflictMsg, setConflictMsg] = useState<string>('')
   const pollRef = useRef<number | null>(null)
+  const logOffsetRef = useRef<number>(0)
+  const pollJobRef = useRef<string>('') // job the shown status/log belong to
 
   // Remove DnD multi-upload in favor of fixed slots
   const onDrop = useCallback((e: React.DragEvent) => { e.preventDefault() }, [])
@@ -58,7 +72,7 @@ export default function App() {
 
   async function doUpload() {
     if (isUploading) return
-    setError(''); setUploadMsg(''); setRunMsg(''); setSessionId(''); setJobId(''); setStatus(null); setLogText(''); setResults([])
+    setError(''); setUploadMsg(''); setConflictMsg(''); setRunMsg(''); setSessionId(''); setJobId(''); setStatus(null); setLogText(''); setResults([])
     // Validate presence of all required files and extension
     for (const k of REQUIRED_KEYS) {
       const f = inputs[k]
@@ -77,7 +91,7 @@ export default function App() {
       setUploading(true)
       console.log('[Upload] URL:', url)
       console.log('[Upload] Files:', REQUIRED_KEYS.map(k=>`${NAMING[k]} <= ${inputs[k]?.name}`))
-      const res = await fetch(url, { method: 'POST', body: fd })
+      const res = await fetch(url, { method: 'POST', body: fd, headers: { 'X-Client-Id': clientId() } })
       const text = await res.text()
       if (!res.ok) {
         console.error('[Upload] Failed', res.status, text)
@@ -93,6 +107,7 @@ export default function App() {
       console.log('[Upload] Success. session_id=', data.session_id)
       setSessionId(data.session_id)
       setUploadMsg('Caricamento effettuato correttamente')
+      checkConflicts(data.session_id)
     } catch (e: any) {
       console.error('[Upload] Exception', e)
       setError(`Errore di rete durante upload: ${e?.message || e}`)
@@ -101,32 +116,66 @@ export default function App() {
     }
   }
 
+  async function checkConflicts(sid: string) {
+    try {
+      const res = await fetch(`${API_BASE}/sessions/${sid}/conflicts`)
+      if (!res.ok) return
+      const data = await res.json()
+      if (data.count > 0) {
+        const first = data.conflicts.slice(0, 3).map((c: any) => `${c.tipo} ${c.nome} (${c.giorno}, ora ${c.ora})`).join('; ')
+        setConflictMsg(`Attenzione: ${data.count} conflitti nell'orario: ${first}${data.count > 3 ? '; ...' : ''}`)
+      }
+    } catch (e: any) {
+      console.warn('[Conflicts] check failed', e)
+    }
+  }
+
   async function runJob() {
     if (!sessionId) { setError('Sessione non valida'); return }
     if (!options.header_text || !String(options.header_text).trim()) { setError('Imposta l\'Header nei Parametri'); return }
     const optsToSend = { ...options, header_text: committedHeader }
-    const res = await fetch(`${API_BASE}/run`, { method: 'POST', headers: { 'Content-Type': 'application/json' }, body: JSON.stringify({ session_id: sessionId, options: optsToSend }) })
+    const res = await fetch(`${API_BASE}/run`, { method: 'POST', headers: { 'Content-Type': 'application/json', 'X-Client-Id': clientId() }, body: JSON.stringify({ session_id: sessionId, options: optsToSend }) })
     if (!res.ok) { setError('Avvio job fallito'); return }
-    const data = await res.json(); setJobId(data.job_id); setRunMsg('Programma lanciato correttamente')
+    const data = await res.json(); setJobId(data.job_id)
+    setRunMsg(data.deduplicated ? 'Stessi file e parametri: riuso del job già avviato' : 'Programma lanciato correttamente')
   }
 
   async function poll() {
-    if (!jobId) return
-    const sres = await fetch(`${API_BASE}/status/${jobId}`)
-    if (sres.ok) {
+    const id = jobId
+    if (!id) return
+    const sres = await fetch(`${API_BASE}/status/${id}`)
+    // late reply for a previous job: drop it
+    if (sres.ok && pollJobRef.current === id) {
       const s: StatusResp = await sres.json(); setStatus(s)
-      const lres = await fetch(`${API_BASE}/logs/${jobId}`)
-      if (lres.ok) setLogText(await lres.text())
+      const offset = logOffsetRef.current
+      const lres = await fetch(`${API_BASE}/logs/${id}?offset=${offset}`)
+      if (lres.ok) {
+        const chunk = await lres.text()
+        // polls overlap (interval, cancelJob, slow replies): append only if nobody appended this chunk meanwhile
+        if (pollJobRef.current === id && logOffsetRef.current === offset) {
+          logOffsetRef.current = Number(lres.headers.get('X-Log-Offset') || offset)
+          if (chunk) setLogText(prev => prev + chunk)
+        }
+      }
+      if (pollJobRef.current !== id) return // job changed while reading the log: its own polling is running
       if (s.status === 'succeeded') {
-        const rres = await fetch(`${API_BASE}/results/${jobId}`)
+        const rres = await fetch(`${API_BASE}/results/${id}`)
+        if (pollJobRef.current !== id) return
         if (rres.ok) setResults(await rres.json())
         stopPolling()
-      } else if (s.status === 'failed') {
+      } else if (s.status === 'failed' || s.status === 'cancelled') {
         stopPolling();
       }
     }
   }
 
+  async function cancelJob() {
+    if (!jobId) return
+    const res = await fetch(`${API_BASE}/jobs/${jobId}/cancel`, { method: 'POST' })
+    if (!res.ok && res.status !== 409) setError('Annullamento fallito')
+    poll()
+  }
+
   function startPolling() {
     if (pollRef.current) return
     pollRef.current = window.setInterval(poll, 2500)
@@ -137,6 +186,9 @@ export default function App() {
   }
 
   useEffect(() => {
+    pollJobRef.current = jobId
+    logOffsetRef.current = 0
+    setLogText('')
     if (jobId) { startPolling(); poll() }
     return () => stopPolling()
   }, [jobId])
@@ -193,6 +245,7 @@ export default function App() {
         <div style={{marginTop:12}}>
           <button onClick={doUpload} disabled={isUploading || !REQUIRED_KEYS.every(k=>!!inputs[k])}>{isUploading ? 'Caricamento...' : 'Carica'}</button>
           {uploadMsg && <div className="alert success" style={{marginTop:8}}>{uploadMsg}</div>}
+          {conflictMsg && <div className="alert error" style={{marginTop:8}}>{conflictMsg}</div>}
         </div>
       </section>
 
@@ -217,6 +270,24 @@ export default function App() {
           }}>Imposta</button>
           {headerMsg && <div className="alert success" style={{marginTop:8}}>{headerMsg}</div>}
         </div>
+        <div style={{marginTop:8}}>
+          <label>
+            <input
+              type="checkbox"
+              checked={!!options.fail_on_conflicts}
+              onChange={(e: React.ChangeEvent<HTMLInputElement>)=>setOptions((o:any)=>({...o, fail_on_conflicts: e.target.checked}))}
+            /> Interrompi l'esecuzione se l'orario contiene conflitti
+          </label>
+        </div>
+        <div style={{marginTop:4}}>
+          <label>
+            <input
+              type="checkbox"
+              checked={!!options.propose_rooms}
+              onChange={(e: React.ChangeEvent<HTMLInputElement>)=>setOptions((o:any)=>({...o, propose_rooms: e.target.checked}))}
+            /> Proponi un'assegnazione delle aule (ORARIO_AULE_PROPOSTA)
+          </label>
+        </div>
       </section>
 
       <section className="card">
@@ -242,6 +313,9 @@ export default function App() {
           {status.status !== 'succeeded' && status.status !== 'failed' && (
             <div className="muted" style={{marginTop:8}}>{status.message}</div>
           )}
+          {(status.status === 'queued' || status.status === 'running') && (
+            <div style={{marginTop:8}}><button className="btn-secondary" onClick={cancelJob}>Annulla</button></div>
+          )}
           {status.status === 'failed' && (
             <>
               <div className="muted" style={{marginTop:8}}>{status.message}</div>
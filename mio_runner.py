@@ -12,6 +12,8 @@
 # ================================
 from pathlib import Path
 import re
+from dataclasses import dataclass
+import numpy as np
 import pandas as pd
 from collections import defaultdict, OrderedDict
 
@@ -524,6 +526,69 @@ def _norm_lookup_classe(classe: str) -> str:
     return s
 
 
+# ======= TESTI DELLE CELLE DEGLI ORARI SETTIMANALI (export e API) =======
+
+def materia_for(docente: str, classe_norm: str, materie_map: dict) -> str | None:
+    """Materia del docente nella classe: prova nome normalizzato, codice (ZX_...), nome grezzo."""
+    d_norm = _norm_lookup_docente(docente)
+    if d_norm and materie_map.get((d_norm, classe_norm)):
+        return materie_map[(d_norm, classe_norm)]
+    d_code = _extract_docente_code(docente)
+    if d_code and materie_map.get((d_code, classe_norm)):
+        return materie_map[(d_code, classe_norm)]
+    d_raw = tidy(docente).replace("_", " ").lower().strip()
+    if d_raw and materie_map.get((d_raw, classe_norm)):
+        return materie_map[(d_raw, classe_norm)]
+    return None
+
+def class_cell_texts(sub_df, cls_name, materie_map, known_aule):
+    """(docenti, materie, aule) di una cella (giorno, ora) dell'orario di una classe."""
+    docenti = sorted({tidy(x) for x in sub_df["docente"].tolist() if tidy(x)})
+    doc_txt = " | ".join(docenti)
+    # aule: colonna 'aula' + fallback da 'classe'
+    aule_set = {tidy(x) for x in sub_df["aula"].tolist() if tidy(x)}
+    for raw in sub_df["classe"].tolist():
+        for tok in split_tokens(raw):
+            if tok.lower() in known_aule:
+                aule_set.add(tok)
+    aul_txt = " | ".join(sorted({a for a in aule_set if a}))
+    classe_norm = _norm_lookup_classe(cls_name)
+    materie_set = {m for m in (materia_for(d, classe_norm, materie_map) for d in docenti) if m}
+    mat_txt = " | ".join(sorted(materie_set))
+    return doc_txt, mat_txt, aul_txt
+
+def room_cell_texts(sub_df, known_aule):
+    """(docenti, classi) di una cella (giorno, ora) dell'orario di un'aula."""
+    docenti = sorted({tidy(x) for x in sub_df["docente"].tolist() if tidy(x)})
+    # classi: escludi token aula e pulisci ^ / *
+    class_set = set()
+    for raw in sub_df["classe"].astype(str).tolist():
+        for t in split_tokens(raw):
+            if t.lower() in known_aule:
+                continue
+            t2 = norm_class_token(t)
+            if t2:
+                class_set.add(t2)
+    return " | ".join(docenti), " | ".join(sorted(class_set))
+
+def teacher_cell_texts(sub_df, materie_map, known_aule):
+    """(classi, materie, aule) di una cella (giorno, ora) dell'orario di un docente."""
+    classi, materie = set(), set()
+    aule_set = {tidy(x) for x in sub_df["aula"].tolist() if tidy(x)}
+    for docente, raw in sub_df[["docente", "classe"]].astype(str).itertuples(index=False):
+        for t in split_tokens(raw):
+            if t.lower() in known_aule:
+                aule_set.add(t)
+                continue
+            t2 = norm_class_token(t)
+            if t2:
+                classi.add(t2)
+                m = materia_for(docente, _norm_lookup_classe(t2), materie_map)
+                if m:
+                    materie.add(m)
+    return " | ".join(sorted(classi)), " | ".join(sorted(materie)), " | ".join(sorted(aule_set))
+
+
 # ======= INTESTAZIONE GLOBALE (richiesta a video) =======
 
 HEADER_TEXT: str | None = None  # usata da tutte le funzioni
@@ -1092,20 +1157,7 @@ def export_OUTPUT_AULE_SETTIMANALE(
             for g in giorni:
                 cell = sub[(sub["giorno"] == g) & (sub["ora"] == o)]
 
-                # docenti
-                docenti = sorted({tidy(x) for x in cell["docente"].tolist() if tidy(x)})
-                doc_txt = " | ".join(docenti)
-
-                # classi: escludi token aula e pulisci ^ / *
-                class_set = set()
-                for raw in cell["classe"].astype(str).tolist():
-                    for t in split_tokens(raw):
-                        if t.lower() in known_aule:
-                            continue
-                        t2 = norm_class_token(t)
-                        if t2:
-                            class_set.add(t2)
-                cls_txt = " | ".join(sorted(class_set))
+                doc_txt, cls_txt = room_cell_texts(cell, known_aule)
 
                 row_doc.append(doc_txt)
                 row_cls.append(cls_txt)
@@ -1175,7 +1227,7 @@ def export_OUTPUT_CLASSI_SETTIMANALE(
     xlsx_day_col_min=14.0,
     xlsx_day_col_max=60.0,
 ):
-    import re, openpyxl
+    import openpyxl
     from openpyxl.styles import Alignment, Font, PatternFill, Border, Side
     from openpyxl.utils import get_column_letter
 
@@ -1187,36 +1239,6 @@ def export_OUTPUT_CLASSI_SETTIMANALE(
     if materie_map is None:
         materie_map = {}
 
-    def _extract_docente_code(nome: str):
-        s = tidy(nome)
-        if not s: return None
-        m = re.search(r"\b([A-Za-z]{2}_[A-Za-z0-9]{3,})\b", s)
-        return m.group(1).lower() if m else None
-
-    def _strip_docente_tokens(nome: str):
-        s = tidy(nome)
-        if not s: return []
-        s = re.sub(r"\[(.*?)\]|\((.*?)\)", " ", s)
-        s = s.replace("_", " ")
-        tokens = re.split(r"[,\s;:/\-]+", s)
-        out = []
-        for t in tokens:
-            t0 = t.strip()
-            if not t0: continue
-            if t0.upper().rstrip(".") in {"COE","PT","SUPP","SUP","POTENZIAMENTO"}:
-                continue
-            if any(ch.isdigit() for ch in t0):
-                continue
-            if re.fullmatch(r"[A-Za-zÀ-ÖØ-öø-ÿ]+", t0):
-                out.append(t0)
-        return out
-
-    def _norm_lookup_docente(nome: str) -> str:
-        toks = _strip_docente_tokens(nome)
-        if not toks: return ""
-        full = " ".join(toks).lower().strip()
-        return full if full else toks[-1].lower().strip()
-
     def _get_indirizzo_for(cls_name: str) -> str:
         if "Indirizzo" in df_classi.columns:
             s = df_classi.loc[df_classi["Classe"].astype(str)==cls_name, "Indirizzo"]
@@ -1260,36 +1282,6 @@ def export_OUTPUT_CLASSI_SETTIMANALE(
     giorni = list(df_only["giorno"].cat.categories)
     ore    = list(df_only["ora"].cat.categories)
 
-    def _texts_for_cell(sub_df, cls_name, g, o):
-        # docenti
-        docenti = sorted({tidy(x) for x in sub_df["docente"].tolist() if tidy(x)})
-        doc_txt = " | ".join(docenti)
-        # aule: colonna 'aula' + fallback da 'classe'
-        aule_set = {tidy(x) for x in sub_df["aula"].tolist() if tidy(x)}
-        for raw in sub_df["classe"].tolist():
-            for tok in split_tokens(raw):
-                if tok.lower() in known_aule:
-                    aule_set.add(tok)
-        aul_txt = " | ".join(sorted({a for a in aule_set if a}))
-        # materie
-        materie_set = set()
-        classe_norm = _norm_lookup_classe(cls_name)
-        for d in docenti:
-            d_norm = _norm_lookup_docente(d)
-            if d_norm:
-                m = materie_map.get((d_norm, classe_norm))
-                if m: materie_set.add(m); continue
-            d_code = _extract_docente_code(d)
-            if d_code:
-                m = materie_map.get((d_code, classe_norm))
-                if m: materie_set.add(m); continue
-            d_raw = tidy(d).replace("_"," ").lower().strip()
-            if d_raw:
-                m = materie_map.get((d_raw, classe_norm))
-                if m: materie_set.add(m)
-        mat_txt = " | ".join(sorted(materie_set))
-        return doc_txt, mat_txt, aul_txt
-
     # ---------------- Excel (unico foglio) ----------------
     wb = openpyxl.Workbook()
     ws = wb.active
@@ -1373,7 +1365,7 @@ def export_OUTPUT_CLASSI_SETTIMANALE(
 
             for g in giorni:
                 cell = sub[(sub["giorno"] == g) & (sub["ora"] == o)]
-                doc_txt, mat_txt, aul_txt = _texts_for_cell(cell, cls, g, o)
+                doc_txt, mat_txt, aul_txt = class_cell_texts(cell, cls, materie_map, known_aule)
                 row_doc.append(doc_txt)
                 row_mat.append(mat_txt)
                 row_aul.append(aul_txt)
@@ -3051,7 +3043,8 @@ def load_aule_capienze(tabella_aule_path, sheet_name=0):
 
 def load_tabella_classi(tabella_classi_path, sheet_name=0):
     """
-    Legge Tabella_Classi e restituisce DataFrame con colonne ['Edificio','Classe'].
+    Legge Tabella_Classi e restituisce DataFrame con colonne ['Edificio','Classe']
+    (più 'Alunni' se il file ha una colonna Alunni/Studenti/Iscritti).
     Riconosce 'Edificio/Plesso/Sede' e 'Classe' come intestazioni.
     """
     import pandas as pd
@@ -3072,6 +3065,8 @@ def load_tabella_classi(tabella_classi_path, sheet_name=0):
         lc = c.strip().lower()
         if lc in {"edificio","plesso","sede"}: col_map[c] = "Edificio"
         elif lc == "classe":                   col_map[c] = "Classe"
+        elif lc in {"alunni","studenti","iscritti","n. alunni","numero alunni"} and "Alunni" not in col_map.values():
+            col_map[c] = "Alunni"
     df = df.rename(columns=col_map)
 
     if not {"Edificio","Classe"} <= set(df.columns):
@@ -3085,6 +3080,9 @@ def load_tabella_classi(tabella_classi_path, sheet_name=0):
     df["Edificio"] = df["Edificio"].apply(tidy)
     df["Classe"]   = df["Classe"].apply(tidy)
     df = df[(df["Classe"]!="")].reset_index(drop=True)
+    if "Alunni" in df.columns:
+        df["Alunni"] = pd.to_numeric(df["Alunni"], errors="coerce").astype("Int64")
+        return df[["Edificio","Classe","Alunni"]]
     return df[["Edificio","Classe"]]
 
 
@@ -3236,55 +3234,1009 @@ def run_with_delay(fn, *args, delay=DELAY_SECONDS, retries=RETRY_COUNT, **kwargs
 # # files.download(archive_base + ".zip")
 
 
+# ======= CONTROLLO CONFLITTI (dopo la lettura, prima degli export) =======
+
+def find_conflicts(df_all, classi=None) -> list[dict]:
+    """
+    Incoerenze dell'orario in un solo passaggio sulle righe "esplose" (una per classe x aula):
+    - "docente": stesso docente in due aule diverse nella stessa ora;
+    - "aula": nella stessa aula e ora docenti con classi diverse (la compresenza,
+      cioè stesse classi nella stessa aula, è ammessa);
+    - "classe": stessa classe in due aule diverse nella stessa ora.
+    Le righe di sostegno contano solo per il controllo "docente". `classi` limita i
+    controlli aula/classe alle classi di Tabella_Classi (come gli export).
+    Ritorna [{tipo, giorno, ora, nome, righe: [{docente, classe, aula}]}] in ordine di orario.
+    """
+    valid = {_norm_lookup_classe(c) for c in classi} if classi is not None else None
+    rows = pd.DataFrame({
+        "docente": df_all["docente"].map(tidy),
+        "classe": df_all["classe"].map(tidy),
+        "aula": df_all["aula"].map(tidy),
+        "giorno": df_all["giorno"].astype(str),
+        "ora": df_all["ora"].astype(str),
+        "sostegno": df_all["is_sostegno"].astype(str).str.strip().str.lower().isin({"true", "1"}),
+    })
+    rows["riga"] = range(len(rows))
+    rows["classe_k"] = rows["classe"].map(
+        lambda c: [k for k in ParsedInputs.class_keys(c) if valid is None or k in valid] or [None])
+    rows["aula_k"] = rows["aula"].map(lambda a: [t.lower() for t in split_tokens(a)] or [None])
+    ex = rows.explode("classe_k").explode("aula_k")
+    slot = ["giorno", "ora"]
+    found = []  # (tipo, chiave, giorno, ora)
+
+    # docente in due aule
+    t = ex[(ex["docente"] != "") & ex["aula_k"].notna()]
+    n = t.groupby(["docente", *slot])["aula_k"].nunique()
+    found += [("docente", d, g, o) for d, g, o in n[n > 1].index]
+
+    lessons = ex[~ex["sostegno"] & ex["classe_k"].notna() & ex["aula_k"].notna()]
+    # classe in due aule
+    n = lessons.groupby(["classe_k", *slot])["aula_k"].nunique()
+    found += [("classe", c, g, o) for c, g, o in n[n > 1].index]
+    # aula con docenti di classi diverse: firma = insieme delle classi del docente in quell'aula
+    sig = (lessons.groupby(["aula_k", *slot, "docente"])["classe_k"]
+           .agg(lambda s: "|".join(sorted(set(s)))))
+    n = sig.groupby(level=["aula_k", *slot]).nunique()
+    found += [("aula", a, g, o) for a, g, o in n[n > 1].index]
+
+    if not found:
+        return []
+    key_col = {"docente": "docente", "classe": "classe_k", "aula": "aula_k"}
+    order_g = {str(g): i for i, g in enumerate(df_all["giorno"].cat.categories)} \
+        if hasattr(df_all["giorno"], "cat") else {}
+    out = []
+    for tipo, nome, g, o in found:
+        sel = ex[(ex[key_col[tipo]] == nome) & (ex["giorno"] == g) & (ex["ora"] == o)]
+        if tipo != "docente":
+            sel = sel[~sel["sostegno"]]
+        righe = rows.loc[rows["riga"].isin(sel["riga"]), ["docente", "classe", "aula"]]
+        out.append({"tipo": tipo, "giorno": g, "ora": o, "nome": nome if tipo == "docente" else nome.upper(),
+                    "righe": righe.to_dict("records")})
+    out.sort(key=lambda c: (order_g.get(c["giorno"], 99), int(c["ora"]) if c["ora"].isdigit() else 99,
+                            c["tipo"], c["nome"]))
+    return out
+
+
+# ======= PROPOSTA ASSEGNAZIONE AULE (abbinamento a costo minimo per ogni ora) =======
+
+ASSIGN_MOVE_COST = 100.0        # spostare una classe dalla sua aula attuale
+ASSIGN_WASTE_COST = 1.0         # per ogni posto vuoto (solo con numero di alunni noto)
+ASSIGN_UNPLACED_COST = 1e6      # nessuna aula adatta: la classe resta dov'è (segnalata)
+ASSIGN_FORBIDDEN_COST = 1e9     # classe più numerosa della capienza
+
+
+def linear_sum_assignment(cost) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Abbinamento righe -> colonne a costo totale minimo (algoritmo ungherese con
+    potenziali, O(n^2 m) con il ciclo interno su array NumPy). Stessa interfaccia di
+    scipy.optimize.linear_sum_assignment: ritorna (righe, colonne) ordinate per riga.
+    """
+    cost = np.asarray(cost, dtype=float)
+    transposed = cost.shape[0] > cost.shape[1]
+    if transposed:
+        cost = cost.T
+    n, m = cost.shape
+    u, v = np.zeros(n + 1), np.zeros(m + 1)
+    p = np.zeros(m + 1, dtype=int)    # p[j] = riga (1-based) abbinata alla colonna j, 0 = libera
+    way = np.zeros(m + 1, dtype=int)
+    for i in range(1, n + 1):
+        p[0], j0 = i, 0
+        minv = np.full(m + 1, np.inf)
+        used = np.zeros(m + 1, dtype=bool)
+        while True:
+            used[j0] = True
+            free = ~used[1:]
+            cur = cost[p[j0] - 1] - u[p[j0]] - v[1:]
+            better = free & (cur < minv[1:])
+            minv[1:][better] = cur[better]
+            way[1:][better] = j0
+            cand = np.where(free, minv[1:], np.inf)
+            j1 = int(np.argmin(cand)) + 1
+            delta = cand[j1 - 1]
+            u[p[used]] += delta
+            v[used] -= delta
+            minv[~used] -= delta
+            j0 = j1
+            if p[j0] == 0:
+                break
+        while j0:
+            p[j0] = p[way[j0]]
+            j0 = way[j0]
+    cols = np.nonzero(p[1:])[0]
+    rows = p[1:][cols] - 1
+    if transposed:
+        rows, cols = cols, rows
+    order = np.argsort(rows)
+    return rows[order], cols[order]
+
+
+def _slot_units(rows, valid, room_of):
+    """
+    Unità da collocare in un'ora di un plesso: classi unite quando condividono un docente
+    (compresenza, classi articolate), con le aule attuali. Ritorna (unità, aule bloccate):
+    unità = [(classi, aule attuali, righe)]; le aule bloccate restano a chi le occupa
+    (righe senza classe di Tabella_Classi, aule fuori da Tabella_Aule del plesso).
+    """
+    parent = {}
+
+    def find(k):
+        while parent.setdefault(k, k) != k:
+            parent[k] = parent[parent[k]]
+            k = parent[k]
+        return k
+
+    blocked, members = set(), []
+    for riga, classe, aula in rows:
+        toks = [t.lower() for t in split_tokens(aula)]
+        keys = [k for k in ParsedInputs.class_keys(classe) if k in valid]
+        if not keys:
+            blocked.update(t for t in toks if t in room_of)
+            continue
+        for k in keys[1:]:
+            parent[find(k)] = find(keys[0])
+        members.append((keys[0], riga, toks))
+    groups = defaultdict(lambda: (set(), set(), []))
+    for k0, riga, toks in members:
+        classi, aule, righe = groups[find(k0)]
+        aule.update(toks)
+        righe.append(riga)
+    for k in parent:
+        groups[find(k)][0].add(k)
+    units = []
+    for classi, aule, righe in groups.values():
+        if not aule:
+            continue  # senza aula (es. palestra, uscite): non si tocca
+        if any(t not in room_of for t in aule):
+            blocked.update(t for t in aule if t in room_of)  # laboratori e aule fuori tabella: fisse
+            continue
+        units.append((sorted(classi), aule, righe))
+    return units, blocked
+
+
+def _slot_cost(units, rooms, blocked, sizes):
+    """Matrice dei costi unità x (aule del plesso + una colonna "resta dov'è" per unità)."""
+    cost = np.full((len(units), len(rooms) + len(units)), ASSIGN_FORBIDDEN_COST)
+    caps = np.array([np.nan if cap is None else cap for _aula, cap in rooms], dtype=float)
+    free = np.array([aula.lower() not in blocked for aula, _cap in rooms])
+    for i, (classi, aule, _righe) in enumerate(units):
+        row = np.where([aula.lower() in aule for aula, _cap in rooms], 0.0, ASSIGN_MOVE_COST)
+        if all(k in sizes for k in classi):
+            alunni = sum(sizes[k] for k in classi)
+            known = ~np.isnan(caps)
+            row[known] += (caps[known] - alunni) * ASSIGN_WASTE_COST
+            row[known & (caps < alunni)] = ASSIGN_FORBIDDEN_COST
+        row[~free] = ASSIGN_FORBIDDEN_COST
+        cost[i, :len(rooms)] = row
+        cost[i, len(rooms) + i] = ASSIGN_UNPLACED_COST
+    return cost
+
+
+def propose_room_assignment(df_all, df_aule, classi, class_sizes=None, workers: int = 1):
+    """
+    Proposta di assegnazione delle aule, ora per ora e plesso per plesso.
+    Per ogni (giorno, ora) le classi del plesso (unite in compresenza) vengono abbinate
+    alle aule di Tabella_Aule del plesso a costo minimo: restare nell'aula attuale è
+    gratis, spostarsi costa ASSIGN_MOVE_COST, con il numero di alunni noto (class_sizes o
+    colonna "Alunni" di Tabella_Classi) le aule troppo piccole sono escluse e si preferisce
+    quella con meno posti vuoti. Due classi nella stessa aula ne ricevono due diverse.
+    Le righe di sostegno seguono la classe; laboratori, aule fuori tabella e righe
+    senza aula restano come sono.
+    workers > 1 risolve le ore in parallelo su più processi (utile solo con orari grandi).
+    Ritorna (copia di df_all con la colonna "aula_proposta", [spostamenti]).
+    """
+    valid = {_norm_lookup_classe(c) for c in classi}
+    sizes = dict(class_sizes or {})
+    sizes = {_norm_lookup_classe(k): int(v) for k, v in sizes.items() if str(v).strip().isdigit()}
+    rooms_by_plesso = defaultdict(list)
+    seen = set()
+    for aula, plesso, cap in df_aule[["Aula", "Plesso", "Capienza"]].itertuples(index=False):
+        aula = tidy(aula)
+        if aula and aula.lower() not in seen:
+            seen.add(aula.lower())
+            m = re.search(r"\d+", tidy(cap))
+            rooms_by_plesso[tidy(plesso).lower()].append((aula, int(m.group(0)) if m else None))
+
+    rows = pd.DataFrame({
+        "plesso": df_all["plesso"].map(tidy).str.lower(),
+        "classe": df_all["classe"].map(tidy),
+        "aula": df_all["aula"].map(tidy),
+        "giorno": df_all["giorno"].astype(str),
+        "ora": df_all["ora"].astype(str),
+        "sostegno": df_all["is_sostegno"].astype(str).str.strip().str.lower().isin({"true", "1"}),
+    })
+    rows["riga"] = range(len(rows))
+    labels = {p.lower(): p for p in df_all["plesso"].map(tidy).unique()}
+    problems = []  # (plesso, giorno, ora, unità, aule, costi)
+    lessons = rows[~rows["sostegno"] & (rows["plesso"] != "")]
+    for (plesso, g, o), sub in lessons.groupby(["plesso", "giorno", "ora"], sort=False):
+        rooms = rooms_by_plesso.get(plesso)
+        if not rooms:
+            continue
+        room_of = {aula.lower() for aula, _cap in rooms}
+        units, blocked = _slot_units(sub[["riga", "classe", "aula"]].itertuples(index=False), valid, room_of)
+        if units:
+            problems.append((plesso, g, o, units, rooms, _slot_cost(units, rooms, blocked, sizes)))
+
+    costs = [p[5] for p in problems]
+    if workers > 1 and len(costs) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            solutions = list(pool.map(linear_sum_assignment, costs, chunksize=max(1, len(costs) // (4 * workers))))
+    else:
+        solutions = [linear_sum_assignment(c) for c in costs]
+
+    proposta = rows["aula"].tolist()
+    by_class = {}  # (giorno, ora, classe) -> (aule attuali, aula proposta)
+    moves = []
+    for (plesso, g, o, units, rooms, _cost), (r_ind, c_ind) in zip(problems, solutions):
+        for i, j in zip(r_ind, c_ind):
+            classi, aule, righe = units[i]
+            da = " | ".join(sorted(rows["aula"].iat[r] for r in righe if rows["aula"].iat[r]))
+            if j >= len(rooms):
+                moves.append({"giorno": g, "ora": o, "plesso": labels[plesso],
+                              "classi": [k.upper() for k in classi], "da": da, "a": None,
+                              "nota": "nessuna aula libera adatta"})
+                continue
+            aula = rooms[j][0]
+            for r in righe:
+                if proposta[r]:
+                    proposta[r] = aula
+            for k in classi:
+                by_class[(g, o, k)] = (aule, aula)
+            if aule != {aula.lower()}:
+                moves.append({"giorno": g, "ora": o, "plesso": labels[plesso],
+                              "classi": [k.upper() for k in classi], "da": da, "a": aula})
+
+    # sostegno: segue la classe se era nella sua aula (o senza aula)
+    for riga, classe, aula, g, o in rows.loc[rows["sostegno"], ["riga", "classe", "aula", "giorno", "ora"]].itertuples(index=False):
+        toks = {t.lower() for t in split_tokens(aula)}
+        for k in ParsedInputs.class_keys(classe):
+            hit = by_class.get((g, o, k))
+            if hit and (not toks or toks <= hit[0]):
+                proposta[riga] = hit[1]
+                break
+
+    out = df_all.copy()
+    out["aula_proposta"] = proposta
+    return out, moves
+
+
+ROOM_PROPOSAL_STAGE = "ORARIO_AULE_PROPOSTA"
+ROOM_PROPOSAL_FILE = "PROPOSTA_AULE.json"
+
+
+# ======= CONFRONTO TRA DUE ORARI (es. due settimane di orario provvisorio) =======
+
+def schedule_facts(df_all) -> set[tuple[str, str, str, str, str]]:
+    """
+    Le lezioni come insieme di fatti (docente, classe, aula, giorno, ora), normalizzati
+    come negli export: classi senza ^ e * (chiavi di _norm_lookup_classe, in maiuscolo),
+    aule e classi con più token in ordine fisso. Righe senza docente escluse.
+    """
+    def norm(col, fn):  # una volta per valore distinto: le celle si ripetono molto
+        values = df_all[col].astype(str)
+        return values.map({v: fn(v) for v in values.unique()})
+    docente = norm("docente", lambda d: " ".join(tidy(d).split()))
+    classe = norm("classe", lambda c: " | ".join(sorted({k.upper() for k in ParsedInputs.class_keys(c)}) or [tidy(c)]))
+    aula = norm("aula", lambda a: " | ".join(sorted({t.upper() for t in split_tokens(tidy(a))})))
+    keep = docente != ""
+    return set(zip(docente[keep], classe[keep], aula[keep],
+                   df_all["giorno"].astype(str)[keep], df_all["ora"].astype(str)[keep]))
+
+
+def diff_schedules(old: "ParsedInputs", new: "ParsedInputs") -> dict:
+    """
+    Cosa cambia passando dall'orario `old` a `new`, per differenza tra insiemi di fatti
+    (vedi schedule_facts). Le lezioni dello stesso docente nella stessa ora tolte da una
+    parte e aggiunte dall'altra sono "modificate" (cambio di aula o classe).
+    Ritorna {conteggi, aggiunte, rimosse, modificate: [{prima, dopo}], ristampe:
+    {classi, docenti, aule}}: ristampe sono le entità i cui orari vanno ristampati.
+    """
+    before, after = schedule_facts(old.df_all), schedule_facts(new.df_all)
+    removed, added = before - after, after - before
+
+    def slot_key(f):
+        return f[0], f[3], f[4]
+    removed_at, added_at = defaultdict(list), defaultdict(list)
+    for f in removed:
+        removed_at[slot_key(f)].append(f)
+    for f in added:
+        added_at[slot_key(f)].append(f)
+    changed = []
+    for key in removed_at.keys() & added_at.keys():
+        if len(removed_at[key]) == len(added_at[key]) == 1:
+            changed.append((removed_at.pop(key)[0], added_at.pop(key)[0]))
+
+    giorni = {str(g): i for i, g in enumerate([*new.giorni, *old.giorni])}
+    order = lambda f: (giorni.get(f[3], 99), int(f[4]) if f[4].isdigit() else 99, f[0], f[1])
+    as_dict = lambda f: dict(zip(("docente", "classe", "aula", "giorno", "ora"), f))
+
+    classi = {_norm_lookup_classe(c): c for p in (old, new) for c in p.classes()}
+    aule = {aula.lower(): aula for p in (old, new) for aula, _plesso, _cap in p.rooms()}
+    reissue = {"classi": set(), "docenti": set(), "aule": set()}
+    for f in removed | added:
+        reissue["docenti"].add(f[0])
+        reissue["classi"].update(classi[k] for k in ParsedInputs.class_keys(f[1]) if k in classi)
+        reissue["aule"].update(aule[t.lower()] for t in split_tokens(f[2]) if t.lower() in aule)
+
+    aggiunte = sorted((f for fs in added_at.values() for f in fs), key=order)
+    rimosse = sorted((f for fs in removed_at.values() for f in fs), key=order)
+    changed.sort(key=lambda pair: order(pair[1]))
+    return {
+        "conteggi": {"prima": len(before), "dopo": len(after), "aggiunte": len(aggiunte),
+                     "rimosse": len(rimosse), "modificate": len(changed)},
+        "aggiunte": [as_dict(f) for f in aggiunte],
+        "rimosse": [as_dict(f) for f in rimosse],
+        "modificate": [{"prima": as_dict(a), "dopo": as_dict(b)} for a, b in changed],
+        "ristampe": {k: sorted(v) for k, v in reissue.items()},
+    }
+
+
+def export_OUTPUT_MODIFICHE(diff: dict, dest, titolo: str = "Modifiche all'orario"):
+    """
+    Workbook del confronto (vedi diff_schedules): foglio "Modifiche" con una riga per
+    lezione aggiunta, rimossa o modificata, foglio "Ristampe" con gli orari da ristampare.
+    dest: percorso o file binario aperto.
+    """
+    import openpyxl
+    from openpyxl.utils import get_column_letter
+    fill_header, _, alt_fill = excel_get_fills()
+    wb = openpyxl.Workbook()
+
+    def sheet(ws, header, rows, widths):
+        ws.append([titolo])
+        ws.merge_cells(start_row=1, start_column=1, end_row=1, end_column=len(header))
+        ws.cell(row=1, column=1).font = Font(bold=True, italic=True)
+        ws.append(header)
+        for c in range(1, len(header) + 1):
+            ws.cell(row=1, column=c).fill = fill_header
+            ws.cell(row=2, column=c).fill = fill_header
+            ws.cell(row=2, column=c).font = Font(bold=True)
+        for i, row in enumerate(rows):
+            ws.append(row)
+            if i % 2:
+                for c in range(1, len(header) + 1):
+                    ws.cell(row=ws.max_row, column=c).fill = alt_fill
+        for c, w in enumerate(widths, 1):
+            ws.column_dimensions[get_column_letter(c)].width = w
+        ws.freeze_panes = "A3"
+
+    rows = []
+    for tipo, facts in (("Aggiunta", diff["aggiunte"]), ("Rimossa", diff["rimosse"])):
+        for f in facts:
+            prima = f if tipo == "Rimossa" else {}
+            dopo = f if tipo == "Aggiunta" else {}
+            rows.append([tipo, f["giorno"], f["ora"], f["docente"], prima.get("classe", ""), dopo.get("classe", ""),
+                         prima.get("aula", ""), dopo.get("aula", "")])
+    for m in diff["modificate"]:
+        a, b = m["prima"], m["dopo"]
+        rows.append(["Modificata", b["giorno"], b["ora"], b["docente"], a["classe"], b["classe"], a["aula"], b["aula"]])
+    giorni = list(OrderedDict.fromkeys(f["giorno"] for f in [*diff["aggiunte"], *diff["rimosse"],
+                                                             *(m["dopo"] for m in diff["modificate"])]))
+    rows.sort(key=lambda r: (giorni.index(r[1]), int(r[2]) if str(r[2]).isdigit() else 99, r[3]))
+    ws = wb.active
+    ws.title = "Modifiche"
+    sheet(ws, ["Tipo", "Giorno", "Ora", "Docente", "Classe prima", "Classe dopo", "Aula prima", "Aula dopo"], rows,
+          [12, 12, 6, 24, 14, 14, 12, 12])
+
+    ristampe = [[tipo, nome] for tipo, key in (("Classe", "classi"), ("Docente", "docenti"), ("Aula", "aule"))
+                for nome in diff["ristampe"][key]]
+    sheet(wb.create_sheet("Ristampe"), ["Tipo", "Nome"], ristampe, [12, 28])
+    wb.save(dest)
+
+
 # ================================
 # Entrypoint per integrazione con FastAPI adapter
 # ================================
-def main(input_paths: list[str], output_dir: str, **options) -> int:
+CONFLICTS_FILE = "CONFLITTI_ORARIO.json"
+
+EXPORT_STAGES = (
+    "ORARIO_CLASSI_SETTIMANALE",
+    "ORARIO_AULE_SETTIMANALE",
+    "ORARIO_TABELLA_GLOBALE",
+    "ORARIO_AULE_COMPATTO_SUCCURSALE",
+    "ORARIO_AULE_COMPATTO_CENTRALE",
+    "ORARIO_CLASSI_COMPATTO_SUCCURSALE",
+    "ORARIO_CLASSI_COMPATTO_CENTRALE",
+    "ORARIO_TABELLA_SUCCURSALE",
+    "ORARIO_TABELLA_CENTRALE",
+    "ORARIO_AULE_LIBERE_CENTRALE",
+    "ORARIO_AULE_LIBERE_SUCCURSALE",
+)
+# Export che una rigenerazione parziale (opzione "only") limita alle entità indicate
+PARTIAL_STAGES = {
+    "ORARIO_CLASSI_SETTIMANALE": lambda only: bool(only.get("classi")),
+    "ORARIO_AULE_SETTIMANALE": lambda only: bool(only.get("aule")),
+    "ORARIO_AULE_LIBERE_CENTRALE": lambda only: "centrale" in {p.lower() for p in only.get("plessi") or []},
+    "ORARIO_AULE_LIBERE_SUCCURSALE": lambda only: "succursale" in {p.lower() for p in only.get("plessi") or []},
+}
+
+
+# i fogli settimanali di una rigenerazione parziale contengono solo alcuni blocchi:
+# nome diverso, così non si confondono con (né sostituiscono) quelli completi
+PARTIAL_SUFFIX = "_PARZIALE"
+
+
+def _partial_stage(name: str, only: dict) -> bool:
+    return name in PARTIAL_STAGES and PARTIAL_STAGES[name](only)
+
+
+LOADER_STAGES = tuple(f"Lettura {n}" for n in ("Tabella_Aule", "Centrale", "Succursale",
+                                                "Tabella_Classi", "Tabella_Materie", "Tabella_Sostegno"))
+
+
+class JobCancelled(Exception):
+    """Il job è stato annullato (o ha superato il tempo massimo) tra due fasi."""
+
+
+# ================================
+# Avanzamento (progress) verso l'adapter
+# ================================
+# Protocollo: progress_callback(stage, index, total, elapsed) chiamato all'inizio
+# di ogni fase (index 1-based, elapsed = secondi dall'avvio di main).
+# In modalità subprocess le stesse informazioni escono su stdout come riga JSON
+# {"progress": {"stage": ..., "index": ..., "total": ..., "elapsed": ...}}.
+def _progress_reporter(progress_callback, total: int, cancel_event=None):
+    """
+    Ritorna report(stage) che numera le fasi e misura il tempo trascorso.
+    Prima di ogni fase controlla cancel_event e solleva JobCancelled se impostato.
+    """
+    t0 = time.monotonic()
+    state = {"index": 0}
+
+    def report(stage: str):
+        if cancel_event is not None and cancel_event.is_set():
+            raise JobCancelled(stage)
+        state["index"] += 1
+        if progress_callback is not None:
+            progress_callback(stage, state["index"], total, round(time.monotonic() - t0, 2))
+    return report
+
+
+def _print_progress_json(stage: str, index: int, total: int, elapsed: float):
+    """progress_callback per la modalità subprocess: una riga JSON su stdout."""
+    import json
+    print(json.dumps({"progress": {"stage": stage, "index": index, "total": total, "elapsed": elapsed}}), flush=True)
+
+
+# ================================
+# Lettura input (riutilizzabile: l'app la anticipa al momento del caricamento)
+# ================================
+# File richiesti: ruolo -> nomi accettati (case-insensitive)
+INPUT_FILES = {
+    "Centrale.xlsx": ("centrale.xlsx",),
+    "Succursale.xlsx": ("succursale.xlsx",),
+    "Tabella_Aule.xlsx": ("tabella_aule.xlsx", "aule.xlsx"),
+    "Tabella_Classi.xlsx": ("tabella_classi.xlsx", "classi.xlsx"),
+    "Tabella_Materie.xlsx": ("tabella_materie.xlsx", "materie.xlsx"),
+    "Tabella_Sostegno.xlsx": ("tabella_sostegno.xlsx", "sostegno.xlsx"),
+}
+
+
+def resolve_inputs(input_paths) -> tuple[dict, list[str]]:
+    """Ritorna ({ruolo: Path}, [ruoli mancanti]) per la lista di file caricati."""
+    name_map = {Path(p).name.lower(): Path(p) for p in input_paths}
+    found, missing = {}, []
+    for role, candidates in INPUT_FILES.items():
+        p = next((name_map[c] for c in candidates if c in name_map), None)
+        if p is None:
+            missing.append(role)
+        else:
+            found[role] = p
+    return found, missing
+
+
+# Operazioni ammesse da ParsedInputs.apply_edits
+EDIT_OPS = ("add", "remove", "move")
+
+
+def _category_value(col: pd.Series, value):
+    """Il valore come categoria della colonna (le ore sono categorie intere, i parametri stringhe)."""
+    if isinstance(col.dtype, pd.CategoricalDtype):
+        return next((c for c in col.cat.categories if str(c) == str(value)), value)
+    return value
+
+
+def _append_row(df: pd.DataFrame, row: dict) -> pd.DataFrame:
+    """df con una riga in più, mantenendo le colonne categoriche (giorno, ora)."""
+    new = pd.DataFrame([{c: _category_value(df[c], row.get(c, "")) for c in df.columns}])
+    for c in df.columns:
+        if isinstance(df[c].dtype, pd.CategoricalDtype):
+            new[c] = pd.Categorical(new[c], categories=df[c].cat.categories, ordered=df[c].cat.ordered)
+        else:
+            new[c] = new[c].astype(df[c].dtype)
+    return pd.concat([df, new], ignore_index=True)
+
+
+@dataclass
+class ParsedInputs:
+    """Tutto ciò che gli export leggono dagli input, già normalizzato."""
+    df_aule: pd.DataFrame
+    df_centrale: pd.DataFrame
+    df_succ: pd.DataFrame
+    df_classi: pd.DataFrame
+    materie_map: dict
+    df_all: pd.DataFrame  # centrale + succursale con sostegno integrato
+    giorni: list
+    ore: list
+
+    def copy(self) -> "ParsedInputs":
+        """Copia indipendente: gli export possono modificare i DataFrame senza toccare la cache."""
+        return ParsedInputs(
+            df_aule=self.df_aule.copy(), df_centrale=self.df_centrale.copy(), df_succ=self.df_succ.copy(),
+            df_classi=self.df_classi.copy(), materie_map=dict(self.materie_map), df_all=self.df_all.copy(),
+            giorni=list(self.giorni), ore=list(self.ore),
+        )
+
+    # --- viste per le interrogazioni dell'app (aule libere, ecc.) ---
+    def rooms(self) -> list[tuple[str, str, int | None]]:
+        """(aula, plesso, capienza) per ogni aula di Tabella_Aule, senza duplicati."""
+        seen, out = set(), []
+        for aula, plesso, cap in self.df_aule[["Aula", "Plesso", "Capienza"]].itertuples(index=False):
+            aula = tidy(aula)
+            if aula and aula not in seen:
+                seen.add(aula)
+                m = re.search(r"\d+", tidy(cap))
+                out.append((aula, tidy(plesso), int(m.group(0)) if m else None))
+        return out
+
+    def room_occupancy(self):
+        """
+        (plesso, aula, giorno, ora) per ogni aula occupata, con le stesse regole di
+        export_OUTPUT_AULE_LIBERE: orario del plesso, celle aula divise con split_tokens.
+        """
+        for plesso, df in (("Centrale", self.df_centrale), ("Succursale", self.df_succ)):
+            for aula, giorno, ora in df[["aula", "giorno", "ora"]].astype(str).itertuples(index=False):
+                for tok in split_tokens(aula):
+                    yield plesso, tok, giorno, ora
+
+    def classes(self) -> list[str]:
+        """Le classi di Tabella_Classi, nell'ordine del file."""
+        return [c for c in (tidy(x) for x in self.df_classi["Classe"]) if c]
+
+    @staticmethod
+    def class_keys(cell) -> list[str]:
+        """Chiavi di confronto delle classi in una cella (come _norm_lookup_classe, senza ^ e *)."""
+        return [k for k in (_norm_lookup_classe(t) for t in split_tokens(tidy(cell))) if k]
+
+    def timetable(self, kind: str, name: str) -> dict | None:
+        """
+        Orario settimanale di una "classe", un "docente" o un'"aula", con gli stessi
+        testi delle celle di ORARIO_CLASSI_SETTIMANALE / ORARIO_AULE_SETTIMANALE.
+        celle[ora][giorno] è la lista dei testi nell'ordine di `righe`, o None se vuota.
+        None se il nome non esiste.
+        """
+        df = self.df_all
+        aule_tab = {str(a).strip().lower() for a in self.df_aule["Aula"].dropna() if str(a).strip()}
+        known_aule = aule_tab | {str(a).strip().lower() for a in df["aula"].dropna() if str(a).strip()}
+        if kind == "classe":
+            allowed = {_norm_lookup_classe(c): c for c in self.classes()}
+            key = _norm_lookup_classe(name)
+            if key not in allowed:
+                return None
+
+            def clean_class(raw):  # come export_OUTPUT_CLASSI_SETTIMANALE
+                toks = [_norm_lookup_classe(t) for t in split_tokens(raw) if t.lower() not in known_aule]
+                return " | ".join(t for t in toks if t in allowed)
+
+            sub = df.assign(classe=df["classe"].astype(str).map(clean_class))
+            sub = sub[sub["classe"] == key]
+            nome, righe = allowed[key], ["Docente", "Materia", "Aula"]
+            texts = lambda cell: class_cell_texts(cell, nome, self.materie_map, known_aule)
+        elif kind == "aula":
+            allowed = {str(a).strip().lower(): str(a).strip() for a in self.df_aule["Aula"].dropna() if str(a).strip()}
+            key = str(name).strip().lower()
+            if key not in allowed:
+                return None
+
+            def has_room(aula, classe):  # come export_OUTPUT_AULE_SETTIMANALE
+                toks = [t.lower() for t in split_tokens(aula) if t.lower() in aule_tab]
+                return key in (toks or [t.lower() for t in split_tokens(classe) if t.lower() in aule_tab])
+
+            mask = [has_room(a, c) for a, c in df[["aula", "classe"]].astype(str).itertuples(index=False)]
+            sub = df[mask]
+            nome, righe = allowed[key], ["Docente", "Classe"]
+            texts = lambda cell: room_cell_texts(cell, aule_tab)
+        elif kind == "docente":
+            key = " ".join(str(name).split()).casefold()
+            docenti = df["docente"].map(tidy)
+            sub = df[docenti.str.casefold() == key]
+            if sub.empty:
+                return None
+            nome, righe = tidy(sub["docente"].iloc[0]), ["Classe", "Materia", "Aula"]
+            texts = lambda cell: teacher_cell_texts(cell, self.materie_map, known_aule)
+        else:
+            raise ValueError(f"tipo di orario non valido: {kind}")
+
+        by_slot = {(str(g), str(o)): cell for (g, o), cell in sub.groupby(["giorno", "ora"], observed=True)}
+        celle = []
+        for o in self.ore:
+            row = []
+            for g in self.giorni:
+                cell = by_slot.get((str(g), str(o)))
+                vals = list(texts(cell)) if cell is not None else None
+                row.append(vals if vals and any(vals) else None)
+            celle.append(row)
+        return {
+            "tipo": kind, "nome": nome, "giorni": [str(g) for g in self.giorni],
+            "ore": [{"ora": str(o), "inizio": ORE_MAP.get(int(o), str(o)) if str(o).isdigit() else str(o)}
+                    for o in self.ore],
+            "righe": righe, "celle": celle,
+        }
+
+    def search_terms(self):
+        """
+        (tipo, nome, termini) per docenti, classi e aule, con le normalizzazioni degli export:
+        nome del docente senza COE/PT/..., codice ZX_..., chiave classe, nome aula.
+        """
+        for docente in sorted({tidy(d) for d in self.df_all["docente"] if tidy(d)}):
+            terms = {_norm_lookup_docente(docente), _extract_docente_code(docente), docente.lower()}
+            yield "teacher", docente, sorted(t for t in terms if t)
+        for classe in self.classes():
+            yield "class", classe, [_norm_lookup_classe(classe)]
+        for aula, _plesso, _cap in self.rooms():
+            yield "room", aula, [aula.lower()]
+
+    def conflicts(self, slots=None) -> list[dict]:
+        """
+        Conflitti dell'orario (vedi find_conflicts), limitati alle classi di Tabella_Classi.
+        slots = [(giorno, ora)] limita il controllo a quelle ore (dopo una modifica puntuale).
+        """
+        df = self.df_all
+        if slots is not None:
+            wanted = {(str(g), str(o)) for g, o in slots}
+            df = df[[(str(g), str(o)) in wanted for g, o in df[["giorno", "ora"]].itertuples(index=False)]]
+        return find_conflicts(df, self.classes())
+
+    def class_sizes(self) -> dict:
+        """{chiave classe: alunni} dalla colonna "Alunni" di Tabella_Classi (vuoto se assente)."""
+        if "Alunni" not in self.df_classi.columns:
+            return {}
+        return {_norm_lookup_classe(c): int(n) for c, n in self.df_classi[["Classe", "Alunni"]].itertuples(index=False)
+                if tidy(c) and pd.notna(n)}
+
+    def propose_rooms(self, class_sizes: dict | None = None, workers: int = 1):
+        """Proposta di assegnazione aule (vedi propose_room_assignment); class_sizes integra Tabella_Classi."""
+        sizes = self.class_sizes()
+        sizes.update({_norm_lookup_classe(k): v for k, v in (class_sizes or {}).items()})
+        return propose_room_assignment(self.df_all, self.df_aule, self.classes(), sizes, workers)
+
+    def lessons(self):
+        """(docente, plesso, classe, aula, giorno, ora, is_sostegno) per ogni riga di df_all con un docente."""
+        cols = ["docente", "plesso", "classe", "aula", "giorno", "ora", "is_sostegno"]
+        for docente, plesso, classe, aula, giorno, ora, sost in self.df_all[cols].itertuples(index=False):
+            docente = tidy(docente)
+            if docente:
+                yield (docente, tidy(plesso), tidy(classe), tidy(aula), str(giorno), str(ora),
+                       str(sost).strip().lower() in {"true", "1"})
+
+    def diff(self, previous: "ParsedInputs") -> dict:
+        """Cosa cambia rispetto a un orario precedente (vedi diff_schedules)."""
+        return diff_schedules(previous, self)
+
+    def diff_workbook(self, previous: "ParsedInputs", titolo: str = "Modifiche all'orario") -> bytes:
+        """Il confronto con un orario precedente come workbook .xlsx (vedi export_OUTPUT_MODIFICHE)."""
+        import io
+        buf = io.BytesIO()
+        export_OUTPUT_MODIFICHE(self.diff(previous), buf, titolo=titolo)
+        return buf.getvalue()
+
+    # --- modifiche puntuali (API PATCH e opzione "edits" dei job) ---
+    def apply_edits(self, edits) -> tuple["ParsedInputs", dict]:
+        """
+        Applica modifiche puntuali, nell'ordine, a una copia dell'orario (l'originale non cambia).
+        Ogni modifica: {"op": "add" | "remove" | "move", "docente", "giorno", "ora",
+        "classe"?, "aula"?, "plesso"?, "sostegno"?, "to"?: {"aula"?, "giorno"?, "ora"?}}.
+        - remove / move: le lezioni del docente in quell'ora, filtrate per classe e aula se
+          indicate (almeno una); move cambia le colonne indicate in "to";
+        - add: una lezione nuova; serve "classe", il plesso si ricava dall'aula o dalla classe.
+        Ritorna (orario modificato, interessati) con interessati = {"docenti", "classi", "aule",
+        "plessi", "slots", "nomi"}: classi e aule come in Tabella_Classi / Tabella_Aule, slots =
+        [(giorno, ora)], nomi = True se cambia l'elenco dei docenti. ValueError se una modifica
+        non è valida o non trova la lezione.
+        """
+        df_all = self.df_all.copy()
+        plessi = {"centrale": self.df_centrale.copy(), "succursale": self.df_succ.copy()}
+        classi = {_norm_lookup_classe(c): c for c in self.classes()}
+        aule = {aula.lower(): (aula, plesso) for aula, plesso, _cap in self.rooms()}
+        edificio = {_norm_lookup_classe(c): tidy(e) for e, c in self.df_classi[["Edificio", "Classe"]].itertuples(index=False)}
+        days = {str(g).lower(): str(g) for g in self.giorni}
+        hours = {str(o) for o in self.ore}
+        touched = {"docenti": set(), "classi": set(), "aule": set(), "plessi": set(), "slots": set()}
+        docenti_prima = {tidy(d).casefold() for d in df_all["docente"] if tidy(d)}
+
+        def slot(edit, where=""):
+            g, o = tidy(edit.get("giorno")), tidy(edit.get("ora"))
+            giorno = days.get(_norm_day(g).lower())
+            if giorno is None:
+                raise ValueError(f"giorno non valido{where}: {g} (ammessi: {', '.join(map(str, self.giorni))})")
+            if o not in hours:
+                raise ValueError(f"ora non valida{where}: {o} (ammesse: {', '.join(map(str, self.ore))})")
+            return giorno, o
+
+        def touch(rows):
+            for docente, classe, aula, plesso, giorno, ora in rows:
+                touched["docenti"].add(tidy(docente))
+                touched["classi"].update(classi[k] for k in self.class_keys(classe) if k in classi)
+                touched["aule"].update(aule[t.lower()][0] for t in split_tokens(tidy(aula)) if t.lower() in aule)
+                if tidy(plesso):
+                    touched["plessi"].add(tidy(plesso))
+                touched["slots"].add((str(giorno), str(ora)))
+
+        def matching(df, edit, giorno, ora):
+            docente = " ".join(tidy(edit.get("docente")).split()).casefold()
+            mask = (df["docente"].map(tidy).str.casefold() == docente) \
+                & (df["giorno"].astype(str) == giorno) & (df["ora"].astype(str) == ora)
+            if tidy(edit.get("classe")):
+                keys = set(self.class_keys(edit["classe"]))
+                mask &= df["classe"].map(lambda c: set(self.class_keys(c)) == keys)
+            if tidy(edit.get("aula")):
+                toks = {t.lower() for t in split_tokens(tidy(edit["aula"]))}
+                mask &= df["aula"].map(lambda a: {t.lower() for t in split_tokens(tidy(a))} == toks)
+            return mask
+
+        cols = ["docente", "classe", "aula", "plesso", "giorno", "ora"]
+        for n, edit in enumerate(edits, 1):
+            where = f" (modifica {n})"
+            op = tidy(edit.get("op")).lower()
+            if op not in EDIT_OPS:
+                raise ValueError(f"operazione non valida{where}: {op} (ammesse: {', '.join(EDIT_OPS)})")
+            if not tidy(edit.get("docente")):
+                raise ValueError(f"docente mancante{where}")
+            giorno, ora = slot(edit, where)
+
+            if op == "add":
+                classe, aula = tidy(edit.get("classe")), tidy(edit.get("aula"))
+                if not classe:
+                    raise ValueError(f"classe mancante{where}")
+                plesso = tidy(edit.get("plesso"))
+                if not plesso:
+                    room = next((aule[t.lower()] for t in split_tokens(aula) if t.lower() in aule), None)
+                    keys = self.class_keys(classe)
+                    plesso = room[1] if room else (edificio.get(keys[0], "") if keys else "")
+                sostegno = bool(edit.get("sostegno", False))
+                if not sostegno and plesso.lower() not in plessi:
+                    raise ValueError(f"plesso non valido{where}: {plesso or '?'} (ammessi: Centrale, Succursale)")
+                row = {"plesso": plesso.capitalize() if plesso.lower() in plessi else plesso,
+                       "docente": " ".join(tidy(edit["docente"]).split()), "classe": classe, "aula": aula,
+                       "giorno": giorno, "ora": ora}
+                df_all = _append_row(df_all, {**row, "is_sostegno": sostegno})
+                if not sostegno:
+                    plessi[plesso.lower()] = _append_row(plessi[plesso.lower()], row)
+                touch([tuple(row[c] for c in cols)])
+                continue
+
+            mask = matching(df_all, edit, giorno, ora)
+            if not mask.any():
+                raise ValueError(f"lezione non trovata{where}: {tidy(edit['docente'])} {giorno} ora {ora}")
+            touch(df_all.loc[mask, cols].itertuples(index=False))
+            if op == "remove":
+                df_all = df_all[~mask].reset_index(drop=True)
+                for key, df in plessi.items():
+                    plessi[key] = df[~matching(df, edit, giorno, ora)].reset_index(drop=True)
+                continue
+
+            to = edit.get("to") or {}
+            if not any(tidy(to.get(c)) for c in ("aula", "giorno", "ora")):
+                raise ValueError(f"move senza destinazione{where}: indicare to.aula, to.giorno o to.ora")
+            new = {}
+            if tidy(to.get("giorno")) or tidy(to.get("ora")):
+                new["giorno"], new["ora"] = slot({"giorno": to.get("giorno") or giorno, "ora": to.get("ora") or ora},
+                                                 where)
+            if tidy(to.get("aula")):
+                new["aula"] = tidy(to["aula"])
+                room = next((aule[t.lower()] for t in split_tokens(new["aula"]) if t.lower() in aule), None)
+                moved = df_all.loc[mask & ~df_all["is_sostegno"].astype(bool), "plesso"].map(tidy).str.lower()
+                if room and (moved != room[1].lower()).any():
+                    raise ValueError(f"{room[0]} è in un altro plesso{where}: usare remove + add")
+            for df in plessi.values():
+                m = matching(df, edit, giorno, ora)
+                for c, v in new.items():
+                    df.loc[m, c] = _category_value(df[c], v)
+            for c, v in new.items():
+                df_all.loc[mask, c] = _category_value(df_all[c], v)
+            touch(df_all.loc[mask, cols].itertuples(index=False))
+
+        docenti_dopo = {tidy(d).casefold() for d in df_all["docente"] if tidy(d)}
+        parsed = ParsedInputs(df_aule=self.df_aule, df_centrale=plessi["centrale"], df_succ=plessi["succursale"],
+                              df_classi=self.df_classi, materie_map=self.materie_map, df_all=df_all,
+                              giorni=list(self.giorni), ore=list(self.ore))
+        affected = {k: sorted(v) for k, v in touched.items()}
+        affected["nomi"] = docenti_prima != docenti_dopo
+        return parsed, affected
+
+
+def load_inputs(input_paths, cancel_event=None, report=None) -> ParsedInputs:
+    """
+    Legge e normalizza i sei file di input (loader + integrazione sostegno).
+    report(stage) viene chiamato prima di ogni lettura; con cancel_event impostato
+    solleva JobCancelled tra una lettura e l'altra.
+    """
+    files, missing = resolve_inputs(input_paths)
+    if missing:
+        raise FileNotFoundError("Mancano i file: " + ", ".join(missing))
+    if report is None:
+        report = _progress_reporter(None, total=len(LOADER_STAGES), cancel_event=cancel_event)
+
+    report("Lettura Tabella_Aule")
+    df_aule = load_aule_capienze(files["Tabella_Aule.xlsx"])
+    report("Lettura Centrale")
+    df_centrale, giorni_c, ore_c = read_teacher_matrix(files["Centrale.xlsx"], plesso_label="Centrale", df_aule=df_aule)
+    report("Lettura Succursale")
+    df_succ,     giorni_s, ore_s = read_teacher_matrix(files["Succursale.xlsx"], plesso_label="Succursale", df_aule=df_aule)
+
+    report("Lettura Tabella_Classi")
+    df_classi = load_tabella_classi(files["Tabella_Classi.xlsx"])
+    report("Lettura Tabella_Materie")
+    materie_map = load_tabella_materie(files["Tabella_Materie.xlsx"])
+
+    if (giorni_c == giorni_s) and (ore_c == ore_s):
+        giorni, ore = giorni_c, ore_c
+    else:
+        giorni = list(OrderedDict.fromkeys(list(giorni_c) + list(giorni_s)))
+        ore    = list(OrderedDict.fromkeys(list(ore_c)    + list(ore_s)))
+
+    report("Lettura Tabella_Sostegno")
+    df_all = pd.concat([df_centrale, df_succ], ignore_index=True)
+    df_sostegno, _, _ = load_tabella_sostegno(files["Tabella_Sostegno.xlsx"], df_aule=df_aule)
+    df_all = integrate_sostegno_and_mark(df_all, df_sostegno, df_aule=df_aule, df_classi=df_classi)
+
+    return ParsedInputs(df_aule=df_aule, df_centrale=df_centrale, df_succ=df_succ, df_classi=df_classi,
+                        materie_map=materie_map, df_all=df_all, giorni=list(giorni), ore=list(ore))
+
+
+# ================================
+# Job batch: più varianti di opzioni sugli stessi input letti una volta
+# ================================
+BATCH_FILE = "VARIANTI.json"
+# processi di default per le varianti: ognuno riceve una copia degli input letti e
+# carica pandas/openpyxl, quindi più di 2 costa memoria senza accorciare molto il job
+BATCH_WORKERS_DEFAULT = 2
+
+_batch_data: ParsedInputs | None = None  # input letti, nei processi del pool del batch
+
+
+def _init_batch_worker(data: ParsedInputs):
+    """Initializer del pool: gli input arrivano una volta per processo, non una per variante."""
+    global _batch_data
+    _batch_data = data
+
+
+def _render_variant(name: str, input_paths, out_dir: str, options: dict, stop, started) -> tuple[int, str]:
+    """
+    Una variante in un processo del pool (globali OUTPUT_DIR e HEADER_TEXT propri del processo).
+    Segnala l'avvio su `started` (coda del Manager) e si ferma tra due fasi se `stop` è impostato.
+    Ritorna (exit code, output stampato) perché il log del job è nel processo principale.
+    """
+    import contextlib, io
+    started.put(name)
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log):
+        code = main(input_paths, out_dir, cancel_event=stop, parsed=_batch_data, **options)
+    return code, log.getvalue()
+
+
+def _variant_dirs(variants) -> list[str]:
+    """Nome di cartella sicuro e univoco per ogni variante ("nome" o variante_N)."""
+    dirs, seen = [], set()
+    for i, v in enumerate(variants, 1):
+        base = re.sub(r"[^\w.-]+", "_", tidy(v.get("nome"))).strip("._") or f"variante_{i}"
+        name, n = base, 2
+        while name.lower() in seen:
+            name, n = f"{base}_{n}", n + 1
+        seen.add(name.lower())
+        dirs.append(name)
+    return dirs
+
+
+def main_batch(input_paths, out: Path, variants: list[dict], shared: dict, parsed=None,
+               progress_callback=None, cancel_event=None) -> int:
+    """
+    Più varianti di opzioni (es. intestazioni con date diverse, export diversi) in un job:
+    gli input si leggono una volta (e le modifiche "edits" si applicano una volta), poi
+    ogni variante {"nome", "options"} viene esportata in out/<nome>/ con le opzioni
+    comuni più le sue. Con batch_workers > 1 (default BATCH_WORKERS_DEFAULT) le varianti
+    girano in parallelo su più processi (i globali del modulo impediscono i thread). Esito in VARIANTI.json.
+    Ogni variante è una fase "Variante <nome>", segnalata quando parte; cancel_event
+    viene girato ai processi, che si fermano alla fase successiva come un job normale.
+    """
+    from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+    import json, multiprocessing, queue
+
+    n_load = 1 if parsed is not None else len(LOADER_STAGES)
+    report = _progress_reporter(progress_callback, total=n_load + len(variants), cancel_event=cancel_event)
+    if parsed is not None:
+        report("Input già letti")
+        data = parsed
+    else:
+        data = load_inputs(input_paths, report=report)
+    edits = shared.pop("edits", None)
+    if edits:
+        data, _affected = data.apply_edits(edits)
+        print(f"[Info] Applicate {len(edits)} modifiche puntuali all'orario caricato")
+
+    workers = max(1, min(len(variants), int(shared.pop("batch_workers", 0) or BATCH_WORKERS_DEFAULT)))
+    jobs = []
+    for name, v in zip(_variant_dirs(variants), variants):
+        opts = {**shared, **(v.get("options") or {})}
+        opts.pop("variants", None)
+        opts.setdefault("pause", 0)  # N varianti: N volte la pausa tra i file sarebbe solo attesa
+        jobs.append((name, opts))
+    codes = {}
+    if workers == 1:
+        for name, opts in jobs:
+            report(f"Variante {name}")
+            codes[name] = main(input_paths, str(out / name), cancel_event=cancel_event, parsed=data, **opts)
+    else:
+        ctx = multiprocessing.get_context("spawn")  # fork da un processo con thread non è sicuro
+        with ctx.Manager() as manager:
+            stop, started = manager.Event(), manager.Queue()
+            pool = ProcessPoolExecutor(max_workers=workers, mp_context=ctx,
+                                       initializer=_init_batch_worker, initargs=(data,))
+            try:
+                futures = {pool.submit(_render_variant, name, input_paths, str(out / name), opts, stop, started): name
+                           for name, opts in jobs}
+                pending = set(futures)
+                while pending:
+                    done, pending = wait(pending, timeout=0.5, return_when=FIRST_COMPLETED)
+                    if cancel_event is not None and cancel_event.is_set():
+                        stop.set()  # i processi si fermano alla prossima fase, shutdown li attende
+                        raise JobCancelled("Varianti")
+                    while True:
+                        try:
+                            report(f"Variante {started.get_nowait()}")
+                        except queue.Empty:
+                            break
+                    for fut in done:
+                        codes[futures[fut]], printed = fut.result()
+                        print(f"--- Variante {futures[fut]} ---\n{printed}", end="", flush=True)
+            finally:
+                pool.shutdown(wait=True, cancel_futures=True)
+    if cancel_event is not None and cancel_event.is_set():
+        raise JobCancelled("Varianti")
+
+    summary = [{"nome": name, "cartella": name, "esito": "ok" if codes.get(name) == 0 else "errore",
+                "options": {k: v for k, v in opts.items() if k not in ("edits", "pause")}} for name, opts in jobs]
+    (out / BATCH_FILE).write_text(json.dumps(summary, ensure_ascii=False, indent=1), encoding="utf-8")
+    failed = [s["nome"] for s in summary if s["esito"] != "ok"]
+    print(f"[Info] {len(jobs) - len(failed)}/{len(jobs)} varianti completate ({workers} processi)")
+    if failed:
+        (out / "_ERROR.txt").write_text("Varianti non riuscite: " + ", ".join(failed), encoding="utf-8")
+        return 1
+    (out / "_OK.txt").write_text("Export completato.", encoding="utf-8")
+    return 0
+
+
+def main(input_paths: list[str], output_dir: str, progress_callback=None, cancel_event=None,
+         parsed: ParsedInputs | None = None, **options) -> int:
     """
     Entry point compatibile con l'app.
     - input_paths: lista file caricati via UI (.xlsx)
     - output_dir: cartella di lavoro del job dove scrivere TUTTI gli output
-    - options: parametri opzionali (es. header_text)
+    - progress_callback: opzionale, vedi protocollo sopra
+    - cancel_event: opzionale (threading.Event), controllato tra una fase e l'altra
+    - parsed: opzionale, risultato di load_inputs(input_paths) già calcolato (non viene modificato)
+    - options: parametri opzionali (es. header_text; fail_on_conflicts=True interrompe il job
+      prima degli export se l'orario ha conflitti; propose_rooms=True aggiunge
+      ORARIO_AULE_PROPOSTA.xlsx e PROPOSTA_AULE.json, con class_sizes={classe: alunni}
+      e assign_workers=N processi; edits=[...] applica modifiche puntuali, vedi
+      ParsedInputs.apply_edits; only={"classi", "aule", "plessi"} rigenera solo
+      i fogli settimanali (*_PARZIALE.xlsx) di quelle classi/aule e le aule libere di quei plessi;
+      variants=[{"nome", "options"}] esegue più varianti in sottocartelle, vedi main_batch;
+      pause=secondi di attesa dopo ogni export, default DELAY_SECONDS)
     """
     from pathlib import Path
+    import json
     import traceback
     try:
-        # 1) Setup output dir e header
+        # 1) Setup output dir (l'header dopo: un job batch lo imposta per variante)
         out = Path(output_dir)
         out.mkdir(parents=True, exist_ok=True)
         global OUTPUT_DIR
         OUTPUT_DIR = out
 
-        # HEADER_TEXT dalle options (UI)
-        hdr = (options or {}).get("header_text") or (options or {}).get("HEADER_TEXT") or ""
-        try:
-            set_header_text(hdr)
-        except Exception:
-            pass
-
-        # 2) Mappa input per nome atteso (case-insensitive)
-        name_map = {Path(p).name.lower(): Path(p) for p in input_paths}
-        def pick(*candidates: str) -> Path | None:
-            for c in candidates:
-                p = name_map.get(c.lower())
-                if p: return p
-            return None
-
-        centrale   = pick("centrale.xlsx")
-        succursale = pick("succursale.xlsx")
-        tab_aule   = pick("tabella_aule.xlsx", "aule.xlsx")
-        tab_classi = pick("tabella_classi.xlsx", "classi.xlsx")
-        tab_materie= pick("tabella_materie.xlsx", "materie.xlsx")
-        tab_sost   = pick("tabella_sostegno.xlsx", "sostegno.xlsx")
-
-        missing = [n for n,p in {
-            "Centrale.xlsx": centrale,
-            "Succursale.xlsx": succursale,
-            "Tabella_Aule.xlsx": tab_aule,
-            "Tabella_Classi.xlsx": tab_classi,
-            "Tabella_Materie.xlsx": tab_materie,
-            "Tabella_Sostegno.xlsx": tab_sost,
-        }.items() if p is None]
+        # 2) Verifica input per nome atteso (case-insensitive)
+        _files, missing = resolve_inputs(input_paths)
         if missing:
             (out / "ERROR_MISSING_INPUTS.txt").write_text(
                 "Mancano i seguenti file richiesti:\n- " + "\n- ".join(missing) +
@@ -3292,42 +4244,124 @@ def main(input_paths: list[str], output_dir: str, **options) -> int:
             )
             return 1
 
-        # 3) Caricamento e pipeline (equivalente sezione originale)
-        df_aule = load_aule_capienze(tab_aule)
-        df_centrale, giorni_c, ore_c = read_teacher_matrix(centrale, plesso_label="Centrale", df_aule=df_aule)
-        df_succ,     giorni_s, ore_s = read_teacher_matrix(succursale, plesso_label="Succursale", df_aule=df_aule)
+        # Job batch: una cartella per variante di opzioni, input letti una volta sola
+        if (options or {}).get("variants"):
+            shared = {k: v for k, v in options.items() if k != "variants"}
+            return main_batch(input_paths, out, options["variants"], shared, parsed=parsed,
+                              progress_callback=progress_callback, cancel_event=cancel_event)
 
-        df_classi = load_tabella_classi(tab_classi)
-        materie_map = load_tabella_materie(tab_materie)
+        # HEADER_TEXT dalle options (UI)
+        hdr = (options or {}).get("header_text") or (options or {}).get("HEADER_TEXT") or ""
+        try:
+            set_header_text(hdr)
+        except Exception:
+            pass
 
-        if (giorni_c == giorni_s) and (ore_c == ore_s):
-            giorni, ore = giorni_c, ore_c
+        # 3) Caricamento e pipeline (equivalente sezione originale)
+        n_load = 1 if parsed is not None else len(LOADER_STAGES)
+        propose = bool((options or {}).get("propose_rooms"))
+        edits = (options or {}).get("edits") or []
+        only = (options or {}).get("only")
+        stages = [name for name in EXPORT_STAGES if only is None or _partial_stage(name, only)]
+        report = _progress_reporter(progress_callback, total=n_load + 1 + len(stages) + propose,
+                                    cancel_event=cancel_event)
+        if parsed is not None:
+            report("Input già letti")
+            data = parsed.copy()
         else:
-            giorni = list(OrderedDict.fromkeys(list(giorni_c) + list(giorni_s)))
-            ore    = list(OrderedDict.fromkeys(list(ore_c)    + list(ore_s)))
-
-        df_all = pd.concat([df_centrale, df_succ], ignore_index=True)
-        df_sostegno, _, _ = load_tabella_sostegno(tab_sost, df_aule=df_aule)
-        df_all = integrate_sostegno_and_mark(df_all, df_sostegno, df_aule=df_aule, df_classi=df_classi)
-
-        # 4) Export principali (solo XLSX)
-        run_with_delay(export_OUTPUT_CLASSI_SETTIMANALE, df_all, df_classi, titolo="ORARIO_CLASSI_SETTIMANALE", materie_map=materie_map)
-        run_with_delay(export_OUTPUT_AULE_SETTIMANALE,   df_all, df_aule, titolo="ORARIO_AULE_SETTIMANALE", plesso=None,
-                       xlsx_first_col_width=6.5, xlsx_second_col_width=10.0, xlsx_day_col_width=None)
-        run_with_delay(export_OUTPUT_TABELLA_GLOBALE,   df_all, giorni, ore, df_aule=df_aule, df_classi=df_classi)
-        run_with_delay(export_OUTPUT_AULE_COMPATTO,     df_succ,     "ORARIO_AULE_COMPATTO_SUCCURSALE.xlsx", df_aule=df_aule)
-        run_with_delay(export_OUTPUT_AULE_COMPATTO,     df_centrale, "ORARIO_AULE_COMPATTO_CENTRALE.xlsx",  df_aule=df_aule)
-        run_with_delay(export_OUTPUT_CLASSI_COMPATTO,   df_succ,     "ORARIO_CLASSI_COMPATTO_SUCCURSALE.xlsx")
-        run_with_delay(export_OUTPUT_CLASSI_COMPATTO,   df_centrale, "ORARIO_CLASSI_COMPATTO_CENTRALE.xlsx")
-        run_with_delay(export_OUTPUT_TABELLA_PLESSO,    df_all, giorni, ore, df_aule=df_aule, plesso_focus="Succursale", df_classi=df_classi)
-        run_with_delay(export_OUTPUT_TABELLA_PLESSO,    df_all, giorni, ore, df_aule=df_aule, plesso_focus="Centrale",  df_classi=df_classi)
-        export_OUTPUT_AULE_LIBERE(df_centrale, df_aule, "Centrale",   "ORARIO_AULE_LIBERE_CENTRALE.xlsx",  xlsx_giorno_col_width=11, xlsx_ora_col_width=6)
-        export_OUTPUT_AULE_LIBERE(df_succ,     df_aule, "Succursale", "ORARIO_AULE_LIBERE_SUCCURSALE.xlsx", xlsx_giorno_col_width=11, xlsx_ora_col_width=6)
-
-        # 5) Report finale
+            data = load_inputs(input_paths, report=report)
+        if edits:
+            # modifiche puntuali fatte via API dopo il caricamento (PATCH /sessions/{id}/schedule)
+            data, _affected = data.apply_edits(edits)
+            print(f"[Info] Applicate {len(edits)} modifiche puntuali all'orario caricato")
+        df_aule, df_centrale, df_succ = data.df_aule, data.df_centrale, data.df_succ
+        df_classi, materie_map, df_all = data.df_classi, data.materie_map, data.df_all
+        giorni, ore = data.giorni, data.ore
+        # fogli settimanali: con una rigenerazione parziale solo i blocchi delle classi e aule indicate
+        classi_sett, aule_sett, pause = df_classi, df_aule, float(options.get("pause", DELAY_SECONDS))
+        sett = ""  # suffisso dei fogli settimanali
+        if only is not None:
+            sett = PARTIAL_SUFFIX
+            pause = 0  # pochi blocchi: la pausa tra un file e l'altro qui è solo attesa
+            classi_sett = df_classi[df_classi["Classe"].map(tidy).isin(only.get("classi") or [])]
+            aule_sett = df_aule[df_aule["Aula"].map(tidy).isin(only.get("aule") or [])]
+
+        # 4) Controllo conflitti: report in CONFLITTI_ORARIO.json, job interrotto se richiesto
+        report("Controllo conflitti")
+        conflicts = data.conflicts()
+        if conflicts:
+            (out / CONFLICTS_FILE).write_text(json.dumps(conflicts, ensure_ascii=False, indent=1), encoding="utf-8")
+            print(f"[Avviso] {len(conflicts)} conflitti nell'orario (dettagli in {CONFLICTS_FILE}):")
+            for c in conflicts[:20]:
+                print(f"  - {c['tipo']} {c['nome']}, {c['giorno']} ora {c['ora']}: "
+                      + "; ".join(f"{r['docente']} {r['classe']} {r['aula']}".strip() for r in c["righe"]))
+            if (options or {}).get("fail_on_conflicts"):
+                (out / "_ERROR.txt").write_text(
+                    f"Orario non coerente: {len(conflicts)} conflitti, vedi {CONFLICTS_FILE}.", encoding="utf-8")
+                return 1
+
+        # 5) Export principali (solo XLSX)
+        exports = {
+            "ORARIO_CLASSI_SETTIMANALE":
+                lambda: run_with_delay(export_OUTPUT_CLASSI_SETTIMANALE, df_all, classi_sett, titolo=f"ORARIO_CLASSI_SETTIMANALE{sett}", materie_map=materie_map, delay=pause),
+            "ORARIO_AULE_SETTIMANALE":
+                lambda: run_with_delay(export_OUTPUT_AULE_SETTIMANALE, df_all, aule_sett, titolo=f"ORARIO_AULE_SETTIMANALE{sett}", plesso=None, delay=pause,
+                                       xlsx_first_col_width=6.5, xlsx_second_col_width=10.0, xlsx_day_col_width=None),
+            "ORARIO_TABELLA_GLOBALE":
+                lambda: run_with_delay(export_OUTPUT_TABELLA_GLOBALE, df_all, giorni, ore, df_aule=df_aule, df_classi=df_classi, delay=pause),
+            "ORARIO_AULE_COMPATTO_SUCCURSALE":
+                lambda: run_with_delay(export_OUTPUT_AULE_COMPATTO, df_succ, "ORARIO_AULE_COMPATTO_SUCCURSALE.xlsx", df_aule=df_aule, delay=pause),
+            "ORARIO_AULE_COMPATTO_CENTRALE":
+                lambda: run_with_delay(export_OUTPUT_AULE_COMPATTO, df_centrale, "ORARIO_AULE_COMPATTO_CENTRALE.xlsx", df_aule=df_aule, delay=pause),
+            "ORARIO_CLASSI_COMPATTO_SUCCURSALE":
+                lambda: run_with_delay(export_OUTPUT_CLASSI_COMPATTO, df_succ, "ORARIO_CLASSI_COMPATTO_SUCCURSALE.xlsx", delay=pause),
+            "ORARIO_CLASSI_COMPATTO_CENTRALE":
+                lambda: run_with_delay(export_OUTPUT_CLASSI_COMPATTO, df_centrale, "ORARIO_CLASSI_COMPATTO_CENTRALE.xlsx", delay=pause),
+            "ORARIO_TABELLA_SUCCURSALE":
+                lambda: run_with_delay(export_OUTPUT_TABELLA_PLESSO, df_all, giorni, ore, df_aule=df_aule, plesso_focus="Succursale", df_classi=df_classi, delay=pause),
+            "ORARIO_TABELLA_CENTRALE":
+                lambda: run_with_delay(export_OUTPUT_TABELLA_PLESSO, df_all, giorni, ore, df_aule=df_aule, plesso_focus="Centrale", df_classi=df_classi, delay=pause),
+            "ORARIO_AULE_LIBERE_CENTRALE":
+                lambda: export_OUTPUT_AULE_LIBERE(df_centrale, df_aule, "Centrale", "ORARIO_AULE_LIBERE_CENTRALE.xlsx", xlsx_giorno_col_width=11, xlsx_ora_col_width=6),
+            "ORARIO_AULE_LIBERE_SUCCURSALE":
+                lambda: export_OUTPUT_AULE_LIBERE(df_succ, df_aule, "Succursale", "ORARIO_AULE_LIBERE_SUCCURSALE.xlsx", xlsx_giorno_col_width=11, xlsx_ora_col_width=6),
+        }
+        for name in stages:
+            report(f"Export {name}")
+            exports[name]()
+
+        # 6) Proposta di assegnazione aule (opzionale): stesso formato di ORARIO_AULE_SETTIMANALE
+        if propose:
+            report(f"Export {ROOM_PROPOSAL_STAGE}")
+            t0 = time.monotonic()
+            df_prop, moves = data.propose_rooms(options.get("class_sizes"), int(options.get("assign_workers") or 1))
+            (out / ROOM_PROPOSAL_FILE).write_text(json.dumps(moves, ensure_ascii=False, indent=1), encoding="utf-8")
+            print(f"[Info] Proposta aule in {time.monotonic() - t0:.1f}s: "
+                  f"{sum(1 for m in moves if m['a'])} spostamenti, "
+                  f"{sum(1 for m in moves if not m['a'])} classi senza aula adatta (dettagli in {ROOM_PROPOSAL_FILE})")
+            run_with_delay(export_OUTPUT_AULE_SETTIMANALE, df_prop.assign(aula=df_prop["aula_proposta"]), df_aule,
+                           titolo=ROOM_PROPOSAL_STAGE, plesso=None, delay=pause,
+                           xlsx_first_col_width=6.5, xlsx_second_col_width=10.0, xlsx_day_col_width=None)
+
+        # 7) Report finale
         (out / "_OK.txt").write_text("Export completato.", encoding="utf-8")
         return 0
+    except JobCancelled as e:
+        print(f"[Info] Esecuzione annullata prima di: {e}")
+        return 1
     except Exception as e:
         (Path(output_dir) / "_ERROR.txt").write_text(str(e) + "\n" + traceback.format_exc(), encoding="utf-8")
         return 1
 
+
+if __name__ == "__main__":
+    # Subprocess mode: python mio_runner.py --inputs "[paths]" --out DIR --options "{...}"
+    import argparse, json, sys
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--inputs", required=True)
+    ap.add_argument("--out", required=True)
+    ap.add_argument("--options", default="{}")
+    args = ap.parse_args()
+    code = main(input_paths=json.loads(args.inputs), output_dir=args.out,
+                progress_callback=_print_progress_json, **json.loads(args.options))
+    sys.exit(int(code or 0))
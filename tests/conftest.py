@@ -0,0 +1,20 @@
+"""Shared fixtures: mio_runner (repo root) and the backend package (backend/app) on sys.path."""
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path[:0] = [str(ROOT), str(ROOT / "backend")]
+# app.config creates OUTPUT_DIR_BASE on import: keep test data out of ./data
+os.environ.setdefault("APP_OUTPUT_DIR_BASE", tempfile.mkdtemp(prefix="apporario-tests-"))
+EXAMPLES = sorted((ROOT / "examples").glob("*.xlsx"))
+
+
+@pytest.fixture(scope="session")
+def parsed():
+    """The example inputs, parsed once for the whole run (treat as read-only)."""
+    import mio_runner
+    return mio_runner.load_inputs([str(p) for p in EXAMPLES])
@@ -0,0 +1,81 @@
+import threading
+import time
+
+from app.expiry import ExpiryIndex, Reaper
+
+
+def test_pop_due_in_deadline_order():
+    index = ExpiryIndex()
+    index.add("job", "c", 3)
+    index.add("job", "a", 1)
+    index.add("session", "b", 2)
+    now = time.monotonic()
+    assert index.pop_due(now) == []
+    assert index.pop_due(now + 10) == [("job", "a"), ("session", "b"), ("job", "c")]
+    assert len(index) == 0
+
+
+def test_touch_rearms_deadline():
+    index = ExpiryIndex()
+    index.add("session", "s", 5)
+    original = time.monotonic() + 5  # not earlier than the deadline set by add
+    time.sleep(0.1)
+    index.touch("session", "s")
+    # due at the original deadline, but the touch moved it ~0.1s later
+    assert index.pop_due(original + 0.01) == []
+    assert len(index) == 1
+    assert index.pop_due(original + 0.2) == [("session", "s")]
+
+
+def test_touch_rearms_past_later_keys():
+    index = ExpiryIndex()
+    index.add("session", "s", 1)
+    index.add("session", "t", 2)
+    index._deadline[("session", "s")] += 2  # as if touched with a longer idle window
+    now = time.monotonic()
+    assert index.pop_due(now + 2.5) == [("session", "t")]
+    assert index.pop_due(now + 3.5) == [("session", "s")]
+
+
+def test_touch_unknown_key_is_noop():
+    index = ExpiryIndex()
+    index.touch("session", "ghost")
+    assert len(index) == 0
+    assert index.pop_due(time.monotonic() + 100) == []
+
+
+def test_discard_and_readd():
+    index = ExpiryIndex()
+    index.add("job", "j", 1)
+    index.discard("job", "j")
+    assert index.pop_due(time.monotonic() + 10) == []
+    index.add("job", "j", 1)
+    index.add("job", "j", 3)  # restart: the earlier heap entry is stale
+    now = time.monotonic()
+    assert index.pop_due(now + 2) == []
+    assert index.pop_due(now + 4) == [("job", "j")]
+    assert index.pop_due(now + 100) == []
+
+
+def test_reaper_readds_when_handler_declines():
+    index = ExpiryIndex()
+    reaper = Reaper(index)
+    calls = []
+    expired = threading.Event()
+
+    def handler(key):
+        calls.append(key)
+        if len(calls) < 2:
+            return False  # still in use: keep for another TTL
+        expired.set()
+        return True
+
+    reaper.register("session", handler, 0.05)
+    reaper.track("session", "s")
+    reaper.start()
+    try:
+        assert expired.wait(5)
+    finally:
+        reaper.stop()
+    assert calls == ["s", "s"]
+    assert len(index) == 0
@@ -0,0 +1,100 @@
+"""Room proposal (user-047): the Hungarian solver against brute force, and the proposal's invariants."""
+from itertools import permutations
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import mio_runner
+from mio_runner import ASSIGN_FORBIDDEN_COST, linear_sum_assignment, propose_room_assignment
+
+
+def brute_force(cost: np.ndarray) -> float:
+    if cost.shape[0] > cost.shape[1]:
+        cost = cost.T
+    n, m = cost.shape
+    return min(sum(cost[i, j] for i, j in enumerate(cols)) for cols in permutations(range(m), n))
+
+
+def check(cost: np.ndarray) -> None:
+    rows, cols = linear_sum_assignment(cost)
+    assert len(rows) == min(cost.shape)
+    assert len(set(rows.tolist())) == len(rows) and len(set(cols.tolist())) == len(cols)
+    assert list(rows) == sorted(rows)
+    assert cost[rows, cols].sum() == pytest.approx(brute_force(cost))
+
+
+@pytest.mark.parametrize("shape", [(1, 1), (3, 3), (2, 5), (5, 2), (4, 6), (6, 4), (5, 5)])
+def test_matches_brute_force(shape):
+    rng = np.random.default_rng(sum(shape))
+    for _ in range(30):
+        check(rng.integers(0, 100, size=shape).astype(float))
+
+
+@pytest.mark.parametrize("shape", [(3, 3), (3, 6), (6, 3)])
+def test_ties(shape):
+    rng = np.random.default_rng(7)
+    check(np.zeros(shape))
+    for _ in range(30):
+        check(rng.integers(0, 3, size=shape).astype(float))  # many equal optima
+
+
+def test_infeasible_rows():
+    # the costs propose_room_assignment builds: forbidden cells plus one "stays put" column per unit
+    rng = np.random.default_rng(3)
+    for _ in range(30):
+        cost = rng.integers(0, 200, size=(4, 7)).astype(float)
+        cost[rng.random(cost.shape) < 0.4] = ASSIGN_FORBIDDEN_COST
+        cost[rng.integers(0, 4)] = ASSIGN_FORBIDDEN_COST  # a row with no feasible cell at all
+        check(cost)
+    check(np.full((3, 5), ASSIGN_FORBIDDEN_COST))
+
+
+def _slot(rows, rooms):
+    df_all = pd.DataFrame(rows, columns=["plesso", "docente", "classe", "aula", "giorno", "ora", "is_sostegno"])
+    df_aule = pd.DataFrame(rooms, columns=["Aula", "Plesso", "Capienza"])
+    return df_all, df_aule
+
+
+def test_clash_resolved_by_size():
+    df_all, df_aule = _slot(
+        [("Centrale", "ROSSI", "1A", "R1", "Lunedì", 1, False),
+         ("Centrale", "BIANCHI", "2A", "R1", "Lunedì", 1, False),
+         ("Centrale", "VERDI", "2A", "R1", "Lunedì", 1, True)],
+        [("R1", "Centrale", 25), ("R2", "Centrale", 35), ("R3", "Centrale", 10)])
+    out, moves = propose_room_assignment(df_all, df_aule, ["1A", "2A"], {"1A": 20, "2A": 30})
+    assert moves == [{"giorno": "Lunedì", "ora": "1", "plesso": "Centrale", "classi": ["2A"], "da": "R1", "a": "R2"}]
+    assert out["aula_proposta"].tolist() == ["R1", "R2", "R2"]  # sostegno follows its class
+
+
+def test_no_room_large_enough():
+    df_all, df_aule = _slot(
+        [("Centrale", "ROSSI", "1A", "R1", "Lunedì", 1, False),
+         ("Centrale", "BIANCHI", "2A", "R1", "Lunedì", 1, False)],
+        [("R1", "Centrale", 25), ("R2", "Centrale", 20)])
+    out, moves = propose_room_assignment(df_all, df_aule, ["1A", "2A"], {"1A": 22, "2A": 40})
+    assert [(m["classi"], m["a"]) for m in moves] == [(["2A"], None)]
+    assert out["aula_proposta"].tolist() == ["R1", "R1"]  # unplaced: stays where it was, reported
+
+
+def test_proposal_never_overfills_or_double_books(parsed):
+    classes = parsed.classes()
+    sizes = {c: 18 + (i * 7) % 13 for i, c in enumerate(classes)}
+    out, moves = parsed.propose_rooms(sizes)
+    assert moves, "the examples contain at least one room clash"
+    key = mio_runner._norm_lookup_classe
+    sizes = {key(c): n for c, n in sizes.items()}
+    caps = {mio_runner.tidy(a).lower(): int(c) for a, c in parsed.df_aule[["Aula", "Capienza"]].itertuples(index=False)
+            if str(c).strip().isdigit()}
+    lessons = out[~out["is_sostegno"].astype(bool)]
+    for move in moves:
+        if move["a"] is None:
+            continue
+        room = move["a"].lower()
+        moved = {k.lower() for k in move["classi"]}
+        if room in caps:
+            assert sum(sizes[k] for k in moved) <= caps[room], move
+        here = lessons[(lessons["giorno"].astype(str) == move["giorno"]) & (lessons["ora"].astype(str) == move["ora"])
+                       & (lessons["aula_proposta"].map(mio_runner.tidy).str.lower() == room)]
+        for classe in here["classe"]:
+            assert set(parsed.class_keys(classe)) & moved, (move, classe)
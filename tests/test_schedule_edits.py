@@ -0,0 +1,64 @@
+"""Point edits (user-048): indexes patched in place must equal a rebuild from the edited timetable."""
+import pytest
+
+from app.schedule import ScheduleRegistry, SessionSchedule
+
+EDITS = [
+    [{"op": "move", "docente": "ABBATE", "giorno": "Martedì", "ora": "3", "to": {"aula": "C101"}}],
+    [{"op": "remove", "docente": "ABBATE", "giorno": "Lunedì", "ora": "1"},
+     {"op": "add", "docente": "ABBATE", "classe": "3AS", "aula": "C031", "giorno": "Lunedì", "ora": 1}],
+    [{"op": "move", "docente": "ABBATE", "giorno": "mar", "ora": 3, "to": {"giorno": "Venerdì", "ora": 4}}],
+    [{"op": "add", "docente": "NUOVO DOCENTE", "classe": "3AS", "aula": "C101", "giorno": "Lunedì", "ora": 1}],
+]
+
+
+def built(parsed) -> SessionSchedule:
+    sched = SessionSchedule("inputs", parsed)
+    sched.rooms, sched.teachers, sched.search, sched.conflicts  # build every index
+    return sched
+
+
+def state(sched: SessionSchedule) -> dict:
+    rooms, teachers, search = sched.rooms, sched.teachers, sched.search
+    lessons = {k: sorted(v, key=repr) for k, v in teachers._lessons.items()}
+    return {
+        "rooms": (rooms.rooms, rooms._free, rooms._plesso),
+        "teachers": (teachers.teachers, teachers.busy, teachers.by_slot, teachers._sostegno_only,
+                     lessons, teachers._class_teachers),
+        "search": (search.entities, search._terms),
+        "conflicts": sched.conflicts,
+    }
+
+
+@pytest.mark.parametrize("edits", EDITS, ids=["move-room", "remove-add", "move-slot", "add-new-teacher"])
+def test_patched_indexes_equal_rebuild(parsed, edits):
+    new, affected = built(parsed).apply(edits)
+    assert affected["slots"]
+    assert new.ready("rooms") and new.ready("conflicts")  # patched, not left to a lazy rebuild
+    assert state(new) == state(SessionSchedule("inputs", new.parsed))
+
+
+def test_edits_accumulate(parsed):
+    sched = built(parsed)
+    for edits in EDITS[:3]:
+        sched, _affected = sched.apply(edits)
+    assert len(sched.edits) == 4
+    assert state(sched) == state(SessionSchedule("inputs", sched.parsed))
+
+
+@pytest.mark.parametrize("bad", [
+    {"op": "swap", "docente": "ABBATE", "giorno": "lun", "ora": 1},
+    {"op": "remove", "docente": "NESSUNO", "giorno": "lun", "ora": 1},
+    {"op": "add", "docente": "ABBATE", "classe": "3AS", "giorno": "lun", "ora": 99},
+])
+def test_failed_edit_changes_nothing(parsed, bad):
+    registry = ScheduleRegistry()
+    sched = built(parsed)
+    registry._schedules["s"] = sched
+    before_df, before = parsed.df_all.copy(), state(sched)
+    valid = EDITS[0][0]
+    with pytest.raises(ValueError):
+        registry.edit("s", [valid, bad])  # all or nothing: the valid edit is not kept either
+    assert registry._schedules["s"] is sched and registry.edits("s") == []
+    assert parsed.df_all.equals(before_df)
+    assert state(sched) == before
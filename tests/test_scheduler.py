@@ -0,0 +1,96 @@
+import random
+
+import pytest
+
+from app.scheduler import FairScheduler
+
+
+def drain(sched):
+    order = []
+    while (job_id := sched.get(timeout=0)) is not None:
+        order.append(job_id)
+    return order
+
+
+def assert_positions_match_dispatch(sched):
+    """jobs_ahead must equal each job's index in the actual dispatch order."""
+    waiting = list(sched._where)
+    ahead = {j: sched.jobs_ahead(j) for j in waiting}
+    order = drain(sched)
+    assert sorted(order) == sorted(waiting)
+    assert ahead == {j: i for i, j in enumerate(order)}
+
+
+def test_round_robin_across_sessions():
+    sched = FairScheduler()
+    for j in ("a1", "a2", "a3"):
+        sched.put(j, "A")
+    sched.put("b1", "B")
+    sched.put("c1", "C")
+    sched.put("c2", "C")
+    assert [sched.jobs_ahead(j) for j in ("a1", "b1", "c1", "a2", "c2", "a3")] == [0, 1, 2, 3, 4, 5]
+    assert drain(sched) == ["a1", "b1", "c1", "a2", "c2", "a3"]
+
+
+def test_batch_waits_behind_interactive():
+    sched = FairScheduler()
+    sched.put("b1", "A", "batch")
+    sched.put("b2", "B", "batch")
+    sched.put("i1", "B")
+    sched.put("i2", "C")
+    assert sched.jobs_ahead("i1") == 0
+    assert sched.jobs_ahead("b1") == 2
+    assert sched.session_head("A") == "b1"
+    assert sched.session_head("B") == "i1"  # interactive first, though queued later
+    assert drain(sched) == ["i1", "i2", "b1", "b2"]
+
+
+def test_remove_while_queued_shifts_positions():
+    sched = FairScheduler()
+    for j in ("a1", "a2"):
+        sched.put(j, "A")
+    for j in ("b1", "b2"):
+        sched.put(j, "B")
+    assert sched.jobs_ahead("b2") == 3
+    assert sched.remove("a2")
+    assert not sched.remove("a2")
+    assert sched.jobs_ahead("a2") is None
+    assert sched.jobs_ahead("b2") == 2
+    assert sched.remove("a1")  # A leaves the rotation
+    assert sched.session_head("A") is None
+    assert sched.count_for_session("A") == 0
+    assert [sched.jobs_ahead(j) for j in ("b1", "b2")] == [0, 1]
+    assert drain(sched) == ["b1", "b2"]
+
+
+def test_session_head_follows_dispatch():
+    sched = FairScheduler()
+    sched.put("a1", "A", "batch")
+    sched.put("a2", "A")
+    assert sched.session_head("A") == "a2"
+    assert sched.get(timeout=0) == "a2"
+    assert sched.session_head("A") == "a1"
+    assert sched.get(timeout=0) == "a1"
+    assert sched.session_head("A") is None
+
+
+def test_invalid_priority():
+    with pytest.raises(ValueError):
+        FairScheduler().put("x", "A", "urgent")
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_jobs_ahead_matches_dispatch_order(seed):
+    rng = random.Random(seed)
+    sched = FairScheduler()
+    queued = []
+    for n in range(rng.randint(1, 30)):
+        job_id = f"j{n}"
+        sched.put(job_id, rng.choice("ABCD"), rng.choice(("interactive", "batch")))
+        queued.append(job_id)
+        if rng.random() < 0.2:
+            sched.remove(queued.pop(rng.randrange(len(queued))))
+        if queued and rng.random() < 0.2:
+            queued.remove(sched.get(timeout=0))
+    assert len(sched) == len(queued)
+    assert_positions_match_dispatch(sched)